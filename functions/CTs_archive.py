@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import os
+import zlib
+import pickle
+import numpy as np
+import xarray as xr
+import JK_functions
+
+#Version of the archive format
+ARCHIVE_VERSION = 1
+#The 27 circulation types (-1 to 28) are stored as code + 2 (1 to 30), missing values as 0, in 5 bits
+CT_OFFSET = 2
+CT_BITS = 5
+
+def packing_bits(values, bits = CT_BITS):
+    """
+    This function packs small unsigned integers with a fixed number of bits each.
+
+    :param values: array of integers from 0 to 2**bits - 1
+    :param bits: number of bits per value
+    :return: bytes
+    """
+    values = np.asarray(values, dtype = np.uint8).ravel()
+    return(np.packbits(np.unpackbits(values[:, None], axis = 1)[:, 8 - bits:]).tobytes())
+
+def unpacking_bits(data, count, bits = CT_BITS):
+    """
+    This function unpacks the integers of packing_bits.
+
+    :param data: bytes
+    :param count: number of values
+    :param bits: number of bits per value
+    :return: numpy array of uint8 values
+    """
+    unpacked = np.unpackbits(np.frombuffer(data, dtype = np.uint8))[:count * bits].reshape((count, bits))
+    padding = np.zeros((count, 8 - bits), dtype = np.uint8)
+    return(np.packbits(np.concatenate([padding, unpacked], axis = 1), axis = 1).ravel())
+
+def encoding_chunk(values, codec):
+    """
+    This function encodes a chunk of circulation types.
+
+    :param values: array of circulation types (NaN for missing values)
+    :param codec: "bits" (5 bits per value) or "zlib" (one byte per value compressed with zlib)
+    :return: bytes
+    """
+    values = np.asarray(values, dtype = float)
+    stored = np.where(np.isfinite(values), np.nan_to_num(values) + CT_OFFSET, 0).astype(np.uint8)
+    if codec == 'bits':
+        return(packing_bits(stored))
+    return(zlib.compress(stored.tobytes(), 6))
+
+def decoding_chunk(data, shape, codec):
+    """
+    This function decodes a chunk of encoding_chunk.
+
+    :param data: bytes
+    :param shape: shape of the chunk
+    :param codec: "bits" or "zlib"
+    :return: numpy array of circulation types (float, NaN for missing values)
+    """
+    count = int(np.prod(shape))
+    if codec == 'bits':
+        stored = unpacking_bits(data, count)
+    else:
+        stored = np.frombuffer(zlib.decompress(data), dtype = np.uint8)
+    values = stored.astype(float) - CT_OFFSET
+    values[stored == 0] = np.nan
+    return(values.reshape(shape))
+
+def month_periods(time):
+    """
+    This function numbers the months of time values (year * 12 + month - 1).
+
+    :param time: array of time values (datetime64 or cftime dates)
+    :return: numpy array of integers
+    """
+    time = xr.DataArray(np.asarray(time), dims = 'time')
+    return(time.dt.year.values * 12 + time.dt.month.values - 1)
+
+def counting_codes(values, period, n_periods):
+    """
+    This function counts the stored codes (code + CT_OFFSET, 0 for missing values) of
+    a chunk for every month.
+
+    :param values: array of circulation types of the chunk, time first (NaN for missing values)
+    :param period: month (index in the summary) of every time step of the chunk
+    :param n_periods: number of months of the summary
+    :return: numpy array with the number of values of every month and stored code
+    """
+    stored = np.where(np.isfinite(values), np.nan_to_num(values) + CT_OFFSET, 0).astype(int)
+    flat = np.asarray(period).reshape((-1,) + (1,) * (stored.ndim - 1)) * 2**CT_BITS + stored
+    return(np.bincount(flat.ravel(), minlength = n_periods * 2**CT_BITS).reshape((n_periods, 2**CT_BITS)))
+
+def summarising_archive(meta, reading = None):
+    """
+    This function counts the stored codes of every month and every chunk of the grid of an
+    archive (decoding every chunk once), for archives written without the summary.
+
+    :param meta: description of the archive (see opening_archive)
+    :param reading: function returning the chunk (i, j, k), default reading_chunk
+    :return: dictionary with the month of every time step ("period", index of the months)
+             and the number of values of every month, chunk of the grid and stored code ("counts")
+    """
+    period = np.unique(month_periods(meta['coords'][meta['dims'][0]][1]), return_inverse = True)[1].ravel()
+    n_periods = int(period.max()) + 1
+    chunks = meta['chunks']
+    index = meta['index']
+    counts = np.zeros((n_periods,) + index.shape[1:3] + (2**CT_BITS,), dtype = np.int32)
+    with open(os.path.join(meta['directory'], meta['file']), 'rb') as f:
+        for i in range(index.shape[0]):
+            for j in range(index.shape[1]):
+                for k in range(index.shape[2]):
+                    chunk = reading_chunk(meta, i, j, k, f) if reading is None else reading(i, j, k)
+                    counts[:, j, k] += counting_codes(chunk, period[i * chunks[0]:(i + 1) * chunks[0]], n_periods)
+    return({'period': period, 'counts': counts})
+
+def writing_archive(CT, directory, time_chunk = 365, space_chunk = (64, 64), codec = 'bits'):
+    """
+    This function writes the circulation types to a compact archive. The values are
+    split in chunks of time steps and tiles of the grid, every chunk is packed and
+    its position is stored in an index, so reading a date range of a region only
+    decodes the chunks it touches (see reading_archive). The number of values of every
+    type, month and chunk of the grid is stored as well (see summed_types).
+
+    :param CT: circulation types in xarray format, time first and the grid (e.g. lat, lon) last.
+               Other dimensions (e.g. "number", "variant") are kept whole in every chunk
+    :param directory: str. directory of the archive
+    :param time_chunk: number of time steps per chunk (default 365)
+    :param space_chunk: (rows, columns) of the grid per chunk (default (64, 64))
+    :param codec: "bits" (default) packs every value in 5 bits, "zlib" compresses one byte per value with zlib
+                  (smaller for large uniform regions, slower to decode)
+    """
+    if isinstance(CT, xr.Dataset):
+        CT = CT['CT']
+    if codec not in ('bits', 'zlib'):
+        raise TypeError("Incorrect codec, only 'bits' or 'zlib' allowed")
+    if CT.dims[0] != 'time' or CT.ndim < 3:
+        raise ValueError('The circulation types must have time as first dimension and the grid as last dimensions')
+    shape = CT.shape
+    chunks = (time_chunk, space_chunk[0], space_chunk[1])
+    starts = [range(0, shape[0], chunks[0]), range(0, shape[-2], chunks[1]), range(0, shape[-1], chunks[2])]
+    index = np.zeros((len(starts[0]), len(starts[1]), len(starts[2]), 2), dtype = np.int64)
+    period = np.unique(month_periods(CT.time.values), return_inverse = True)[1].ravel()
+    n_periods = int(period.max()) + 1
+    counts = np.zeros((n_periods, len(starts[1]), len(starts[2]), 2**CT_BITS), dtype = np.int32)
+    os.makedirs(directory, exist_ok = True)
+    offset = 0
+    with open(os.path.join(directory, 'CT.bin'), 'wb') as f:
+        for i, t in enumerate(starts[0]):
+            #One block of time steps is read at once
+            block = np.asarray(CT[t:t + chunks[0]].values)
+            for j, y in enumerate(starts[1]):
+                for k, x in enumerate(starts[2]):
+                    values = block[..., y:y + chunks[1], x:x + chunks[2]]
+                    data = encoding_chunk(values, codec)
+                    f.write(data)
+                    index[i, j, k] = (offset, len(data))
+                    offset += len(data)
+                    counts[:, j, k] += counting_codes(values, period[t:t + chunks[0]], n_periods)
+    meta = {'version': ARCHIVE_VERSION, 'codec': codec, 'shape': shape, 'chunks': chunks, 'index': index,
+            'file': 'CT.bin', 'layouts': [], 'name': CT.name, 'dims': CT.dims, 'attrs': CT.attrs,
+            'coords': {name: (CT[name].dims, CT[name].values) for name in CT.coords},
+            'summary': {'period': period, 'counts': counts}}
+    with open(os.path.join(directory, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    print('Archive written: ' + directory + ' (' + str(round(offset / 1024**2, 2)) + ' MB) ✓')
+
+def opening_archive(directory):
+    """
+    This function reads the description and chunk index of an archive.
+
+    :param directory: str. directory of the archive
+    :return: dictionary with the description of the archive
+    """
+    with open(os.path.join(directory, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    if meta['version'] != ARCHIVE_VERSION:
+        raise ValueError('Archive version ' + str(meta['version']) + ' not supported')
+    meta.setdefault('file', 'CT.bin')
+    meta.setdefault('layouts', [])
+    meta['directory'] = directory
+    return(meta)
+
+def layout_view(meta, layout):
+    """
+    This function describes an archive through one of its other chunk layouts.
+
+    :param meta: description of the archive (see opening_archive)
+    :param layout: dictionary with the "file", "chunks", "index" and "codec" of the layout
+    :return: description of the archive with that layout
+    """
+    view = dict(meta)
+    view.update(layout)
+    view['layouts'] = []
+    return(view)
+
+def choosing_layout(meta, positions):
+    """
+    This function chooses the chunk layout of an archive decoding the fewest values
+    for a selection (e.g. time-contiguous chunks for the series of a few gridpoints,
+    map chunks for the maps of a few dates).
+
+    :param meta: description of the archive (see opening_archive)
+    :param positions: dictionary of arrays of positions for every dimension (see selecting_positions)
+    :return: description of the archive with the chosen layout
+    """
+    dims = meta['dims']
+    views = [meta] + [layout_view(meta, layout) for layout in meta.get('layouts', [])]
+    costs = []
+    for view in views:
+        touched = [len(np.unique(positions[dim] // chunk)) for dim, chunk in zip((dims[0], dims[-2], dims[-1]), view['chunks'])]
+        costs.append(np.prod(touched) * np.prod(view['chunks']))
+    return(views[int(np.argmin(costs))])
+
+def selecting_positions(meta, selection, method = None):
+    """
+    This function converts a selection by coordinate values (as with xarray "sel")
+    to the positions along every dimension.
+
+    :param meta: description of the archive (see opening_archive)
+    :param selection: dictionary of coordinate values or slices, e.g. {"time": slice("2000-12-01", "2001-02-28")}
+    :param method: None for exact values, "nearest" for the nearest coordinate values (not used with slices)
+    :return: dictionary of arrays of positions for every dimension, and list of the dimensions
+             selected with a single value
+    """
+    positions = {}
+    single = []
+    for axis, dim in enumerate(meta['dims']):
+        size = meta['shape'][axis]
+        if dim in selection:
+            coords = {dim: meta['coords'][dim][1]} if dim in meta['coords'] else {}
+            lookup = xr.DataArray(np.arange(size), coords = coords, dims = [dim])
+            if type(selection[dim]) == slice:
+                selected = lookup.sel({dim: selection[dim]})
+            else:
+                selected = lookup.sel({dim: selection[dim]}, method = method)
+            if selected.ndim == 0:
+                single.append(dim)
+            positions[dim] = np.atleast_1d(selected.values)
+        else:
+            positions[dim] = np.arange(size)
+    return(positions, single)
+
+def reading_chunk(meta, i, j, k, f = None):
+    """
+    This function reads and decodes one chunk of an archive.
+
+    :param meta: description of the archive (see opening_archive)
+    :param i, j, k: position of the chunk along time, rows and columns of the grid
+    :param f: file of the archive already opened (optional)
+    :return: numpy array of circulation types of the chunk
+    """
+    if f is None:
+        with open(os.path.join(meta['directory'], meta['file']), 'rb') as f:
+            return(reading_chunk(meta, i, j, k, f))
+    shape = meta['shape']
+    chunks = meta['chunks']
+    offset, length = meta['index'][i, j, k]
+    f.seek(offset)
+    chunk_shape = ((min(chunks[0], shape[0] - i * chunks[0]),) + tuple(shape[1:-2]) +
+                   (min(chunks[1], shape[-2] - j * chunks[1]), min(chunks[2], shape[-1] - k * chunks[2])))
+    return(decoding_chunk(f.read(length), chunk_shape, meta['codec']))
+
+def selected_chunks(meta, positions, reading = None):
+    """
+    This function decodes, one after the other, the chunks touched by the selected positions.
+
+    :param meta: description of the archive (see opening_archive)
+    :param positions: dictionary of arrays of positions for every dimension (see selecting_positions)
+    :param reading: function returning the chunk (i, j, k), e.g. from a cache of chunks (default reading_chunk)
+    :return: generator of the positions in the selection (time, rows and columns) and the selected values of every chunk
+    """
+    dims = meta['dims']
+    chunks = meta['chunks']
+    t_pos, y_pos, x_pos = positions[dims[0]], positions[dims[-2]], positions[dims[-1]]
+    middle = [positions[dim] for dim in dims[1:-2]]
+    if min([len(t_pos), len(y_pos), len(x_pos)] + [len(p) for p in middle]) == 0:
+        return
+    with open(os.path.join(meta['directory'], meta['file']), 'rb') as f:
+        for i in np.unique(t_pos // chunks[0]):
+            t_in = np.flatnonzero(t_pos // chunks[0] == i)
+            for j in np.unique(y_pos // chunks[1]):
+                y_in = np.flatnonzero(y_pos // chunks[1] == j)
+                for k in np.unique(x_pos // chunks[2]):
+                    x_in = np.flatnonzero(x_pos // chunks[2] == k)
+                    chunk = reading_chunk(meta, i, j, k, f) if reading is None else reading(i, j, k)
+                    chunk = chunk[t_pos[t_in] - i * chunks[0]]
+                    for axis, p in enumerate(middle):
+                        chunk = np.take(chunk, p, axis = axis + 1)
+                    chunk = chunk[..., y_pos[y_in] - j * chunks[1], :][..., x_pos[x_in] - k * chunks[2]]
+                    yield t_in, y_in, x_in, chunk
+
+def reading_chunks(meta, positions, reading = None):
+    """
+    This function decodes the chunks touched by the selected positions.
+
+    :param meta: description of the archive (see opening_archive)
+    :param positions: dictionary of arrays of positions for every dimension (see selecting_positions)
+    :param reading: function returning the chunk (i, j, k), e.g. from a cache of chunks (default reading_chunk)
+    :return: numpy array of circulation types of the selection
+    """
+    dims = meta['dims']
+    middle = [np.arange(len(positions[dim])) for dim in dims[1:-2]]
+    values = np.full((len(positions[dims[0]]),) + tuple(len(p) for p in middle) +
+                     (len(positions[dims[-2]]), len(positions[dims[-1]])), np.nan)
+    for t_in, y_in, x_in, chunk in selected_chunks(meta, positions, reading):
+        values[np.ix_(t_in, *middle, y_in, x_in)] = chunk
+    return(values)
+
+def counting_types(meta, positions, lookup, n_types, reading = None):
+    """
+    This function counts the circulation types of the selected positions chunk by chunk,
+    so only one decoded chunk is held in memory whatever the size of the selection.
+
+    :param meta: description of the archive (see opening_archive)
+    :param positions: dictionary of arrays of positions for every dimension (see selecting_positions)
+    :param lookup: class of every code + 2 (see JK_functions.type_classes)
+    :param n_types: number of classes
+    :param reading: function returning the chunk (i, j, k), e.g. from a cache of chunks (default reading_chunk)
+    :return: numpy array with the number of values of every class
+    """
+    counts = np.zeros(n_types, dtype = np.int64)
+    for t_in, y_in, x_in, chunk in selected_chunks(meta, positions, reading):
+        classes = JK_functions.type_indices(chunk, lookup)
+        counts += np.bincount(classes[classes >= 0], minlength = n_types)
+    return(counts)
+
+def summed_types(meta, positions, lookup, n_types, counting = None):
+    """
+    This function counts the circulation types of the selected positions from the summary of the
+    archive (see summarising_archive) for the months and chunks of the grid selected whole, and
+    decodes the chunks only for the rest of the selection (e.g. the edges of a box).
+
+    :param meta: description of the archive (see opening_archive), with its "summary"
+    :param positions: dictionary of arrays of positions for every dimension (see selecting_positions),
+                      every dimension except time, rows and columns selected whole
+    :param lookup: class of every code + 2 (see JK_functions.type_classes)
+    :param n_types: number of classes
+    :param counting: function counting the types of other positions, default counting_types
+    :return: numpy array with the number of values of every class
+    """
+    if counting is None:
+        counting = lambda selection: counting_types(choosing_layout(meta, selection), selection, lookup, n_types)
+    dims = meta['dims']
+    chunks = meta['chunks']
+    summary = meta['summary']
+    t_pos, y_pos, x_pos = positions[dims[0]], positions[dims[-2]], positions[dims[-1]]
+    #Months with all their time steps selected
+    n_periods = summary['counts'].shape[0]
+    whole_periods = (np.bincount(summary['period'][t_pos], minlength = n_periods) ==
+                     np.bincount(summary['period'], minlength = n_periods))
+    whole_periods &= np.bincount(summary['period'][t_pos], minlength = n_periods) > 0
+    #Chunks of the grid with all their rows (columns) selected
+    whole = []
+    for pos, chunk, size in ((y_pos, chunks[1], meta['shape'][-2]), (x_pos, chunks[2], meta['shape'][-1])):
+        n_chunks = -(-size // chunk)
+        whole.append(np.bincount(np.unique(pos) // chunk, minlength = n_chunks) ==
+                     np.bincount(np.arange(size) // chunk, minlength = n_chunks))
+    codes = summary['counts'][whole_periods][:, whole[0]][:, :, whole[1]].sum(axis = (0, 1, 2))
+    stored = np.flatnonzero(codes)
+    classes = JK_functions.type_indices(stored - CT_OFFSET, lookup)
+    counts = np.bincount(classes[classes >= 0], weights = codes[stored][classes >= 0], minlength = n_types).astype(np.int64)
+    #The rest of the selection is decoded: rows of partial chunks, columns of partial chunks, partial months
+    y_whole = y_pos[whole[0][y_pos // chunks[1]]]
+    x_whole = x_pos[whole[1][x_pos // chunks[2]]]
+    rest = [(t_pos, y_pos[~whole[0][y_pos // chunks[1]]], x_pos),
+            (t_pos, y_whole, x_pos[~whole[1][x_pos // chunks[2]]]),
+            (t_pos[~whole_periods[summary['period'][t_pos]]], y_whole, x_whole)]
+    for t_rest, y_rest, x_rest in rest:
+        if min(len(t_rest), len(y_rest), len(x_rest)) > 0:
+            counts += counting(dict(positions, **{dims[0]: t_rest, dims[-2]: y_rest, dims[-1]: x_rest}))
+    return(counts)
+
+def reading_points(meta, t_pos, y_pos, x_pos, reading = None):
+    """
+    This function reads the circulation types of a batch of points (time, row, column),
+    decoding every chunk touched once.
+
+    :param meta: description of the archive (see opening_archive)
+    :param t_pos, y_pos, x_pos: arrays of positions of the points along time, rows and columns of the grid
+    :param reading: function returning the chunk (i, j, k), e.g. from a cache of chunks (default reading_chunk)
+    :return: numpy array of circulation types, the points first and the other dimensions (e.g. "number") after
+    """
+    chunks = meta['chunks']
+    t_pos, y_pos, x_pos = (np.asarray(p, dtype = int) for p in (t_pos, y_pos, x_pos))
+    values = np.full((len(t_pos),) + tuple(meta['shape'][1:-2]), np.nan)
+    keys = np.stack([t_pos // chunks[0], y_pos // chunks[1], x_pos // chunks[2]], axis = 1)
+    unique, inverse = np.unique(keys, axis = 0, return_inverse = True)
+    inverse = inverse.ravel()
+    with open(os.path.join(meta['directory'], meta['file']), 'rb') as f:
+        for n, (i, j, k) in enumerate(unique):
+            points = np.flatnonzero(inverse == n)
+            chunk = reading_chunk(meta, i, j, k, f) if reading is None else reading(i, j, k)
+            values[points] = np.moveaxis(chunk[..., y_pos[points] - j * chunks[1], x_pos[points] - k * chunks[2]], -1, 0)[
+                np.arange(len(points)), t_pos[points] - i * chunks[0]]
+    return(values)
+
+def reading_archive(directory, method = None, **selection):
+    """
+    This function reads the circulation types of an archive, decoding only
+    the chunks touched by the selection.
+
+    :param directory: str. directory of the archive (see writing_archive)
+    :param method: None for exact coordinate values, "nearest" for the nearest ones (not used with slices)
+    :param selection: coordinate values or slices of any dimension, as with xarray "sel", e.g.
+                      time = slice("2000-12-01", "2001-02-28"), lat = slice(60, 40), lon = slice(-20, 10)
+    :return: circulation types in xarray format
+
+    Archives with several chunk layouts (see rechunking_archive) are read with the layout
+    decoding the fewest values for the selection.
+    """
+    meta = opening_archive(directory)
+    for dim in selection:
+        if dim not in meta['dims']:
+            raise ValueError('Dimension ' + str(dim) + ' not found in the archive')
+    positions, single = selecting_positions(meta, selection, method)
+    values = reading_chunks(choosing_layout(meta, positions), positions)
+    coords = {}
+    for name, (dims, coord) in meta['coords'].items():
+        coords[name] = (dims, coord[np.ix_(*[positions[dim] for dim in dims])] if len(dims) > 0 else coord)
+    output = xr.DataArray(data = values, coords = coords, dims = meta['dims'])
+    #Single values drop the dimension (as with xarray "sel")
+    output = output.isel({dim: 0 for dim in single})
+    output.name = meta['name']
+    output.attrs = meta['attrs']
+    return(output)
+
+def rechunking_archive(directory, time_chunk = None, space_chunk = (8, 8), memory = '1GB', output = None, codec = None):
+    """
+    This function rewrites an archive with another chunk layout, by default time-contiguous
+    chunks (the whole record of 8 x 8 gridpoints per chunk) so the series of a gridpoint is
+    read from one chunk. The chunks are written in groups fitting the memory budget.
+    The new layout is kept side by side with the original one in the same archive
+    (reading_archive then picks the best one for every selection), or written to a new archive.
+
+    :param directory: str. directory of the archive
+    :param time_chunk: number of time steps per chunk (default None, the whole record)
+    :param space_chunk: (rows, columns) of the grid per chunk (default (8, 8))
+    :param memory: memory budget, in bytes or as a string (e.g. "1GB")
+    :param output: str. directory of a new archive with only the new layout (default None adds
+                   the layout to the archive)
+    :param codec: "bits" or "zlib" (default None, the codec of the archive)
+    """
+    import JK_planner
+    meta = opening_archive(directory)
+    shape = meta['shape']
+    codec = meta['codec'] if codec is None else codec
+    if codec not in ('bits', 'zlib'):
+        raise TypeError("Incorrect codec, only 'bits' or 'zlib' allowed")
+    chunks = (shape[0] if time_chunk is None else min(time_chunk, shape[0]), min(space_chunk[0], shape[-2]),
+              min(space_chunk[1], shape[-1]))
+    starts = [range(0, shape[0], chunks[0]), range(0, shape[-2], chunks[1]), range(0, shape[-1], chunks[2])]
+    index = np.zeros((len(starts[0]), len(starts[1]), len(starts[2]), 2), dtype = np.int64)
+    #Number of chunks decoded at once (as float values, plus the chunks of the original layout)
+    chunk_bytes = 8 * np.prod(chunks) * np.prod(shape[1:-2], dtype = int)
+    group = int(max(JK_planner.memory_size(memory) // (2 * chunk_bytes), 1))
+    name = 'CT_' + 'x'.join(str(c) for c in chunks) + '.bin'
+    if output is not None:
+        os.makedirs(output, exist_ok = True)
+        name = 'CT.bin'
+    positions = {dim: np.arange(size) for dim, size in zip(meta['dims'], shape)}
+    offset = 0
+    with open(os.path.join(directory if output is None else output, name), 'wb') as f:
+        for i, t in enumerate(starts[0]):
+            for j, y in enumerate(starts[1]):
+                for first in range(0, len(starts[2]), group):
+                    last = min(first + group, len(starts[2]))
+                    positions[meta['dims'][0]] = np.arange(t, min(t + chunks[0], shape[0]))
+                    positions[meta['dims'][-2]] = np.arange(y, min(y + chunks[1], shape[-2]))
+                    positions[meta['dims'][-1]] = np.arange(starts[2][first], min(starts[2][last - 1] + chunks[2], shape[-1]))
+                    block = reading_chunks(meta, positions)
+                    for k in range(first, last):
+                        x = starts[2][k] - starts[2][first]
+                        data = encoding_chunk(block[..., x:x + chunks[2]], codec)
+                        f.write(data)
+                        index[i, j, k] = (offset, len(data))
+                        offset += len(data)
+    layout = {'file': name, 'chunks': chunks, 'index': index, 'codec': codec}
+    if output is None:
+        meta['layouts'] = [other for other in meta.get('layouts', []) if other['file'] != name] + [layout]
+    else:
+        meta.update(layout)
+        meta['layouts'] = []
+        #The summary counts the chunks of the original layout
+        meta.pop('summary', None)
+        directory = output
+    del(meta['directory'])
+    with open(os.path.join(directory, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    print('Layout of ' + ' x '.join(str(c) for c in chunks) + ' written: ' + os.path.join(directory, name) +
+          ' (' + str(round(offset / 1024**2, 2)) + ' MB) ✓')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import numpy as np
+import xarray as xr
+import JK_functions
+import JK_io
+import CTs_composites
+
+def confusion_counts(reference, model, types = 27, block_size = 365, prefetch = 2):
+    """
+    This function counts, at every gridpoint, the days of every pair of circulation types of two
+    datasets (one bincount of the paired types per block of time steps). The days of the model
+    are matched with the days of the reference, and only the days found in both are counted.
+
+    :param reference: circulation types (e.g. ERA5) in xarray format, or str. filename, glob pattern or list of filenames
+    :param model: circulation types (e.g. a CMIP6 model) in xarray format or filenames, on the grid of the
+                  reference or on a grid containing it
+    :param types: 27 (default) or 11 (grouped types, see JK_functions.CT_GROUPS)
+    :param block_size: number of time steps read at once (default 365)
+    :param prefetch: number of blocks of the reference read in advance (default 2)
+    :return: counts with the types of the reference and of the model first and the gridpoints after,
+             the labels of the types and the reference (first segment, in xarray format)
+    """
+    labels, lookup = JK_functions.type_classes(types)
+    n_types = len(labels)
+    ref_segments = CTs_composites.opening_variable(reference, 'CT')
+    CT = ref_segments[0]
+    cells = int(np.prod(CT.shape[1:]))
+    cell = np.arange(cells).reshape(CT.shape[1:])
+    #Indexing the days of the model
+    segments = [CTs_composites.matching_grid(segment, CT) for segment in CTs_composites.opening_variable(model, 'CT')]
+    index = CTs_composites.indexing_days(segments, 'CT')
+    expand = tuple(n + 1 for n, dim in enumerate(CT.dims[1:]) if dim not in segments[0].dims)
+    ref_days = np.concatenate([JK_functions.normalise_time(segment.time.values) for segment in ref_segments])
+    counts = np.zeros(n_types * n_types * cells, dtype = np.int64)
+    print('Counting the pairs of circulation types ⇄')
+    for start, block in JK_io.prefetch_blocks(ref_segments, block_size, depth = prefetch, scale = 1):
+        values = CTs_composites.reading_days(segments, ref_days[start:start + len(block)], index)
+        values = np.broadcast_to(np.expand_dims(values, expand), block.shape)
+        first = JK_functions.type_indices(block, lookup)
+        second = JK_functions.type_indices(values, lookup)
+        paired = (first >= 0) & (second >= 0)
+        flat = (first * n_types + second) * cells + cell
+        counts += np.bincount(flat[paired], minlength = n_types * n_types * cells)
+    return(counts.reshape((n_types, n_types) + CT.shape[1:]), labels, CT)
+
+def CT_comparison(reference, model, types = 27, block_size = 365, prefetch = 2):
+    """
+    This function compares two datasets of circulation types (e.g. a CMIP6 model against ERA5)
+    at every gridpoint, from the confusion counts of the types of the days found in both.
+
+    :param reference: circulation types in xarray format, or str. filename, glob pattern or list of filenames
+    :param model: circulation types in xarray format or filenames, on the grid of the reference
+                  or on a grid containing it
+    :param types: 27 (default) or 11 (grouped types)
+    :param block_size: number of time steps read at once (default 365)
+    :param prefetch: number of blocks of the reference read in advance (default 2)
+    :return: xarray dataset with the confusion counts ("confusion", types of the reference and of the model),
+             the number of days compared ("days"), the relative frequencies of every type ("frequency_reference",
+             "frequency_model") and their difference ("frequency_bias"), the fraction of days of the same type
+             ("accuracy"), the Brier score of every type ("brier", the model type of every day as a forecast of
+             the reference type) and of all the types ("brier_score") and the Perkins skill score ("perkins"),
+             NaN scores at the gridpoints without days compared
+    """
+    counts, labels, CT = confusion_counts(reference, model, types, block_size, prefetch)
+    days = counts.sum(axis = (0, 1))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        total = np.where(days > 0, days, np.nan)
+        frequency_reference = counts.sum(axis = 1) / total
+        frequency_model = counts.sum(axis = 0) / total
+        hits = np.moveaxis(np.diagonal(counts), -1, 0) / total
+    #A type is wrongly forecast when the model or the reference have it and the other does not
+    brier = frequency_reference + frequency_model - 2 * hits
+    #Storing the comparison in an xarray dataset
+    dims = list(CT.dims[1:])
+    coords = {'type': labels, 'type_reference': labels, 'type_model': labels}
+    for name in CT.coords:
+        if name != 'time' and all(dim in dims for dim in CT[name].dims):
+            coords[name] = (CT[name].dims, CT[name].values)
+    output = xr.Dataset(coords = coords)
+    output['confusion'] = (['type_reference', 'type_model'] + dims, counts)
+    output['days'] = (dims, days)
+    output['frequency_reference'] = (['type'] + dims, frequency_reference)
+    output['frequency_model'] = (['type'] + dims, frequency_model)
+    output['frequency_bias'] = (['type'] + dims, frequency_model - frequency_reference)
+    output['accuracy'] = (dims, hits.sum(axis = 0))
+    output['brier'] = (['type'] + dims, brier)
+    output['brier_score'] = (dims, brier.sum(axis = 0))
+    output['perkins'] = (dims, np.minimum(frequency_reference, frequency_model).sum(axis = 0))
+    output.attrs = {'description': 'Comparison of Jenkinson-Collison circulation types'}
+    print('The End! ✓')
+    return(output)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import warnings
+import numpy as np
+import xarray as xr
+import JK_functions
+import JK_io
+
+def opening_variable(source, name):
+    """
+    This function opens a variable lazily (nothing is loaded into memory) as a list
+    of time-ordered segments, one per file.
+
+    :param source: variable or dataset in xarray format, or str. filename, glob pattern or list of filenames
+    :param name: name of the variable in the datasets and files (the only gridded variable when not found,
+                 see JK_io.selecting_variable)
+    :return: list of segments in xarray format
+    """
+    def variable(DS):
+        if name in DS.data_vars:
+            return DS[name]
+        return JK_io.selecting_variable(DS)
+    if isinstance(source, xr.DataArray):
+        return([source])
+    if isinstance(source, xr.Dataset):
+        return([variable(source)])
+    return(JK_io.opening_segments(JK_io.input_files(source), variable)[0])
+
+def matching_grid(segment, CT):
+    """
+    This function selects the gridpoints of the circulation types in a
+    co-registered variable (same grid, or a grid containing it).
+
+    :param segment: variable in xarray format (not loaded)
+    :param CT: circulation types in xarray format
+    :return: variable with the dimensions of the circulation types
+    """
+    renames = {old: new for old, new in (('latitude', 'lat'), ('longitude', 'lon')) if old in segment.dims}
+    segment = segment.rename(renames)
+    if 'lon' in segment.dims and 'lon' in CT.dims:
+        segment = JK_functions.checking_lon_coords(segment, 'lon')
+    selection = {dim: CT[dim].values for dim in CT.dims[1:] if dim in segment.dims and dim in CT.coords}
+    try:
+        segment = segment.sel(selection, method = 'nearest', tolerance = 1e-3)
+    except KeyError:
+        raise ValueError('The variables must be on the grid of the circulation types')
+    dims = [dim for dim in CT.dims if dim in segment.dims]
+    return(segment.transpose(*dims))
+
+def indexing_days(segments, name, daily = None):
+    """
+    This function indexes the time steps of a variable by day.
+
+    :param segments: list of segments in xarray format (not loaded)
+    :param name: name of the variable (for the error messages)
+    :param daily: None (default) for daily variables, "mean" to average the time steps of every day
+                  or an integer hour (e.g. 12) to keep that hour only, for sub-daily variables
+    :return: dictionary with the list of (segment, position) of every day
+    """
+    JK_functions.checking_daily(daily)
+    index = {}
+    for s, segment in enumerate(segments):
+        days = JK_functions.normalise_time(segment.time.values)
+        keep = np.ones(len(days), dtype = bool) if daily in (None, 'mean') else segment.time.dt.hour.values == daily
+        for position in np.flatnonzero(keep):
+            index.setdefault(days[position], []).append((s, position))
+    if daily is None and any(len(steps) > 1 for steps in index.values()):
+        raise ValueError("The variable '" + name + "' has several time steps per day, "
+                         "use daily = 'mean' or an integer hour")
+    return(index)
+
+def reading_days(segments, days, index, scale = 1):
+    """
+    This function reads the time steps of a variable matching a list of days,
+    reading only the time steps between the first and last day of every segment.
+    The time steps of the same day are averaged.
+
+    :param segments: list of segments in xarray format (not loaded)
+    :param days: array of days (see JK_functions.normalise_time) to be read
+    :param index: dictionary with the (segment, position) of the time steps of every day (see indexing_days)
+    :param scale: the values are divided by scale
+    :return: numpy array with the days first, NaN for the days not found
+    """
+    sums = np.zeros((len(days),) + segments[0].shape[1:])
+    counts = np.zeros(sums.shape)
+    for s, segment in enumerate(segments):
+        steps = [(n, position) for n, day in enumerate(days) for f, position in index.get(day, []) if f == s]
+        if len(steps) == 0:
+            continue
+        rows = np.array([n for n, position in steps])
+        positions = np.array([position for n, position in steps])
+        first = positions.min()
+        values = JK_io.reading_block(segment, first, positions.max() + 1, scale)[positions - first]
+        valid = np.isfinite(values)
+        np.add.at(sums, rows, np.where(valid, values, 0))
+        np.add.at(counts, rows, valid)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return(sums / counts)
+
+def CT_composites(CT, variables, thresholds = None, types = 27, block_size = 365, prefetch = 2, daily = None):
+    """
+    This function computes the composites of other variables (e.g. precipitation or temperature)
+    by circulation type at every gridpoint, in one streaming pass over blocks of time steps.
+    For every type and gridpoint the sum, number of values, mean, variance and the number of
+    values exceeding thresholds are accumulated with weighted bincounts, so no masks of the
+    whole record are built. The variables are matched with the circulation types by day.
+
+    :param CT: circulation types in xarray format (time first, or the dataset of JK_classification with
+               diagnostics or ensemble statistics), or str. filename, glob pattern or list of filenames
+               of the results of JK_classification
+    :param variables: dictionary of the variables, e.g. {'pr': 'pr_day_*.nc', 't2m': t2m}, given in
+                      xarray format (variables or datasets) or as filenames, glob patterns or lists of filenames (split
+                      files are read one after the other). The variables can have the dimensions of the
+                      circulation types or fewer (e.g. no "number"), on the same grid or a grid containing it
+    :param thresholds: dictionary of lists of thresholds of the variables, e.g. {'pr': [1, 10, 20]}
+    :param types: 27 (default) or 11 (grouped types, see JK_functions.CT_GROUPS)
+    :param block_size: number of time steps read at once (default 365)
+    :param prefetch: number of blocks of circulation types read in advance (default 2)
+    :param daily: None (default) for daily variables (sub-daily variables raise an error), "mean" to average
+                  the time steps of every day or an integer hour (e.g. 12) to keep that hour only
+    :return: xarray dataset with the number of days of every type ("CT_count") and the mean
+             ("<name>_mean"), variance ("<name>_variance"), number of values ("<name>_count") and
+             number of values above the thresholds ("<name>_exceedance") of every variable
+    """
+    thresholds = thresholds or {}
+    labels, lookup = JK_functions.type_classes(types)
+    n_types = len(labels)
+    ct_segments = opening_variable(CT, 'CT')
+    CT = ct_segments[0]
+    cells = int(np.prod(CT.shape[1:]))
+    cell = np.arange(cells)
+    #Opening the variables and indexing their days
+    sources = {}
+    for name, source in variables.items():
+        segments = [matching_grid(segment, CT) for segment in opening_variable(source, name)]
+        index = indexing_days(segments, name, daily)
+        expand = tuple(n for n, dim in enumerate(CT.dims[1:]) if dim not in segments[0].dims)
+        sources[name] = {'segments': segments, 'index': index, 'expand': expand,
+                         'thresholds': np.atleast_1d(thresholds.get(name, [])).astype(float)}
+    ct_days = np.concatenate([JK_functions.normalise_time(segment.time.values) for segment in ct_segments])
+    #Accumulators: types first and gridpoints after
+    CT_count = np.zeros(n_types * cells)
+    sums = {name: {'count': np.zeros(n_types * cells), 'sum': np.zeros(n_types * cells),
+                   'squares': np.zeros(n_types * cells), 'shift': None,
+                   'exceedance': np.zeros((len(source['thresholds']), n_types * cells))}
+            for name, source in sources.items()}
+    print('Accumulating the composites by circulation type ∑')
+    for start, block in JK_io.prefetch_blocks(ct_segments, block_size, depth = prefetch, scale = 1):
+        classes = JK_functions.type_indices(block, lookup)
+        typed = classes >= 0
+        flat = classes * cells + cell.reshape(CT.shape[1:])
+        CT_count += np.bincount(flat[typed], minlength = n_types * cells)
+        days = ct_days[start:start + len(block)]
+        for name, source in sources.items():
+            values = reading_days(source['segments'], days, source['index'])
+            values = np.broadcast_to(np.expand_dims(values, tuple(n + 1 for n in source['expand'])), block.shape)
+            total = sums[name]
+            if total['shift'] is None:
+                #Values are accumulated relative to the mean of the first block (accurate variances)
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning) #Gridpoints without values
+                    total['shift'] = np.nan_to_num(np.nanmean(values, axis = 0))
+            valid = typed & np.isfinite(values)
+            index = flat[valid]
+            shifted = (values - total['shift'])[valid]
+            total['count'] += np.bincount(index, minlength = n_types * cells)
+            total['sum'] += np.bincount(index, weights = shifted, minlength = n_types * cells)
+            total['squares'] += np.bincount(index, weights = shifted**2, minlength = n_types * cells)
+            for n, threshold in enumerate(source['thresholds']):
+                total['exceedance'][n] += np.bincount(index, weights = values[valid] > threshold,
+                                                      minlength = n_types * cells)
+    #Storing the composites in an xarray dataset
+    dims = ['type'] + list(CT.dims[1:])
+    coords = {'type': labels}
+    for name in CT.coords:
+        if name != 'time' and all(dim in dims for dim in CT[name].dims):
+            coords[name] = (CT[name].dims, CT[name].values)
+    shape = (n_types,) + CT.shape[1:]
+    output = xr.Dataset(coords = coords)
+    output['CT_count'] = (dims, CT_count.reshape(shape))
+    for name, total in sums.items():
+        count = total['count'].reshape(shape)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = total['sum'].reshape(shape) / count
+            variance = (total['squares'].reshape(shape) - count * mean**2) / (count - 1)
+        output[name + '_mean'] = (dims, mean + total['shift'])
+        output[name + '_variance'] = (dims, np.where(count > 1, np.maximum(variance, 0), np.nan))
+        output[name + '_count'] = (dims, count)
+        if len(sources[name]['thresholds']) > 0:
+            output[name + '_exceedance'] = (['threshold_' + name] + dims, total['exceedance'].reshape((-1,) + shape))
+            output = output.assign_coords({'threshold_' + name: sources[name]['thresholds']})
+    output.attrs = {'description': 'Composites by Jenkinson-Collison circulation type'}
+    print('The End! ✓')
+    return(output)
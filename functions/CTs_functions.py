@@ -7,18 +7,14 @@
 """
 
 import numpy as np
-import pandas as pd
 import xarray as xr
-import matplotlib.pyplot as plt
-import seaborn as sns
-from mpl_toolkits.basemap import Basemap
-import cftime
-from matplotlib import cm
-from matplotlib.colors import ListedColormap, LinearSegmentedColormap
-import matplotlib.colors as colors
-from matplotlib.patches import Patch
-from matplotlib.lines import Line2D
+import JK_functions
+#The plotting modules (matplotlib and Basemap) are imported when plotting,
+#so the circulation types can be processed without them
+from CTs_plots import plotting_modules
+
 def plot_CT(CT):
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
     #Defining colours to plot CTs
     colores = ListedColormap(["#7C7C77", "#000000", "#2179E4", "#1A49D7", "#8591FB",
                          "#FAF084", "#55DD9D", "#056704", "#548A80", 
@@ -48,6 +44,7 @@ def plot_CT_MSLP(CT,date,file_dir,source):
     :param CT: xarray file of the eleven reduced circulation types
 
     '''
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
 #     print('Provide the date to be plotted as "YYYY-MM-DD":')
 #     date = str(input())
     MSLP = xr.open_dataset(file_dir)
@@ -96,7 +93,7 @@ def plot_CT_MSLP(CT,date,file_dir,source):
     x,y = m(lons, lats)
     
     im1 = m.pcolor(x,y,CT,norm = norm,cmap = colores, alpha = 0.70)
-    from scipy.ndimage.filters import gaussian_filter
+    from scipy.ndimage import gaussian_filter
     data3 = gaussian_filter(MSLP, sigma=.8)    
     im2 = m.contour(x,y,data3, np.arange(1012-40, 1012+44, 4), colors = '0.10', linewidths = 0.5)
     plt.clabel(im2, im2.levels, inline=True,fmt ='%.0f', fontsize=10)
@@ -148,6 +145,8 @@ def seasonal_frelative_frequencies(filename, year_init, year_end):
     DS = xr.open_dataset(filename)
     CT = DS.CT.sel(time = slice(str(year_init)+'-03-01', str(year_end)+'-11-30'))
     del(DS)
+    #Consistent daily time coordinate for every calendar
+    CT = CT.assign_coords(time = JK_functions.normalise_time(CT.time.values))
     LF = xr.where(CT == -1, 1, np.nan)
     A = xr.where(CT ==  0, 1, np.nan)
     C = xr.where(CT == 20, 1, np.nan)
@@ -204,3 +203,28 @@ def seasonal_frelative_frequencies(filename, year_init, year_end):
 
 
 
+
+def ensemble_CTs(CT, types = 27, dim = 'number'):
+    '''
+    This function computes the ensemble statistics of circulation types already classified
+    (see JK_functions.ensemble_statistics), the members of every type are counted in one pass
+
+    :param CT: circulation types of the ensemble members in xarray format
+    :param types: 27 or 11 (grouped types, coded as eleven_CTs)
+    :param dim: dimension of the ensemble members (default "number")
+    :return: xarray dataset with "CT_probability" ("type" dimension after time), "CT_mode",
+             "CT_agreement" and "CT_entropy"
+    '''
+    if dim not in CT.dims:
+        raise ValueError('The ensemble statistics need the "' + dim + '" dimension of the ensemble members')
+    labels = JK_functions.type_classes(types)[0]
+    reduced = JK_functions.ensemble_statistics(CT.values, CT.dims.index(dim), types)
+    dims = [name for name in CT.dims if name != dim]
+    position = 1 if dims[0] == 'time' else 0
+    coords = {name: values for name, values in CT.coords.items() if dim not in values.dims}
+    output = xr.Dataset(coords = coords)
+    output['CT_probability'] = (dims[:position] + ['type'] + dims[position:], np.moveaxis(reduced['probability'], -1, position))
+    output = output.assign_coords(type = labels)
+    for name in ('mode', 'agreement', 'entropy'):
+        output['CT_' + name] = (dims, reduced[name])
+    return(output)
@@ -4,21 +4,31 @@
 # In[1]:
 
 
+import os
 import numpy as np
-import pandas as pd
 import xarray as xr
-from mpl_toolkits.basemap import Basemap
-import matplotlib.pyplot as plt
-import cftime
-from matplotlib import cm
-from matplotlib.colors import ListedColormap, LinearSegmentedColormap
-import matplotlib.colors as colors
-from matplotlib.patches import Patch
-from matplotlib.lines import Line2D
 import sys
+from collections import OrderedDict
+from functools import lru_cache
 directory = 'functions/'
 sys.path.insert(0, directory)
 import JK_functions
+#The plotting modules (matplotlib and Basemap) are imported on first use,
+#so importing this module (e.g. in a pool of processes) stays fast
+
+def plotting_modules():
+    '''
+    This function imports the plotting modules on first use (also used by CTs_functions)
+
+    :return: pyplot, Basemap, ListedColormap, matplotlib.colors and Line2D
+    '''
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.basemap import Basemap
+    from matplotlib.colors import ListedColormap
+    import matplotlib.colors as colors
+    from matplotlib.lines import Line2D
+    return(plt, Basemap, ListedColormap, colors, Line2D)
+
 def plot_CT(CT, date):
     '''
     This function plots the 11 circulation types to a map
@@ -27,6 +37,7 @@ def plot_CT(CT, date):
     :param CT: xarray file of the eleven reduced circulation types
 
     '''
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
     CT = CT.sel(time = date)[0]
     print('Would you like to provide the area to be plotted? \n yes/no')
     answer = input()
@@ -111,6 +122,87 @@ def plot_CT(CT, date):
     plt.ioff()
     return fig
 
+#Open MSLP files (modification time, dataset and variable with the longitude coordinates fixed),
+#least recently used first
+_mslp_handles = OrderedDict()
+MSLP_HANDLES = 8
+
+def MSLP_handle(filename_MSLP, lon_name):
+    '''
+    This function returns the MSLP variable of a file without reading its values.
+    The open files, with the longitude coordinates already fixed to -180 to 180,
+    are kept for the following plots (up to MSLP_HANDLES files, the files removed
+    are closed). A file modified since it was opened is opened again.
+
+    :param filename_MSLP: a string indicating the location and name of the Mean Sea Level Pressure dataset
+    :param lon_name: name of longitude coordinate
+    '''
+    key = (filename_MSLP, lon_name)
+    mtime = os.path.getmtime(filename_MSLP)
+    if key in _mslp_handles:
+        if _mslp_handles[key][0] == mtime:
+            _mslp_handles.move_to_end(key)
+            return _mslp_handles[key][2]
+        _mslp_handles.pop(key)[1].close()
+    DS = xr.open_dataset(filename_MSLP)
+    MSLP = DS[list(DS.variables)[-1]]
+    print('Checking if longitude coordinates are -180 to 180')
+    MSLP = JK_functions.checking_lon_coords(MSLP, lon_name)
+    _mslp_handles[key] = (mtime, DS, MSLP)
+    while len(_mslp_handles) > MSLP_HANDLES:
+        _mslp_handles.popitem(last = False)[1][1].close()
+    return MSLP
+
+@lru_cache(maxsize = 16)
+def map_projection(**kwargs):
+    '''
+    This function returns the Basemap of the given projection and area. The maps
+    (with their parsed coastlines) are kept, so browsing dates does not build them again.
+
+    :param kwargs: arguments of Basemap
+    '''
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
+    return Basemap(**kwargs)
+
+def MSLP_contours(filename_MSLP, source, date, lat_north, lat_south, lon_west, lon_east):
+    '''
+    This function reads the MSLP (hPa) of one date over the plotted area only,
+    and smooths it for the contours. The smoothed fields are kept in memory,
+    so plotting again the same date and area does not read the file (unless
+    the file was modified meanwhile).
+
+    :param filename_MSLP: a string indicating the location and name of the Mean Sea Level Pressure dataset
+    :param source: a string indicating the source of the dataset. Either "REAN" or "GCM"
+    :param date: a string in format "YYYY-MM-DD" indicating the date to be plotted
+    :param lat_north, lat_south, lon_west, lon_east: limits of the plotted area
+    :return: array of smoothed MSLP values
+    '''
+    return smoothed_MSLP(filename_MSLP, os.path.getmtime(filename_MSLP), source, date,
+                         lat_north, lat_south, lon_west, lon_east)
+
+@lru_cache(maxsize = 64)
+def smoothed_MSLP(filename_MSLP, mtime, source, date, lat_north, lat_south, lon_west, lon_east):
+    '''
+    This function reads and smooths the MSLP of one date (see MSLP_contours), the
+    modification time of the file is part of the key of the fields kept.
+    '''
+    from scipy.ndimage import gaussian_filter
+    if source == 'REAN':
+        MSLP = MSLP_handle(filename_MSLP, 'longitude').sel(time = date)[0]
+        MSLP = MSLP.sel(latitude = slice(lat_north, lat_south), longitude = slice(lon_west, lon_east))
+        lat_list = list(MSLP.latitude)
+    elif source == 'GCM':
+        MSLP = MSLP_handle(filename_MSLP, 'lon').sel(time = date)[0]
+        MSLP = MSLP.sel(lat = slice(lat_south, lat_north), lon = slice(lon_west, lon_east))
+        lat_list = list(MSLP.lat)
+    else:
+        raise TypeError("Incorrect source, only 'REAN' or 'GCM' allowed")
+    MSLP = MSLP.load()/100 #Only the date and area plotted are read
+    order_lats = lat_list[0] - lat_list[-1]
+    if order_lats < 0:
+        MSLP = MSLP.reindex(lat=list(reversed(MSLP.lat)))
+    return gaussian_filter(MSLP, sigma=.8)
+
 def plot_CT_MSLP(CT,date,source, filename_MSLP):
     '''
     This function plots the 11 circulation types to a map
@@ -122,21 +214,12 @@ def plot_CT_MSLP(CT,date,source, filename_MSLP):
     :param filename_MSLP: a string indicating the location and name of the Mean Sea Level Pressure dataset
 
     '''
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
 #     print('Provide the date to be plotted as "YYYY-MM-DD":')
 #     date = str(input())
-    MSLP = xr.open_dataset(filename_MSLP)
-    MSLP = MSLP[list(MSLP.variables)[-1]]/100
-    MSLP = MSLP.sel(time = date)[0]
     CT = CT.sel(time = date)[0]
-    #Checking longitude coordinates to be - 180 to 180
-    if source == 'REAN':
-        lon_name = 'longitude'
-    elif source == 'GCM':
-        lon_name = 'lon'
-    else:
+    if source not in ('REAN', 'GCM'):
         raise TypeError("Incorrect source, only 'REAN' or 'GCM' allowed")
-    print('Checking if longitude coordinates are -180 to 180')
-    MSLP = JK_functions.checking_lon_coords(MSLP, lon_name)
     
             
     print('Would you like to provide the area to be plotted? \n yes/no')
@@ -174,28 +257,10 @@ def plot_CT_MSLP(CT,date,source, filename_MSLP):
         size_x = 12
         size_y = 6        
     
-    if source == 'REAN':
-        MSLP = MSLP.sel(latitude = slice(lat_north, lat_south), longitude = slice(lon_west, lon_east))
-        lat = MSLP.latitude
-        lon = MSLP.longitude
-        lon_list = list(lon)
-        lat_list = list(lat)
-    elif source == 'GCM':
-        MSLP = MSLP.sel(lat = slice(lat_south, lat_north), lon = slice(lon_west, lon_east))
-        lat = MSLP.lat
-        lon = MSLP.lon
-        lon_list = list(lon)
-        lat_list = list(lat)          
-    else:
-        raise TypeError("Source dataset not recognised!")        
-        
     CT = xr.where((CT.lat < 10) & (CT.lat > -10), np.nan, CT)       
         
-    order_lats = lat_list[0] - lat_list[-1]
-    if order_lats < 0:
-        MSLP = MSLP.reindex(lat=list(reversed(MSLP.lat)))
-    else:
-        None
+    #Smoothed MSLP of the date and area plotted
+    data3 = MSLP_contours(filename_MSLP, source, str(date), float(lat_north), float(lat_south), float(lon_west), float(lon_east))
         
     #Defining colours to plot CTs
     colores = ListedColormap(["#7C7C77", "#17344F", "#0255F4","#0F78ED", "#9E09EE", "#F6664C",
@@ -206,13 +271,11 @@ def plot_CT_MSLP(CT,date,source, filename_MSLP):
     #Defining size and map boundaries
     plt.gcf().clear()   
     fig= plt.figure(figsize = (size_x,size_y))    
-    m = Basemap(projection='cyl',llcrnrlat=lat_south,urcrnrlat=lat_north,\
-                    llcrnrlon=lon_west,urcrnrlon=lon_east,resolution='l')
+    m = map_projection(projection='cyl',llcrnrlat=float(lat_south),urcrnrlat=float(lat_north),\
+                    llcrnrlon=float(lon_west),urcrnrlon=float(lon_east),resolution='l')
     m.drawcoastlines()
     x,y = m(lons, lats)    
     im1 = m.pcolor(x,y,CT,norm = norm,cmap = colores, alpha = 0.75)
-    from scipy.ndimage.filters import gaussian_filter
-    data3 = gaussian_filter(MSLP, sigma=.8)    
     im2 = m.contour(x,y,data3, np.arange(1012-40, 1012+44, 4), colors = '0.10', linewidths = 0.5)
     plt.clabel(im2, im2.levels, inline=True,fmt ='%.0f', fontsize=10)
     parallels = np.arange(-90.,120.,30.)
@@ -257,19 +320,10 @@ def plot_CT_MSLP_globe(CT,date, source, filename_MSLP):
     :param filename_MSLP: a string indicating the location and name of the Mean Sea Level Pressure dataset
 
     '''
-    MSLP = xr.open_dataset(filename_MSLP)
-    MSLP = MSLP[list(MSLP.variables)[-1]]/100
-    MSLP = MSLP.sel(time = date)[0]
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
     CT = CT.sel(time = date)[0]
-    #Checking longitude coordinates to be - 180 to 180
-    if source == 'REAN':
-        lon_name = 'longitude'
-    elif source == 'GCM':
-        lon_name = 'lon'
-    else:
+    if source not in ('REAN', 'GCM'):
         raise TypeError("Incorrect source, only 'REAN' or 'GCM' allowed")
-    print('Checking if longitude coordinates are -180 to 180')
-    MSLP = JK_functions.checking_lon_coords(MSLP, lon_name)
     print('Would you like to provide the central area where to plot? \n yes/no')
     answer = input()
     if answer == 'yes':
@@ -292,27 +346,9 @@ def plot_CT_MSLP_globe(CT,date, source, filename_MSLP):
         lon_west  = float(CT.lon[0].values)
         lon_east  = float(CT.lon[-1].values)
     
-    if source == 'REAN':
-        MSLP = MSLP.sel(latitude = slice(lat_north, lat_south), longitude = slice(lon_west, lon_east))
-        lat = MSLP.latitude
-        lon = MSLP.longitude
-        lon_list = list(lon)
-        lat_list = list(lat)
-    elif source == 'GCM':
-        MSLP = MSLP.sel(lat = slice(lat_south, lat_north), lon = slice(lon_west, lon_east))
-        lat = MSLP.lat
-        lon = MSLP.lon
-        lon_list = list(lon)
-        lat_list = list(lat)          
-    else:
-        raise TypeError("Source dataset not recognised!")
     CT = xr.where((CT.lat < 10) & (CT.lat > -10), np.nan, CT)       
-        
-    order_lats = lat_list[0] - lat_list[-1]
-    if order_lats < 0:
-        MSLP = MSLP.reindex(lat=list(reversed(MSLP.lat)))
-    else:
-        MSLP = MSLP 
+    #Smoothed MSLP of the date and area plotted
+    data3 = MSLP_contours(filename_MSLP, source, str(date), lat_north, lat_south, lon_west, lon_east)
 
     #Defining colours to plot CTs
     colores = ListedColormap(["#7C7C77", "#17344F", "#0255F4","#0F78ED", "#9E09EE", "#F6664C",
@@ -328,15 +364,13 @@ def plot_CT_MSLP_globe(CT,date, source, filename_MSLP):
 
     fig = plt.figure(figsize = (12,10))
     # call the basemap and use orthographic projection at viewing angle
-    m = Basemap(projection='ortho',lon_0=lon_central,lat_0=lat_central,resolution='l')
+    m = map_projection(projection='ortho',lon_0=lon_central,lat_0=lat_central,resolution='l')
     m.drawcoastlines()
     # m.etopo(scale=0.9, alpha=0.90)
     m.shadedrelief()
     # m.bluemarble(scale=0.5);
     x,y = m(lons, lats)
     im1 = m.pcolor(x,y,CT,norm = norm,cmap = colores, alpha = 0.75)
-    from scipy.ndimage.filters import gaussian_filter
-    data3 = gaussian_filter(MSLP, sigma=.8)    
     im2 = m.contour(x,y,data3, np.arange(1012-40, 1012+44, 4), colors = '0.10', linewidths = 0.5)
     plt.clabel(im2, im2.levels, inline=True,fmt ='%.0f', fontsize=10)
 
@@ -359,3 +393,131 @@ def plot_CT_MSLP_globe(CT,date, source, filename_MSLP):
     plt.ioff()
     return fig
 
+
+#Colours and labels of the 11 circulation types (-1 to 9)
+CT_COLOURS = ["#7C7C77", "#17344F", "#0255F4","#0F78ED", "#9E09EE", "#F6664C",
+              "#F24E64", "#D3C42D", "#2FC698", "#20E1D7", "#BD0000"]
+CT_LABELS = ['LF', 'A', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW', 'N', 'C']
+
+def building_frame(lat, lon, size = (12, 6), dpi = 100):
+    '''
+    This function builds the map of the animation once: projection, coastlines,
+    colour mapping and legend. Every frame then only updates the values of the map.
+
+    :param lat: latitude values of the circulation types
+    :param lon: longitude values of the circulation types
+    :param size: size of the figure in inches
+    :param dpi: resolution of the frames
+    :return: figure, map of the circulation types and title
+    '''
+    plt, Basemap, ListedColormap, colors, Line2D = plotting_modules()
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    colores = ListedColormap(CT_COLOURS)
+    bounds = np.arange(-1,11,1)
+    norm = colors.BoundaryNorm(boundaries=bounds, ncolors=12)
+    lons, lats = np.meshgrid(lon, lat)
+    #The figure has its own Agg canvas, the backend of pyplot (e.g. of a notebook) is not changed
+    fig = Figure(figsize = size, dpi = dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    m = Basemap(projection='cyl',llcrnrlat=min(lat[0], lat[-1]),urcrnrlat=max(lat[0], lat[-1]),\
+                    llcrnrlon=min(lon[0], lon[-1]),urcrnrlon=max(lon[0], lon[-1]),resolution='l', ax = ax)
+    m.drawcoastlines()
+    m.drawparallels(np.arange(-90.,120.,30.),labels=[True,False,False,True])
+    m.drawmeridians(np.arange(0.,390.,30.),labels=[True,False,False,True])
+    x,y = m(lons, lats)
+    mesh = m.pcolormesh(x, y, np.ma.masked_all(lons.shape), norm = norm, cmap = colores, alpha = 0.70, shading = 'auto')
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0 + box.height * 0.1,
+                     box.width, box.height * 0.9])
+    legend_elements = [Line2D([0], [0], marker='o', color=colour, markerfacecolor=None, linestyle='None', markersize=17, label=label)
+                       for colour, label in zip(CT_COLOURS, CT_LABELS)]
+    ax.legend(handles=legend_elements,loc = 'center', bbox_to_anchor=(1.1, 0.50),frameon = False, prop={'size': 14})
+    title = ax.set_title('', size = 16)
+    return fig, mesh, title
+
+def rendering_frames(task):
+    '''
+    This function renders a series of frames to PNG files with one figure,
+    only the values of the map and the title change between frames.
+    Used by animate_CT, one task per process.
+
+    :param task: tuple of (lat, lon, values, titles, filenames, size, dpi)
+    :return: list of the PNG filenames
+    '''
+    lat, lon, values, titles, filenames, size, dpi = task
+    fig, mesh, title = building_frame(lat, lon, size, dpi)
+    for frame, text, filename in zip(values, titles, filenames):
+        mesh.set_array(np.ma.masked_invalid(frame).ravel())
+        title.set_text(text)
+        fig.savefig(filename, dpi = dpi)
+    return filenames
+
+def animate_CT(CT, output, dates = None, fps = 4, processes = 1, size = (12, 6), dpi = 100):
+    '''
+    This function renders the 11 circulation types of many dates as PNG frames,
+    a GIF or an MP4 movie. The map (projection, coastlines, colours and legend)
+    is built once and only the values are updated for every frame.
+    The frames can be split across a pool of processes.
+    ¡! Works only with Basemap module (MP4 movies also need ffmpeg)
+
+    :param CT: xarray file of the eleven reduced circulation types
+    :param output: a string with the name of the output. A directory for PNG frames,
+                   or a filename ending in ".gif" or ".mp4"
+    :param dates: slice or list of dates to be plotted (default None plots all of them)
+    :param fps: frames per second of GIF and MP4 files
+    :param processes: number of processes rendering the frames
+    :param size: size of the figure in inches
+    :param dpi: resolution of the frames
+    :return: list of PNG frames, or the name of the GIF/MP4 file
+    '''
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    if dates is not None:
+        CT = CT.sel(time = dates)
+    CT = xr.where((CT.lat < 10) & (CT.lat > -10), np.nan, CT)
+    values = CT.transpose('time', 'lat', 'lon').values
+    titles = [str(t)[0:10] for t in CT.time.values]
+    lat = CT.lat.values
+    lon = CT.lon.values
+    movie = os.path.splitext(output)[1].lower()
+    if movie in ('.gif', '.mp4'):
+        frames_dir = tempfile.mkdtemp()
+    elif movie == '':
+        frames_dir = output
+        os.makedirs(frames_dir, exist_ok = True)
+    else:
+        raise TypeError("Incorrect output! Only a directory, '.gif' or '.mp4' files allowed")
+    filenames = [os.path.join(frames_dir, 'CT_%05d.png' % i) for i in range(len(titles))]
+    #Splitting the frames in consecutive chunks, one per process
+    chunks = np.array_split(np.arange(len(titles)), max(1, min(processes, len(titles))))
+    tasks = [(lat, lon, values[c], [titles[i] for i in c], [filenames[i] for i in c], size, dpi) for c in chunks]
+    print('Rendering ' + str(len(titles)) + ' frames ✎')
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            list(pool.map(rendering_frames, tasks))
+    else:
+        for task in tasks:
+            rendering_frames(task)
+    if movie == '':
+        return filenames
+    print('Writing ' + output + ' ✉︎')
+    if movie == '.gif':
+        from PIL import Image
+        def frames():
+            #Every frame is loaded and its file closed before the next one is opened
+            for filename in filenames[1:]:
+                with Image.open(filename) as image:
+                    yield image.copy()
+        with Image.open(filenames[0]) as first:
+            first.save(output, save_all = True, append_images = frames(), duration = int(1000 / fps), loop = 0)
+    else:
+        import subprocess
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps), '-i',
+                        os.path.join(frames_dir, 'CT_%05d.png'), '-pix_fmt', 'yuv420p',
+                        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', output], check = True)
+    for filename in filenames:
+        os.remove(filename)
+    os.rmdir(frames_dir)
+    return output
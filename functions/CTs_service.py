@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+
+Local query service over archives of circulation types (see CTs_archive).
+
+Server: python functions/CTs_service.py archive_dir [archive_dir ...] [--port 8765]
+Client: CT_points, CT_frequencies and archives_info query the service from Python.
+"""
+#Importing neccesary modules
+import os
+import sys
+import json
+import threading
+import urllib.request
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+import JK_functions
+import CTs_archive
+
+#Port of the service on localhost
+PORT = 8765
+#Size budget of the decoded chunks kept in memory (least recently used chunks are removed first)
+CHUNK_CACHE_SIZE = 512 * 1024**2
+#Number of frequency responses kept in memory
+RESPONSES = 256
+#Months of the seasons
+SEASONS = {'DJF': (12, 1, 2), 'MAM': (3, 4, 5), 'JJA': (6, 7, 8), 'SON': (9, 10, 11)}
+
+_archives = {}
+_chunks = OrderedDict()
+_chunks_size = [0]
+_responses = OrderedDict()
+_lock = threading.Lock()
+
+def opening_archives(directories):
+    """
+    This function opens the archives served, named after their directory.
+
+    :param directories: list of directories of archives (see CTs_archive.writing_archive)
+    """
+    for directory in directories:
+        meta = CTs_archive.opening_archive(directory)
+        if tuple(meta['dims'][-2:]) != ('lat', 'lon'):
+            raise ValueError('Only archives of regular latitude-longitude grids can be served: ' + directory)
+        #Days, months and coordinates used to find the positions of the points
+        time = meta['coords']['time'][1]
+        if np.issubdtype(time.dtype, np.datetime64):
+            meta['months'] = pd.DatetimeIndex(time).month.values
+        else:
+            meta['months'] = np.array([date.month for date in time])
+        meta['days'] = np.array([str(date)[:10] for date in JK_functions.normalise_time(time)])
+        meta['day_index'] = dict(zip(meta['days'], range(len(meta['days']))))
+        meta['lat'] = np.asarray(meta['coords']['lat'][1], dtype = float)
+        meta['lon'] = np.asarray(meta['coords']['lon'][1], dtype = float)
+        #Number of values of every type, month and chunk of the grid, summed by the frequency queries
+        if 'summary' not in meta:
+            print('Summarising ' + directory + ' ∑')
+            meta['summary'] = CTs_archive.summarising_archive(meta)
+        _archives[os.path.basename(os.path.normpath(directory))] = meta
+
+def cached_chunk(name, view, i, j, k):
+    """
+    This function returns a decoded chunk of an archive, from the cache of chunks
+    when it was already used.
+
+    :param name: name of the archive
+    :param view: description of the archive with the chunk layout used (see CTs_archive.choosing_layout)
+    :param i, j, k: position of the chunk along time, rows and columns of the grid
+    :return: numpy array of circulation types of the chunk
+    """
+    key = (name, view['file'], int(i), int(j), int(k))
+    with _lock:
+        if key in _chunks:
+            _chunks.move_to_end(key)
+            return(_chunks[key])
+    chunk = CTs_archive.reading_chunk(view, i, j, k)
+    chunk.setflags(write = False)
+    with _lock:
+        if key not in _chunks:
+            _chunks[key] = chunk
+            _chunks_size[0] += chunk.nbytes
+        while _chunks_size[0] > CHUNK_CACHE_SIZE and len(_chunks) > 1:
+            _, removed = _chunks.popitem(last = False)
+            _chunks_size[0] -= removed.nbytes
+    return(chunk)
+
+def time_positions(meta, dates):
+    """
+    This function finds the positions of dates (YYYY-MM-DD) in the time coordinate of an archive.
+
+    :param meta: description of the archive
+    :param dates: list of dates
+    :return: array of positions, -1 for dates not found
+    """
+    return(np.array([meta['day_index'].get(str(date)[:10], -1) for date in dates], dtype = int))
+
+def points(name, lat, lon, time):
+    """
+    This function answers the circulation types of a batch of points.
+
+    :param name: name of the archive
+    :param lat, lon: lists of latitudes and longitudes (or single values)
+    :param time: list of dates in YYYY-MM-DD format (or a single date)
+    :return: dictionary with the circulation types of every point (None when not available)
+    """
+    meta = _archives[name]
+    lat, lon, time = np.broadcast_arrays(np.atleast_1d(lat), np.atleast_1d(lon), np.atleast_1d(time))
+    #Binary search on the coordinates, the longitudes modulo 360º
+    y_pos = JK_functions.nearest_index(meta['lat'], lat)
+    x_pos = JK_functions.nearest_index(meta['lon'], lon, periodic = True)
+    t_pos = time_positions(meta, time)
+    found = t_pos >= 0
+    values = np.full((len(t_pos),) + tuple(meta['shape'][1:-2]), np.nan)
+    if found.any():
+        dims = meta['dims']
+        view = CTs_archive.choosing_layout(meta, {dims[0]: t_pos[found], dims[-2]: y_pos[found], dims[-1]: x_pos[found]})
+        values[found] = CTs_archive.reading_points(view, t_pos[found], y_pos[found], x_pos[found],
+                                                   reading = lambda i, j, k: cached_chunk(name, view, i, j, k))
+    values = np.where(np.isfinite(values), values, None).tolist()
+    return({'lat': meta['lat'][y_pos].tolist(), 'lon': meta['lon'][x_pos].tolist(),
+            'time': [str(date) for date in time], 'CT': values})
+
+def frequencies(name, lat = None, lon = None, season = None, time = None, types = 11):
+    """
+    This function answers the relative frequencies (%) of the circulation types over
+    a box of the grid, for a season and a time frame, summing the counts of the summary of the
+    archive for the whole months and chunks of the grid (see CTs_archive.summed_types) and decoding
+    only the chunks at the edges of the box and the time frame. The answers are kept in memory.
+
+    :param name: name of the archive
+    :param lat, lon: [first, last] latitude and [west, east] longitude of the box (default None, the whole grid).
+                     Boxes crossing the dateline have west > east, e.g. [170, -170]
+    :param season: "DJF", "MAM", "JJA" or "SON" (default None, all the year)
+    :param time: [first, last] dates in YYYY-MM-DD format (default None, all the time steps)
+    :param types: 11 (grouped types, see JK_functions.CT_GROUPS) or 27 (all the types)
+    :return: dictionary with the labels and frequencies of the types and the number of values
+    """
+    key = repr((name, lat, lon, season, time, types))
+    with _lock:
+        if key in _responses:
+            _responses.move_to_end(key)
+            return(_responses[key])
+    meta = _archives[name]
+    if season is not None and season not in SEASONS:
+        raise ValueError('Incorrect season, only ' + ', '.join(SEASONS) + ' allowed')
+    labels, lookup = JK_functions.type_classes(types)
+    selected = np.ones(meta['shape'][0], dtype = bool)
+    if season is not None:
+        selected &= np.isin(meta['months'], SEASONS[season])
+    if time is not None:
+        time = np.atleast_1d(time)
+        selected &= (meta['days'] >= str(time[0])[:10]) & (meta['days'] <= str(time[-1])[:10])
+    positions = {meta['dims'][0]: np.flatnonzero(selected)}
+    for dim, box, values in ((meta['dims'][-2], lat, meta['lat']), (meta['dims'][-1], lon, meta['lon'])):
+        if box is None or (dim == meta['dims'][-1] and box[-1] - box[0] >= 360):
+            positions[dim] = np.arange(len(values))
+        elif dim == meta['dims'][-1]:
+            #Longitudes east of the west edge, boxes crossing the dateline are split in two
+            #(and the box can use -180/180 or 0/360 longitudes)
+            positions[dim] = np.flatnonzero((values - box[0]) % 360 <= (box[-1] - box[0]) % 360)
+        else:
+            positions[dim] = np.flatnonzero((values >= min(box)) & (values <= max(box)))
+    for dim in meta['dims'][1:-2]:
+        positions[dim] = np.arange(meta['shape'][meta['dims'].index(dim)])
+    def counting(selection):
+        #Counted chunk by chunk, the selection is never decoded at once
+        view = CTs_archive.choosing_layout(meta, selection)
+        return(CTs_archive.counting_types(view, selection, lookup, len(labels),
+                                          reading = lambda i, j, k: cached_chunk(name, view, i, j, k)))
+    counts = CTs_archive.summed_types(meta, positions, lookup, len(labels), counting).tolist()
+    total = int(sum(counts))
+    answer = {'types': labels, 'frequency': [100 * count / total if total > 0 else None for count in counts],
+              'count': total}
+    with _lock:
+        _responses[key] = answer
+        while len(_responses) > RESPONSES:
+            _responses.popitem(last = False)
+    return(answer)
+
+def archives():
+    """
+    This function describes the archives served.
+
+    :return: dictionary with the dimensions, shape and time frame of every archive
+    """
+    return({name: {'dims': list(meta['dims']), 'shape': list(meta['shape']),
+                   'time': [meta['days'][0], meta['days'][-1]]}
+            for name, meta in _archives.items()})
+
+def parsing_query(query):
+    """
+    This function reads the parameters of a GET request, lists being separated by commas.
+
+    :param query: query of the URL
+    :return: dictionary of parameters
+    """
+    params = {}
+    for name, value in urllib.parse.parse_qsl(query):
+        values = value.split(',')
+        if name in ('lat', 'lon'):
+            values = [float(v) for v in values]
+        elif name == 'types':
+            values = [int(v) for v in values]
+        params[name] = values if len(values) > 1 else values[0]
+    return(params)
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    Requests of the service, as GET with the parameters in the URL or as POST with
+    the parameters in a JSON body (for large batches of points):
+    /archives, /points?archive=&lat=&lon=&time= and /frequencies?archive=&lat=&lon=&season=&time=&types=
+    Lists are given separated by commas in the URL.
+    '''
+    def answering(self, path, parsing):
+        try:
+            params = parsing()
+            if path == '/archives':
+                answer = archives()
+            elif path in ('/points', '/frequencies'):
+                params = dict(params)
+                name = params.pop('archive', None)
+                if name not in _archives:
+                    raise ValueError('Archive not found: ' + str(name))
+                answer = (points if path == '/points' else frequencies)(name, **params)
+            else:
+                self.send_error(404)
+                return
+            status, body = 200, json.dumps(answer)
+        except (ValueError, TypeError, KeyError) as error:
+            status, body = 400, json.dumps({'error': str(error)})
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        #Parsed while answering, so malformed parameters are answered with an error
+        self.answering(url.path, lambda: parsing_query(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.answering(urllib.parse.urlparse(self.path).path, lambda: json.loads(self.rfile.read(length) or b'{}'))
+
+    def log_message(self, format, *args):
+        pass #Requests are not printed
+
+class Server(ThreadingHTTPServer):
+    '''
+    HTTP server answering every request on its own thread, with a long queue
+    of connections waiting to be accepted (many concurrent clients).
+    '''
+    daemon_threads = True
+    request_queue_size = 128
+
+def serving(directories, port = PORT):
+    """
+    This function serves the archives on localhost until it is stopped (Ctrl+C).
+    Every request is answered on its own thread.
+
+    :param directories: list of directories of archives (see CTs_archive.writing_archive)
+    :param port: port of the service (default 8765)
+    """
+    opening_archives(directories)
+    server = Server(('127.0.0.1', port), Handler)
+    print('Serving ' + ', '.join(_archives) + ' on http://127.0.0.1:' + str(port) + ' ☁︎')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def querying(path, params = None, url = 'http://127.0.0.1:' + str(PORT)):
+    """
+    This function sends a query to the service (as a POST request with a JSON body).
+
+    :param path: "/archives", "/points" or "/frequencies"
+    :param params: dictionary of parameters
+    :param url: address of the service
+    :return: dictionary with the answer
+    """
+    request = urllib.request.Request(url + path, data = json.dumps(params or {}).encode(),
+                                     headers = {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return(json.loads(response.read()))
+    except urllib.error.HTTPError as error:
+        raise ValueError(json.loads(error.read()).get('error', str(error)))
+
+def archives_info(url = 'http://127.0.0.1:' + str(PORT)):
+    """
+    This function lists the archives of the service.
+
+    :param url: address of the service
+    :return: dictionary with the dimensions, shape and time frame of every archive
+    """
+    return(querying('/archives', url = url))
+
+def CT_points(archive, lat, lon, time, url = 'http://127.0.0.1:' + str(PORT)):
+    """
+    This function asks the circulation types of a batch of points (nearest gridpoints).
+
+    :param archive: name of the archive (its directory name)
+    :param lat, lon: latitudes and longitudes of the points (lists or single values)
+    :param time: dates of the points in YYYY-MM-DD format (list or single date)
+    :param url: address of the service
+    :return: dictionary with the gridpoints and circulation types of every point
+    """
+    def listing(values):
+        values = np.atleast_1d(values)
+        return([str(v) if values.dtype.kind in 'OUM' else float(v) for v in values])
+    return(querying('/points', {'archive': archive, 'lat': listing(lat), 'lon': listing(lon), 'time': listing(time)},
+                    url = url))
+
+def CT_frequencies(archive, lat = None, lon = None, season = None, time = None, types = 11,
+                   url = 'http://127.0.0.1:' + str(PORT)):
+    """
+    This function asks the relative frequencies (%) of the circulation types over a box.
+
+    :param archive: name of the archive (its directory name)
+    :param lat, lon: [first, last] latitude and [west, east] longitude of the box (default None, the whole grid).
+                     Boxes crossing the dateline have west > east, e.g. [170, -170]
+    :param season: "DJF", "MAM", "JJA" or "SON" (default None, all the year)
+    :param time: [first, last] dates in YYYY-MM-DD format (default None, all the time steps)
+    :param types: 11 (grouped types) or 27 (all the types)
+    :param url: address of the service
+    :return: dictionary with the labels and frequencies of the types and the number of values
+    """
+    return(querying('/frequencies', {'archive': archive, 'lat': lat, 'lon': lon, 'season': season,
+                                     'time': time, 'types': types}, url = url))
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    port = PORT
+    if '--port' in arguments:
+        position = arguments.index('--port')
+        port = int(arguments[position + 1])
+        del(arguments[position:position + 2])
+    serving(arguments, port)
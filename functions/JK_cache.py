@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import os
+import shutil
+import pickle
+import hashlib
+import numpy as np
+import xarray as xr
+
+#Version of the classification, changing it invalidates all the stored results
+CACHE_VERSION = 1
+#Size budget of the cache directory in bytes (least recently used results are removed first)
+CACHE_SIZE = 2 * 1024**3
+
+def fingerprint(files, content = False):
+    """
+    This function identifies the input files by their path, size and
+    modification time, or by a hash of their content.
+
+    :param files: list of filenames
+    :param content: True to hash the content of the files (slower, but robust to copies and touched files)
+    :return: list of tuples identifying every file
+    """
+    prints = []
+    for file in files:
+        if content:
+            digest = hashlib.sha1()
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    digest.update(chunk)
+            prints.append(digest.hexdigest())
+        else:
+            info = os.stat(file)
+            prints.append((os.path.abspath(file), info.st_size, info.st_mtime_ns))
+    return(prints)
+
+def cache_key(files, content = False, **options):
+    """
+    This function computes the key of a classification run from the input files
+    and the options that change the result (time frame, globe, engine, ...).
+
+    :param files: list of filenames
+    :param content: True to identify the files by a hash of their content
+    :param options: options of the classification
+    :return: str. key of the run
+    """
+    run = (CACHE_VERSION, fingerprint(files, content), sorted((k, repr(v)) for k, v in options.items()))
+    return(hashlib.sha1(repr(run).encode()).hexdigest())
+
+def loading_result(cache_dir, key):
+    """
+    This function returns a stored result, with the circulation types memory-mapped
+    (only the values used are read from disk).
+
+    :param cache_dir: str. directory of the cache
+    :param key: key of the run (see cache_key)
+    :return: circulation types in xarray format, or None if the run is not stored
+    """
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return(None)
+    os.utime(entry) #Most recently used
+    with open(os.path.join(entry, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    values = np.load(os.path.join(entry, 'CT.npy'), mmap_mode = 'r')
+    output = xr.DataArray(data = values, coords = meta['coords'], dims = meta['dims'])
+    output.name = meta['name']
+    output.attrs = meta['attrs']
+    return(output)
+
+def storing_result(cache_dir, key, output, cache_size = None):
+    """
+    This function stores the circulation types of a run and removes the least
+    recently used results when the cache exceeds its size budget.
+
+    :param cache_dir: str. directory of the cache
+    :param key: key of the run (see cache_key)
+    :param output: circulation types in xarray format
+    :param cache_size: size budget in bytes (default CACHE_SIZE)
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+    entry = os.path.join(cache_dir, key)
+    temporary = entry + '.tmp' + str(os.getpid())
+    os.makedirs(temporary, exist_ok = True)
+    np.save(os.path.join(temporary, 'CT.npy'), np.ascontiguousarray(output.values))
+    meta = {'name': output.name, 'dims': output.dims, 'attrs': output.attrs,
+            'coords': {name: (output[name].dims, output[name].values) for name in output.coords}}
+    with open(os.path.join(temporary, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    #Moving the complete result in place, so a stopped run never leaves a broken entry
+    if os.path.isdir(entry):
+        shutil.rmtree(temporary)
+    else:
+        os.replace(temporary, entry)
+    evicting(cache_dir, CACHE_SIZE if cache_size is None else cache_size)
+
+def evicting(cache_dir, cache_size):
+    """
+    This function removes the least recently used results until the
+    cache fits in its size budget.
+
+    :param cache_dir: str. directory of the cache
+    :param cache_size: size budget in bytes
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if os.path.isdir(entry) and '.tmp' not in name:
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= cache_size:
+            break
+        shutil.rmtree(entry)
+        total -= size
+        print('Removed from the cache: ' + os.path.basename(entry))
@@ -6,346 +6,509 @@
 @Author: Pedro Herrera-Lormendez
 """
 
+import functools
 import numpy as np
-import pandas as pd
 import xarray as xr
 #Importing the directory where the neccesary functions are located
 import JK_functions #Functions that help compute the CTs
+import JK_io #Reading the MSLP data
+import JK_cache #Storing the results on disk
+import JK_planner #Memory budget of the classification
+
+def JK_classification(filename, source, daily = None, engine = 'points', interpolation = 'nearest', block_size = 31,
+                      prefetch = 2, diagnostics = None, output_file = None, time_init = None, time_end = None,
+                      globe = None, cache = None, variants = None, geometry = None, tiles = None, workers = 1,
+                      memory = None, dry_run = False, ensemble = None, variable = None, scale = None, backend = None,
+                      field = 'mslp', levels = None, cache_content = False):
 
-def JK_classification(filename, source):
-    
     '''
-    
+
     @authors: Herrera-Lormendez, Pedro & John, Amal
     TU Bergakademie Freiberg and CNRS/Météo-France
-    
+
     This computes the gridded Jenkinson-Collison circulation types
     derived from the original Lamb Weather Types Classification
-    
+
     Computation of circulation types employs Mean Sea Level Pressure data
-    
-    :param filename: str. name and directory of the MSLP file
-    :param source: str. Use "REAN" for ERA5 and ERA20C reanalysis and "GCM" when using GCMs
-    :return: grided circulation types data as an xarray file
-    '''
-    if type(filename) == str:
-        print('Reading filename: ', filename)
-        #Reading the file
-        DS = xr.open_dataset(filename)
-        mslp = DS[list(DS.variables)[-1]]/100 #Reads the MSLP variable and converts to hPa
-        if source == 'REAN': #ERA5 or ERA20C reanalyses
-            DS.close()
-            lon_name = 'longitude'
-            lat_name = 'latitude'
-            print('Do you wish to provide the time frame for the computation? (yes/no)')
-            answer_time = input()
-            if answer_time == 'yes':
-                print('Time 0:',str(mslp.time[0].values))
-                print('Time n-1:', str(mslp.time[-1].values))
-                print('Provide starting time in YYYY-MM-DD format:')
-                time_init = input()
-                print('Provide ending time in YYYY-MM-DD format:')
-                time_end = input()
-            elif answer_time == 'no':
-                time_init = str(mslp.time[0].values)
-                time_end = str(mslp.time[-1].values)
-                print('Using default time period from ' +  str(time_init) + ' to ' +  str(time_end))                
-                
-            else:
-                raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")
-            
-            #Cropping MSLP data in the time coordinate. 
-            mslp =mslp.sel(time = slice(time_init,time_end))
-            #Checking longitude coordinates to be - 180 to 180, if not (0 to 360) then fixed
-            print('Checking if longitude coordinates are -180 to 180')
-            mslp = JK_functions.checking_lon_coords(mslp, lon_name)
+    (or geopotential height at one or several levels, see field)
 
-            #Computing factors based on grid size and spacing
-            dif_lon = float((mslp.longitude[1]-mslp.longitude[0])) #Longitude grid spacing
-            dif_lat = float((mslp.latitude[1]-mslp.latitude[0])) #Latitude grid spacing
-            factor_lat = float(np.abs(1/dif_lat))
-            factor_lon = float(np.abs(1/dif_lon))
-            f_lat1 = int(10*factor_lat)
-            f_lat2 = int(-10*factor_lat)
-            f_lon1 = int(15*factor_lon)
-            f_lon2 = int(-15*factor_lon)
-            print('does your data covers the whole Globe? (yes/no)')
-            answer_globe = input()  
-            if answer_globe == 'yes':
-                psl_area=mslp[:,f_lat1:f_lat2, :] 
-            elif answer_globe == 'no':
-                psl_area=mslp[:,f_lat1:f_lat2, f_lon1:f_lon2]
-            else:
-                raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")
-            #Extracting values of longitude, latitude and time coordinates
-            lat = psl_area.latitude
-            lon = psl_area.longitude
-            time = psl_area.time.values
-            time_len = len(time)
-            lon_list = list(lon)
-            lat_list = list(lat)
-            len_lon = len(lon_list)
-            len_lat = len(lat_list)
-            
-            ds = []
-            #Computing latitude dependent constants
-            print('Calculating latitude dependant constants ☀︎')
-            lat_central = lat
-            phi = lat_central            
-            constants = JK_functions.constants(phi, lon)
-            sc = constants[0]
-            zwa = constants[1]
-            zwb = constants[2]
-            zsc = constants[3]
-            print('Checking time formats ☽')
-            #Checking the time coordinate values, since some models use different calendars
-            if type(time[0]) == np.datetime64:
-                time_pd = pd.to_datetime(time)
-                dates = [pd.to_datetime(str(time_pd[t].year) + '-' + str(time_pd[t].month) + '-' + str(time_pd[t].day), 
-                                            format = '%Y%m%d',errors = 'ignore') for t in range(len(time))]
-            else:
-                dates = [pd.to_datetime(str(time[t].year) + '-' + str(time[t].month) + '-' + str(time[t].day), 
-                                    format = '%Y%m%d',errors = 'ignore') for t in range(len(time))]
+    Regular and non-uniform (e.g. Gaussian) latitude-longitude grids are supported,
+    as well as curvilinear grids with 2-D latitude and longitude values (e.g. rotated-pole
+    EURO-CORDEX grids), which are classified on their native grid.
 
-            #Extracting the 16-gridded values of MSLP
-            print('Extracting 16 gridpoints ●')
-            if answer_globe == 'yes':
-                gridpoints = JK_functions.extracting_gridpoints_rean_globe(mslp, lat, lon)
-                p1  = gridpoints[0]
-                p2  = gridpoints[1]
-                p3  = gridpoints[2]
-                p4  = gridpoints[3]
-                p5  = gridpoints[4]
-                p6  = gridpoints[5]
-                p7  = gridpoints[6]
-                p8  = gridpoints[7]
-                p9  = gridpoints[8]
-                p10 = gridpoints[9]
-                p11 = gridpoints[10]
-                p12 = gridpoints[11]
-                p13 = gridpoints[12]
-                p14 = gridpoints[13]
-                p15 = gridpoints[14]
-                p16 = gridpoints[15]
-                del(gridpoints)
-            elif answer_globe == 'no':
-                gridpoints = JK_functions.extracting_gridpoints_rean_area(mslp, lat, lon)
-                p1  = gridpoints[0]
-                p2  = gridpoints[1]
-                p3  = gridpoints[2]
-                p4  = gridpoints[3]
-                p5  = gridpoints[4]
-                p6  = gridpoints[5]
-                p7  = gridpoints[6]
-                p8  = gridpoints[7]
-                p9  = gridpoints[8]
-                p10 = gridpoints[9]
-                p11 = gridpoints[10]
-                p12 = gridpoints[11]
-                p13 = gridpoints[12]
-                p14 = gridpoints[13]
-                p15 = gridpoints[14]
-                p16 = gridpoints[15]
-                del(gridpoints)
-            else:
-                raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")                
+    :param filename: str. name and directory of the MSLP file. Data split in several files (e.g. yearly CMIP6 files)
+                     is classified as one record when giving a list of filenames or a glob pattern (e.g. "psl_day_*.nc")
+    :param source: str. Use "REAN" for ERA5 and ERA20C reanalysis, "GCM" when using GCMs
+                   and "RCM" for regional climate models (e.g. EURO-CORDEX)
+    :param daily: None (default) classifies every time step of the file. Sub-daily data can be reduced
+                  to daily values while reading with "mean" (daily means) or an integer hour (e.g. 12 for 12 UTC)
+    :param engine: "points" (default) computes the flow terms from the 16 extracted gridpoints, "sparse" computes
+                   W, S, ZW and ZS at once as a precompiled sparse matrix product with the MSLP fields
+    :param interpolation: "nearest" (default) snaps the 16 gridpoints to the nearest grid values,
+                          "bilinear" interpolates them from the surrounding grid values (regular grids only)
+    :param block_size: number of time steps classified at once (default 31)
+    :param prefetch: number of blocks read in advance on a background thread while classifying (default 2),
+                     0 reads every block when needed
+    :param diagnostics: list of flow terms stored along with the circulation types, any of "W" (westerly flow),
+                        "S" (southerly flow), "F" (resultant flow), "ZW", "ZS" and "Z" (shear vorticities).
+                        They are stored as compressed int16 values (0.02 resolution)
+    :param output_file: str. netCDF file where the results are written block by block while classifying,
+                        so the whole record is never held in memory (default None keeps the results in memory)
+    :param time_init, time_end: str. time frame of the computation in YYYY-MM-DD format (default None asks for it)
+    :param globe: True if the data covers the whole globe, False otherwise (default None asks for it)
+    :param cache: str. directory of the on-disk cache of results (default None does not use it). A rerun with
+                  the same files and options returns the stored circulation types memory-mapped (see JK_cache)
+    :param variants: list of threshold configurations (see JK_functions.VARIANT_DEFAULT), e.g.
+                     [{}, {'low_flow': 4, 'low_vorticity': 4}, {'hybrid': 1.5}]. The circulation types of every
+                     configuration are computed from the same flow terms and stored along a "variant" dimension
+    :param geometry: (latitude step, longitude step) of the stencil in degrees, default None uses (5, 10), the
+                     original ±10º latitude and ±5º/±15º longitude offsets. A list of geometries, e.g.
+                     [(5, 10), (2.5, 5), (5, 5)], evaluates all of them on every block read and stores them along
+                     a "geometry" dimension (on the central points shared by all the geometries)
+    :param tiles: (latitudes, longitudes) number of central points per tile, e.g. (200, 400). Default None classifies
+                  the whole grid at once. Every tile reads its own halo of gridpoints (wrapping across the dateline
+                  on global grids), so the memory needed depends on the tile size and not on the grid size.
+                  Regular grids only
+    :param workers: number of tiles classified in parallel (threads, default 1)
+    :param memory: memory budget in bytes or as a string (e.g. "8GB"). The block size (and the tiles when one time
+                   step of the grid does not fit) are chosen from the grid, the on-disk chunks of the input and the
+                   engine so the classification stays within the budget (block_size and tiles are then ignored)
+    :param dry_run: True prints the estimated peak memory, bytes to read and runtime without reading
+                    any MSLP values, and returns the estimates (default budget: the physical memory)
+    :param ensemble: True (or 27) computes, along with the circulation types of the ensemble members ("number"
+                     dimension), the fraction of members of every type ("CT_probability", "type" dimension after
+                     time), the most frequent type ("CT_mode"), the fraction of members of the most frequent type
+                     ("CT_agreement") and the entropy of the types ("CT_entropy") at every gridpoint and time step.
+                     11 uses the 11 grouped types (coded as CTs_functions.eleven_CTs). Default None
+    :param variable: str. name of the MSLP variable in the files (default None: "psl" for RCM files,
+                     otherwise the only gridded variable of the files, see JK_io.selecting_variable)
+    :param scale: the values are divided by scale (default None: 100 for MSLP in Pa, giving hPa, see field)
+    :param backend: format of the files, "netcdf", "zarr" (Zarr stores) or "array" (.npy files or binary
+                    memory maps with a JSON sidecar of coordinates, see JK_io.opening_array). Default None
+                    guesses it from the names
+    :param field: field classified, "mslp" (default), "geopotential" (m2 s-2, e.g. ERA5 "z") or "height"
+                  (geopotential height in m, e.g. CMIP6 "zg"). Geopotential heights are classified in
+                  decametres unless another scale is given
+    :param levels: list of the levels classified (e.g. [850, 500]) when the files have a vertical level dimension,
+                   default None classifies all of them. All the levels are classified at once with the same stencil
+                   plan and kept along the level dimension of the results
+    :param cache_content: True identifies the files of the cache by a hash of their content instead of their path,
+                          size and modification time (slower, but copied or touched files are found in the cache)
+    :return: grided circulation types data as an xarray file (an xarray dataset with the flow terms
+             when diagnostics or ensemble statistics are requested), or a dictionary with the estimates when dry_run is True
+    '''
+    files = JK_io.input_files(filename)
+    if source not in ('REAN', 'GCM', 'RCM'):
+        raise TypeError("Incorrect source, only 'REAN', 'GCM' or 'RCM' allowed")
+    if engine not in ('points', 'sparse'):
+        raise TypeError("Incorrect engine, only 'points' or 'sparse' allowed")
+    diagnostics = list(diagnostics or [])
+    for name in diagnostics:
+        if name not in JK_io.DIAGNOSTICS:
+            raise TypeError("Incorrect diagnostic '" + str(name) + "', only " + ', '.join(JK_io.DIAGNOSTICS) + " allowed")
+    JK_functions.checking_daily(daily)
+    if field not in JK_io.FIELDS:
+        raise TypeError("Incorrect field, only 'mslp', 'geopotential' or 'height' allowed")
+    if scale is None:
+        scale = JK_io.FIELDS[field][1]
+    if ensemble is True:
+        ensemble = 27
+    if ensemble not in (None, 11, 27):
+        raise TypeError("Incorrect ensemble, only True, 27 or 11 allowed")
+    if variants is not None:
+        variants = [JK_functions.checking_variant(variant) for variant in variants]
+    #Several geometries (sweep) are given as a list of (latitude step, longitude step) tuples
+    sweep = type(geometry) == list
+    geometries = geometry if sweep else [JK_functions.GEOMETRY_DEFAULT if geometry is None else geometry]
+    if len(geometries) == 0 or not all(np.shape(step) == (2,) for step in geometries):
+        raise TypeError("Incorrect geometry, only (latitude step, longitude step) tuples or lists of them allowed")
+    geometries = [tuple(float(step) for step in steps) for steps in geometries]
+    print('Reading filename: ', filename)
+    variable_name = variable
+    def variable(DS):
+        if variable_name is None and source == 'RCM' and 'psl' in DS.data_vars:
+            return DS['psl'] #CORDEX files also store the grid mapping and bounds variables
+        return JK_io.selecting_variable(DS, variable_name) #Reads the MSLP variable (converted to hPa below)
+    #Reading the files, several files are read one after the other as one record
+    segments, DS_attrs = JK_io.opening_segments(files, variable, backend)
+    if len(segments) > 1:
+        print(str(len(segments)) + ' files read as one record')
+    attrs = {'description':'Gridded Lamb circulation types derived from MSLP data based on the automated Jenkinson-Collison classification'}
+    if field != 'mslp':
+        attrs['description'] = attrs['description'].replace('MSLP', JK_io.FIELDS[field][0])
+        attrs['field'] = field
+    if source == 'GCM': #CMIP6 datasets
+        attrs['institution_id'] = DS_attrs['institution_id']
+        attrs['source_id'] = DS_attrs['source_id']
+        attrs['experiment_id'] = DS_attrs['experiment_id']
+    elif source == 'RCM': #CORDEX datasets
+        for name in ('institute_id', 'model_id', 'driving_model_id', 'experiment_id'):
+            if name in DS_attrs:
+                attrs[name] = DS_attrs[name]
+    if time_init is not None and time_end is not None:
+        print('Using time period from ' +  str(time_init) + ' to ' +  str(time_end))
+        answer_time = None
+    else:
+        print('Do you wish to provide the time frame for the computation? (yes/no)')
+        answer_time = input()
+    if answer_time is None:
+        pass
+    elif answer_time == 'yes':
+        print('Time 0:',str(segments[0].time[0].values))
+        print('Time n-1:', str(segments[-1].time[-1].values))
+        print('Provide starting time in YYYY-MM-DD format:')
+        time_init = input()
+        print('Provide ending time in YYYY-MM-DD format:')
+        time_end = input()
+    elif answer_time == 'no':
+        time_init = str(segments[0].time[0].values)
+        time_end = str(segments[-1].time[-1].values)
+        print('Using default time period from ' +  str(time_init) + ' to ' +  str(time_end))
+
+    else:
+        raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")
 
-            print('Computing flow terms ☈')
-            #Computing equations of flows and vorticity            
-            flows = JK_functions.flows_rean(p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, sc, zwa, zsc, zwb, lat, lon, time, mslp)
-            W  = flows[0] #Westerly flow
-            S  = flows[1] #Southerly flow
-            F  = flows[2] #Resultant flow
-            ZW = flows[3] #Westerly shear vorticity
-            ZS = flows[4] #Southerly shear vorticity
-            Z  = flows[5] #Total shear vorticity   
+    #Latitude and longitude names, "latitude" and "longitude" or "lat" and "lon"
+    lat_name = 'latitude' if 'latitude' in segments[0].coords else 'lat'
+    lon_name = 'longitude' if 'longitude' in segments[0].coords else 'lon'
+    if segments[0][lat_name].ndim == 1 and globe is None:
+        print('does your data covers the whole Globe? (yes/no)')
+        answer_globe = input()
+        if answer_globe not in ('yes', 'no'):
+            raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")
+        globe = answer_globe == 'yes'
 
-        else: #CMIP6 datasets
-            institution_id = DS.institution_id
-            experiment_id = DS.experiment_id
-            source_id = DS.source_id
-            DS.close()
-            lon_name = 'lon'
-            lat_name = 'lat'            
-            print('Do you wish to provide the time frame for the computation? (yes/no)')
-            answer_time = input()
-            if answer_time == 'yes':
-                print('Time 0:',str(mslp.time[0].values))
-                print('Time n-1:', str(mslp.time[-1].values))                
-                print('Provide starting time in YYYY-MM-DD format:')
-                time_init = input()
-                print('Provide ending time in YYYY-MM-DD format:')
-                time_end = input()
-            elif answer_time == 'no':
-                time_init = str(mslp.time[0].values)
-                time_end = str(mslp.time[-1].values)
-                print('Using default time period from ' +  str(time_init) + ' to ' +  str(time_end))                
-                
-            else:
-                raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")
-                
-            mslp = mslp.sel(time = slice(time_init,time_end))
-            #Checking longitude coordinates to be - 180 to 180
-            print('Checking if longitude coordinates are -180 to 180')
-            mslp = JK_functions.checking_lon_coords(mslp, lon_name)
+    if cache is not None and (len(diagnostics) > 0 or output_file is not None or ensemble is not None):
+        print('The cache only stores the circulation types, it is not used with diagnostics, ensemble or output_file')
+        cache = None
+    if cache is not None:
+        key = JK_cache.cache_key(files, content = cache_content, source = source, time_init = time_init, time_end = time_end, globe = globe,
+                                 daily = daily, engine = engine, interpolation = interpolation,
+                                 variants = variants, geometry = geometries if sweep else geometries[0],
+                                 variable = variable_name, scale = scale, field = field, levels = levels)
+        output = JK_cache.loading_result(cache, key)
+        if output is not None:
+            print('Circulation types found in the cache ✓')
+            return output
 
-            #Computing factors based on grid size
-            dif_lon = float((mslp.lon[1]-mslp.lon[0]))
-            dif_lat = float((mslp.lat[1]-mslp.lat[0]))
+    #Cropping MSLP data in the time coordinate.
+    segments = [segment.sel(time = slice(time_init,time_end)) for segment in segments]
+    segments = [segment for segment in segments if len(segment.time) > 0]
+    if len(segments) == 0:
+        raise ValueError('No time steps found between ' + str(time_init) + ' and ' + str(time_end))
+    #Vertical levels, classified together as an extra dimension (like the ensemble members)
+    level_dims = [dim for dim in segments[0].dims[1:-2] if dim in JK_io.LEVEL_DIMS]
+    if levels is not None:
+        if len(level_dims) == 0:
+            raise ValueError('No level dimension found in the files (' + ', '.join(JK_io.LEVEL_DIMS) + ')')
+        try:
+            segments = [segment.sel({level_dims[0]: list(np.atleast_1d(levels))}) for segment in segments]
+        except KeyError:
+            raise ValueError('Levels ' + str(levels) + ' not found, the files store ' +
+                             ', '.join(str(level) for level in segments[0][level_dims[0]].values))
+    if len(level_dims) > 0:
+        print(str(len(segments[0][level_dims[0]])) + ' levels classified at once ☰')
+    layout = JK_planner.input_layout(segments[0])
+    read_steps = sum(len(segment.time) for segment in segments)
+    n_steps = read_steps
+    days = None
+    if daily is not None:
+        #Sub-daily data is reduced to days while reading the blocks (the same plan for a dry run),
+        #the days split across two files included
+        days = JK_functions.daily_steps(np.concatenate([segment.time.values for segment in segments]), daily)
+    if days is not None:
+        print('Aggregating sub-daily data to daily values while reading ☼')
+        read_steps = len(days['steps'])
+        n_steps = len(days['time'])
+    mslp = segments[0] #The grid is read from the first segment
 
-            factor_lat = float(np.abs(1/dif_lat))
-            factor_lon = float(np.abs(1/dif_lon))
-            f_lat1 = int(10*factor_lat)
-            f_lat2 = int(-10*factor_lat)
-            
-            f_lon1 = int(15*factor_lon)
-            f_lon2 = int(-15*factor_lon)
-            print('does your data covers the whole Globe? (yes/no)')
-            answer_globe = input()
-            if answer_globe == 'yes':
-                psl_area=mslp[:,f_lat1:f_lat2, :] 
-            elif answer_globe == 'no':
-                psl_area=mslp[:,f_lat1:f_lat2, f_lon1:f_lon2]
-            else:
-                raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")                
-                
-            lat = psl_area.lat
-            lon = psl_area.lon
-            time = psl_area.time.values
-            time_len = len(time)
-            lon_list = list(lon)
-            lat_list = list(lat)
-            len_lon = len(lon_list)
-            len_lat = len(lat_list)
-            ds = []
+    if mslp[lat_name].ndim == 2: #Curvilinear grids (e.g. rotated pole rlat/rlon)
+        print('Curvilinear grid, the classification is computed on the native grid')
+        if interpolation != 'nearest':
+            raise ValueError("Only 'nearest' interpolation is available for curvilinear grids")
+        if tiles is not None:
+            raise ValueError("Tiles are only available for regular latitude-longitude grids")
+        grid_dims = list(mslp[lat_name].dims)
+        segments = [segment.transpose(..., *grid_dims) for segment in segments]
+        mslp = segments[0]
+        print('Planning the 16 gridpoints of every central point ●')
+        plans = [JK_functions.stencil_plan_curvilinear(mslp[lat_name].values, mslp[lon_name].values, steps)
+                 for steps in geometries]
+        plan = plans[0]
+        lat = mslp[lat_name].values
+        lon = mslp[lon_name].values
+        grid_coords = {'lat': (grid_dims, lat), 'lon': (grid_dims, lon)}
+        for dim in grid_dims:
+            if dim in mslp.coords:
+                grid_coords[dim] = mslp[dim].values
+    else:
+        #Checking longitude coordinates to be - 180 to 180, if not (0 to 360) then fixed
+        print('Checking if longitude coordinates are -180 to 180')
+        segments = [JK_functions.checking_lon_coords(segment, lon_name).transpose(..., lat_name, lon_name)
+                    for segment in segments]
+        mslp = segments[0]
+        #Planning the 16 gridpoints from the actual coordinate values (any grid spacing)
+        plans = [JK_functions.stencil_plan(mslp[lat_name].values, mslp[lon_name].values, bool(globe),
+                                           interpolation = interpolation, geometry = steps) for steps in geometries]
+        #Several geometries are computed on the central points shared by all of them
+        lat_index = plans[0]['lat_index']
+        lon_index = plans[0]['lon_index']
+        for other in plans[1:]:
+            lat_index = np.intersect1d(lat_index, other['lat_index'])
+            lon_index = np.intersect1d(lon_index, other['lon_index'])
+        plans = [other if other['shape'] == (len(lat_index), len(lon_index))
+                 else JK_functions.restricting_plan(other, lat_index, lon_index) for other in plans]
+        plan = plans[0]
+        #Extracting values of longitude and latitude of the central points
+        lat = mslp[lat_name][plan['lat_index']]
+        lon = mslp[lon_name][plan['lon_index']]
+        grid_dims = ['lat', 'lon']
+        grid_coords = {'lat': lat.values, 'lon': lon.values}
+    #The stencil plan is computed once, all the files must share the same grid
+    for segment in segments[1:]:
+        if not (np.array_equal(segment[lat_name].values, mslp[lat_name].values) and
+                np.array_equal(segment[lon_name].values, mslp[lon_name].values)):
+            raise ValueError('All the files must have the same latitude-longitude grid')
+    time = np.concatenate([segment.time.values for segment in segments]) if days is None else days['time']
 
-            print('Calculating constants ☀︎') 
+    #Computing latitude dependent constants
+    print('Calculating latitude dependant constants ☀︎')
+    phi = lat
+    setups = []
+    for steps, other in zip(geometries, plans):
+        sc, zwa, zwb, zsc = JK_functions.constants(phi, lon, steps)
+        wc = JK_functions.geometry_factors(steps)[0] if steps != JK_functions.GEOMETRY_DEFAULT else 1
+        setups.append({'plan': other, 'sc': np.asarray(sc), 'zwa': np.asarray(zwa), 'zwb': np.asarray(zwb),
+                       'zsc': np.asarray(zsc), 'wc': wc})
+    print('Checking time formats ☽')
+    #Checking the time coordinate values, since some models use different calendars
+    dates = JK_functions.normalise_time(time)
+    if (dates[1:] != dates[:-1]).all():
+        time = dates #Daily data is stored with a consistent daily time coordinate
 
-            lat_central = lat
-            phi = lat_central            
-            constants = JK_functions.constants(phi, lon)
-            sc = constants[0]
-            zwa = constants[1]
-            zwb = constants[2]
-            zsc = constants[3]            
+    #Extra dimensions (e.g. "number" of the ensemble members) are kept
+    dims = ['time'] + list(mslp.dims[1:-2]) + grid_dims
+    coords = {'time': time}
+    for dim in mslp.dims[1:-2]:
+        coords[dim] = mslp[dim].values
+    coords.update(grid_coords)
+    if ensemble is not None:
+        if 'number' not in dims:
+            raise ValueError('The ensemble statistics need the "number" dimension of the ensemble members')
+        labels = JK_functions.type_classes(ensemble)[0]
+        #Statistics per central point and time step (every geometry and variant)
+        n_ensemble = ((len(labels) + 3) * int(np.prod(mslp.shape[1:-2])) // len(mslp['number']) *
+                      len(geometries) * (1 if variants is None else len(variants)))
+    lat_c = np.asarray(lat)
+    if lat_c.ndim == 1:
+        lat_c = lat_c[:, None]
+    for setup in setups:
+        setup['lat_c'] = lat_c
+    if memory is not None or dry_run:
+        print('Planning the blocks within the memory budget ⚖︎')
+        grid = {'read_steps': read_steps, 'steps': n_steps, 'extra': int(np.prod(mslp.shape[1:-2])),
+                'grid_shape': plan['grid_shape'], 'central': int(np.prod(plan['shape']))}
+        run = JK_planner.planning(JK_planner.available_memory() if memory is None else memory, workers, grid, layout,
+                                  engine, interpolation, variants, len(geometries), len(diagnostics),
+                                  output_file is None, prefetch, plans if plan['kind'] == 'rectilinear' else None,
+                                  bool(globe), 0 if ensemble is None else n_ensemble)
+        JK_planner.printing_plan(grid, run)
+        if dry_run:
+            print('Dry run, no MSLP values were read ✎')
+            return run
+        block_size = run['block_size']
+        tiles = run['tiles']
+    if tiles is not None:
+        #Every tile has its own stencil plans and constants
+        print('Splitting the grid into tiles ▦')
+        tiles = JK_functions.tiling([setup['plan'] for setup in setups], tiles, bool(globe))
+        for tile in tiles:
+            tile['setups'] = []
+            for setup, tile_plan in zip(setups, tile['plans']):
+                tile_setup = {name: setup[name][tile['lat_pos'], tile['lon_pos']] for name in ('sc', 'zwa', 'zwb', 'zsc')}
+                tile_setup.update(plan = tile_plan, wc = setup['wc'], lat_c = lat_c[tile['lat_pos']])
+                tile['setups'].append(tile_setup)
+        print(str(len(tiles)) + ' tiles')
+    if engine == 'sparse':
+        print('Compiling the flow terms as a sparse operator ☈')
+        for setup in setups if tiles is None else [setup for tile in tiles for setup in tile['setups']]:
+            setup['operator'] = JK_functions.flow_operator(setup['plan'])
 
+    flip_lat = grid_dims == ['lat', 'lon'] and grid_coords['lat'][0] < grid_coords['lat'][-1]
+    shape = mslp.shape[1:-2] + tuple(plan['shape'])
+    #The circulation types of several threshold configurations have a "variant" dimension after time
+    #and the geometries of a sweep have a "geometry" dimension after time (the flow terms as well)
+    if sweep:
+        dims = ['time', 'geometry'] + dims[1:]
+        coords['geometry'] = np.array(['%gx%g' % steps for steps in geometries])
+        shape = (len(geometries),) + shape
+    CT_dims = dims
+    CT_coords = coords
+    CT_shape = shape
+    if variants is not None:
+        CT_dims = dims[:1 + sweep] + ['variant'] + dims[1 + sweep:]
+        CT_coords = dict(coords)
+        CT_coords['variant'] = np.array([JK_functions.variant_label(variant) for variant in variants])
+        CT_shape = shape[:sweep] + (len(variants),) + shape[sweep:]
+    if ensemble is not None:
+        #The ensemble statistics have the dimensions of the circulation types without "number",
+        #and the fractions of every type a "type" dimension after time
+        member_axis = CT_dims.index('number')
+        ensemble_dims = {name: [dim for dim in CT_dims if dim != 'number'] for name in JK_io.ENSEMBLE}
+        ensemble_dims['CT_probability'].insert(1, 'type')
+        ensemble_coords = {dim: values for dim, values in CT_coords.items() if dim != 'number'}
+        ensemble_coords['type'] = np.array(labels)
+        ensemble_sizes = dict(zip(CT_dims[1:], CT_shape), type = len(labels))
+        ensemble_shape = {name: tuple(ensemble_sizes[dim] for dim in names[1:]) for name, names in ensemble_dims.items()}
+    if output_file is not None:
+        print('Writing the results to ' + output_file + ' ✉︎')
+        variables = {'CT': CT_dims}
+        for name in diagnostics:
+            variables[name] = dims
+        sizes = dict(zip(CT_dims[1:], CT_shape))
+        writer_coords = CT_coords
+        if ensemble is not None:
+            variables.update(ensemble_dims)
+            sizes['type'] = len(labels)
+            writer_coords = dict(CT_coords, type = ensemble_coords['type'])
+        writer = JK_io.opening_writer(output_file, sizes, writer_coords, variables, attrs, flip_lat)
+    else:
+        lwt = np.full((len(time),) + CT_shape, np.nan)
+        #The flow terms are kept packed (int16) in memory as well
+        terms = {name: np.empty((len(time),) + shape, dtype = JK_io.DIAGNOSTICS_ENCODING['dtype']) for name in diagnostics}
+        #The ensemble statistics as float32
+        statistics = {name: np.empty((len(time),) + ensemble_shape[name], dtype = 'float32')
+                      for name in (JK_io.ENSEMBLE if ensemble is not None else [])}
 
-            print('Checking time formats ☂︎')
+    def classifying(block, setup):
+        if engine == 'sparse':
+            W, S, F, ZW, ZS, Z = JK_functions.flows_operator(block, setup['plan'], setup['operator'], setup['sc'],
+                                                             setup['zwa'], setup['zsc'], setup['zwb'], setup['wc'])
+        else:
+            #Extracting the 16-gridded values of MSLP
+            gridpoints = JK_functions.extracting_gridpoints(block, setup['plan'])
+            #Computing equations of flows and vorticity
+            W, S, F, ZW, ZS, Z = JK_functions.flows(gridpoints, setup['sc'], setup['zwa'], setup['zsc'],
+                                                    setup['zwb'], setup['wc'])
+            del(gridpoints)
+        #W: Westerly flow, S: Southerly flow, F: Resultant flow
+        #ZW: Westerly shear vorticity, ZS: Southerly shear vorticity, Z: Total shear vorticity
+        #Determination of Circulation Type (27 Original types)
+        if variants is None:
+            lwt_block = JK_functions.circulation_types(W, S, F, Z, setup['lat_c'])
+        else:
+            lwt_block = JK_functions.circulation_types_variants(W, S, F, Z, setup['lat_c'], variants)
+        return(lwt_block, {'W': W, 'S': S, 'F': F, 'ZW': ZW, 'ZS': ZS, 'Z': Z})
 
-                    #Checking the time coordinate values 
-            if type(time[0]) == np.datetime64:
-                time_pd = pd.to_datetime(time)
-                dates = [pd.to_datetime(str(time_pd[t].year) + '-' + str(time_pd[t].month) + '-' + str(time_pd[t].day), 
-                                            format = '%Y%m%d',errors = 'ignore') for t in range(len(time))]
-            else:
-                dates = [pd.to_datetime(str(time[t].year) + '-' + str(time[t].month) + '-' + str(time[t].day), 
-                                    format = '%Y%m%d',errors = 'ignore') for t in range(len(time))]
+    def classifying_geometries(block, setups):
+        if not sweep:
+            return(classifying(block, setups[0]))
+        #Every geometry is evaluated on the block already read
+        results = [classifying(block, setup) for setup in setups]
+        lwt_block = np.stack([result[0] for result in results], axis = 1)
+        flows = {name: np.stack([result[1][name] for result in results], axis = 1) for name in diagnostics}
+        return(lwt_block, flows)
 
-                    #Extracting the 16-gridded values of MSLP
-                    #extraction based on point 8 on original map
-            print('Extracting 16 gridpoints ●')
-            if answer_globe == 'yes':
-                gridpoints = JK_functions.extracting_gridpoints_gcm_globe(mslp, lat, lon)
-                p1  = gridpoints[0]
-                p2  = gridpoints[1]
-                p3  = gridpoints[2]
-                p4  = gridpoints[3]
-                p5  = gridpoints[4]
-                p6  = gridpoints[5]
-                p7  = gridpoints[6]
-                p8  = gridpoints[7]
-                p9  = gridpoints[8]
-                p10 = gridpoints[9]
-                p11 = gridpoints[10]
-                p12 = gridpoints[11]
-                p13 = gridpoints[12]
-                p14 = gridpoints[13]
-                p15 = gridpoints[14]
-                p16 = gridpoints[15]
-            elif answer_globe == 'no':
-                gridpoints = JK_functions.extracting_gridpoints_gcm_area(mslp, lat, lon)
-                p1  = gridpoints[0]
-                p2  = gridpoints[1]
-                p3  = gridpoints[2]
-                p4  = gridpoints[3]
-                p5  = gridpoints[4]
-                p6  = gridpoints[5]
-                p7  = gridpoints[6]
-                p8  = gridpoints[7]
-                p9  = gridpoints[8]
-                p10 = gridpoints[9]
-                p11 = gridpoints[10]
-                p12 = gridpoints[11]
-                p13 = gridpoints[12]
-                p14 = gridpoints[13]
-                p15 = gridpoints[14]
-                p16 = gridpoints[15]
-            else:
-                raise TypeError("Incorrect answer! Only 'yes' and 'no' is allowed")                
+    def classifying_tile(task):
+        segment, first, last, tile = task
+        if segment is None: #Days of sub-daily data
+            reading = functools.partial(JK_io.reading_tile, rows = tile['rows'], cols = tile['cols'])
+            block = JK_io.reading_days(segments, days, first, last, scale, reading)
+        else:
+            block = JK_io.reading_tile(segment, first, last, tile['rows'], tile['cols'], scale)
+        return(classifying_geometries(block, tile['setups']))
 
-            print('Computing flow terms ☈')
-            #Computing equations of flows and vorticity                        
-            flows = JK_functions.flows_gcm(p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, sc, zwa, zsc, zwb, lat, lon, time)
-            W  = flows[0] #Westerly flow
-            S  = flows[1] #Southerly flow
-            F  = flows[2] #Resultant flow
-            ZW = flows[3] #Westerly shear vorticity
-            ZS = flows[4] #Southerly shear vorticity
-            Z  = flows[5] #Total shear vorticity            
+    def block_ranges():
+        #(segment, first, last) of every block and its start in the record, the blocks
+        #of days (segment None) cross the boundaries between segments
+        if days is not None:
+            for first in range(0, len(time), block_size):
+                yield None, first, min(first + block_size, len(time)), first
+            return
+        offset = 0
+        for segment in segments:
+            for first in range(0, segment.shape[0], block_size):
+                yield segment, first, min(first + block_size, segment.shape[0]), offset + first
+            offset += segment.shape[0]
 
-        print('Computing flow directions ↖︎ → ↘︎ ↓ ←')
-        #Computing the wind direction values          
-        dd = np.arctan(W/S)
-        deg = np.rad2deg(dd)
-        deg=np.mod(180+np.rad2deg(np.arctan2(W, S)),360) 
-        #https://confluence.ecmwf.int/pages/viewpage.action?pageId=133262398 
-        #Assigning the Wind Direction labels
-        direction = JK_functions.direction_def_NH(deg)
-        if source == 'REAN':
-            direction = xr.where(deg.latitude < 0, JK_functions.direction_def_SH(deg), direction)
-        elif source == 'GCM':
-            direction = xr.where(deg.lat < 0, JK_functions.direction_def_SH(deg), direction)            
+    def classified_blocks():
+        if tiles is None:
+            #Classifying blocks of time steps, the next blocks are read (and converted to hPa) meanwhile
+            for start, block in JK_io.prefetch_blocks(segments, block_size, depth = prefetch, scale = scale, days = days):
+                yield (start, len(block)) + classifying_geometries(block, setups)
+            return
+        #Classifying the tiles of every block of time steps in parallel and stitching them together
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            for segment, first, last, start in block_ranges():
+                lwt_block = np.full((last - first,) + CT_shape, np.nan)
+                flows = {name: np.full((last - first,) + shape, np.nan) for name in diagnostics}
+                tasks = [(segment, first, last, tile) for tile in tiles]
+                for tile, (lwt_tile, flows_tile) in zip(tiles, pool.map(classifying_tile, tasks)):
+                    lwt_block[..., tile['lat_pos'], tile['lon_pos']] = lwt_tile
+                    for name in diagnostics:
+                        flows[name][..., tile['lat_pos'], tile['lon_pos']] = flows_tile[name]
+                yield start, last - first, lwt_block, flows
 
-        print('Determining the Circulation types ☁︎ ☀︎ ☂︎')
-        #Determination of Circulation Type (27 Original types)
-        lwt = JK_functions.assign_lwt(F, Z, direction)[0]
-        
-        #Storing the gridded Circulation Types in an xarray file
-        print('Saving the data in an xarray format ✉︎')
-        if (mslp.dims[1] == 'latitude') or (mslp.dims[1] == 'lat'):
-            output=xr.DataArray(data = lwt.values,
-                coords = {'time': time,
-                        'lat': lat_list, 
-                        'lon': lon_list},
-                        dims = ['time', 'lat', 'lon'])
-            output.name = 'CT' #Assigning variable name
-        elif mslp.dims[1] == 'number':
-            output=xr.DataArray(data = lwt.values,
-                coords = {'time': time,
-                          'number':mslp.number,
-                          'lat': lat_list, 
-                          'lon': lon_list},
-                        dims = ['time','number', 'lat', 'lon'])
-            output.name = 'CT' #Assigning variable name
-        if source == 'GCM':
-            output.attrs = {
-                'description':'Gridded Lamb circulation types derived from MSLP data based on the automated Jenkinson-Collison classification',
-                'institution_id': institution_id,
-                'source_id': source_id,
-                'experiment_id': experiment_id}
-        elif source == 'REAN':
-            output.attrs = {
-                'description':'Gridded Lamb circulation types derived from MSLP data based on the automated Jenkinson-Collison classification'}
-        order_lats = lat_list[0] - lat_list[-1]
-        if order_lats < 0:
-            output = output.reindex(lat=list(reversed(output.lat)))
+    print('Computing flow terms and Circulation types ☁︎ ☀︎ ☂︎')
+    for start, length, lwt_block, flows in classified_blocks():
+        if ensemble is not None:
+            #Members of every type counted once per block, streamed with the circulation types
+            reduced = JK_functions.ensemble_statistics(lwt_block, member_axis, ensemble)
+            reduced = {'CT_probability': np.moveaxis(reduced['probability'], -1, 1), 'CT_mode': reduced['mode'],
+                       'CT_agreement': reduced['agreement'], 'CT_entropy': reduced['entropy']}
+        if output_file is not None:
+            values = {'CT': lwt_block}
+            for name in diagnostics:
+                values[name] = flows[name]
+            if ensemble is not None:
+                values.update(reduced)
+            JK_io.writing_block(writer, start, values)
         else:
-            output = output        
+            lwt[start:start + length] = lwt_block
+            for name in diagnostics:
+                terms[name][start:start + length] = JK_io.packing(flows[name], JK_io.DIAGNOSTICS_ENCODING)
+            for name in statistics:
+                statistics[name][start:start + length] = reduced[name]
+
+    if output_file is not None:
+        JK_io.closing_writer(writer)
+        output = xr.open_dataset(output_file)
         print('The End! ✓')
-                # 'citation'
+        if len(diagnostics) == 0 and ensemble is None:
+            return output['CT']
+        return output
 
+    #Storing the gridded Circulation Types in an xarray file
+    print('Saving the data in an xarray format ✉︎')
+    output=xr.DataArray(data = lwt, coords = CT_coords, dims = CT_dims)
+    output.name = 'CT' #Assigning variable name
+    output.attrs = attrs
+    if len(diagnostics) > 0:
+        output = output.to_dataset()
+        output.attrs = attrs
+        encoding = JK_io.DIAGNOSTICS_ENCODING
+        for name in diagnostics:
+            output[name] = xr.DataArray(data = terms[name], coords = coords, dims = dims,
+                                        attrs = {'long_name': JK_io.DIAGNOSTICS[name], 'scale_factor': encoding['scale_factor'],
+                                                 'add_offset': encoding['add_offset'], '_FillValue': encoding['_FillValue']})
+        #Unpacked when the values are used, and stored compactly when saving with to_netcdf
+        output = xr.decode_cf(output)
+        for name in diagnostics:
+            output[name].encoding.update(zlib = encoding['zlib'], complevel = encoding['complevel'])
+    if ensemble is not None:
+        output = output.to_dataset() if type(output) == xr.DataArray else output
+        output.attrs = attrs
+        for name in statistics:
+            output[name] = xr.DataArray(data = statistics[name], coords = {dim: ensemble_coords[dim] for dim in ensemble_dims[name] if dim in ensemble_coords},
+                                        dims = ensemble_dims[name], attrs = {'long_name': JK_io.ENSEMBLE[name]})
+            #Stored compactly when saving with to_netcdf
+            output[name].encoding.update(JK_io.variable_encoding(name))
+    if flip_lat:
+        output = output.reindex(lat=list(reversed(output.lat)))
+    if cache is not None:
+        JK_cache.storing_result(cache, key, output)
+    print('The End! ✓')
+            # 'citation'
 
-    else:
-        raise TypeError("Incorrect filename directory. Only strings allowed")
-    
-    return output
\ No newline at end of file
+    return output
@@ -9,6 +9,7 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
+from collections import OrderedDict
 
 def checking_lon_coords(mslp, lon_name):
     """
@@ -38,30 +39,718 @@ def checking_lon_coords(mslp, lon_name):
         pass
     return(mslp)
 
-def constants(phi, lon):
+def normalise_time(time):
+    """
+    This function normalises the time values to daily values (00 UTC)
+    using array operations only.
+    Works with np.datetime64 values and with all cftime calendars
+    (360_day, noleap, all_leap, ...) used by the GCMs.
+
+    :param time: array of time values
+    :return: array of daily time values of the same type and calendar
+    """
+    time = np.asarray(time)
+    if len(time) == 0 or np.issubdtype(time.dtype, np.datetime64):
+        return(time.astype('datetime64[D]').astype('datetime64[ns]'))
+    import cftime
+    calendar = time[0].calendar
+    units = 'days since 0001-01-01'
+    days = np.floor(cftime.date2num(time, units, calendar = calendar))
+    return(cftime.num2date(days, units, calendar = calendar))
+
+def checking_daily(daily):
+    """
+    This function checks the daily option of the classification.
+
+    :param daily: None, "mean" or an integer hour (0 to 23)
+    """
+    if daily is None or daily == 'mean':
+        return
+    if isinstance(daily, (int, np.integer)) and not isinstance(daily, bool) and 0 <= daily < 24:
+        return
+    raise TypeError("Incorrect daily option! Only 'mean' or an integer hour is allowed")
+
+def daily_steps(time, daily):
+    """
+    This function plans the reduction of sub-daily (e.g. hourly ERA5) data to one
+    field per day, from the time values only (see JK_io.reading_days).
+    The days split across two files are reduced as one day.
+
+    :param time: time values of the whole record, in time order (all the files)
+    :param daily: "mean" for daily means or an integer hour (e.g. 12) to keep that synoptic hour only
+    :return: dictionary with the positions in the record of the time steps read ("steps"), the first
+             of every day among them ("starts") and the time of every day ("time"), or None for
+             daily means of data already daily
+    """
+    checking_daily(daily)
+    if daily == 'mean':
+        days = normalise_time(time)
+        new_day = np.ones(len(days), dtype = bool)
+        new_day[1:] = days[1:] != days[:-1]
+        starts = np.flatnonzero(new_day)
+        if len(starts) == len(days):
+            #Already one field per day
+            return None
+        return({'steps': np.arange(len(days)), 'starts': starts, 'time': days[starts]})
+    hours = xr.DataArray(time, dims = 'time').dt.hour.values
+    steps = np.flatnonzero(hours == daily)
+    if len(steps) == 0:
+        raise ValueError('No time steps found at ' + str(daily) + ' UTC')
+    return({'steps': steps, 'starts': np.arange(len(steps)), 'time': np.asarray(time)[steps]})
+
+#Latitude and longitude offsets (º) of the 16 gridpoints (p1 to p16) in reference to the central point
+STENCIL_OFFSETS = ((10, -5), (10, 5),
+                   (5, -15), (5, -5), (5, 5), (5, 15),
+                   (0, -15), (0, -5), (0, 5), (0, 15),
+                   (-5, -15), (-5, -5), (-5, 5), (-5, 15),
+                   (-10, -5), (-10, 5))
+#Default geometry of the stencil (º): 5º between latitudes and 10º between longitudes
+#of the gridpoints (offsets of ±5º and ±10º in latitude, ±5º and ±15º in longitude)
+GEOMETRY_DEFAULT = (5, 10)
+#Stencil plans already computed, one per grid, least recently used first
+_stencil_plans = OrderedDict()
+STENCIL_PLANS = 32
+
+def cached_plan(key):
+    '''
+    This function returns a stencil plan already computed, or None.
+
+    :param key: key of the grid
+    '''
+    plan = _stencil_plans.get(key)
+    if plan is not None:
+        _stencil_plans.move_to_end(key)
+    return(plan)
+
+def storing_plan(key, plan):
+    '''
+    This function keeps a stencil plan for the following files of the same grid
+    (up to STENCIL_PLANS grids).
+
+    :param key: key of the grid
+    :param plan: stencil plan
+    '''
+    _stencil_plans[key] = plan
+    if len(_stencil_plans) > STENCIL_PLANS:
+        _stencil_plans.popitem(last = False)
+    return(plan)
+
+def stencil_offsets(geometry = GEOMETRY_DEFAULT):
+    '''
+    This function scales the offsets of the 16 gridpoints to other stencil geometries.
+    Geometries can be scaled (e.g. (2.5, 5)) or anisotropic (e.g. (5, 5)).
+
+    :param geometry: (latitude step, longitude step) of the stencil in degrees, default (5, 10)
+    :return: tuple of (latitude, longitude) offsets of the 16 gridpoints (p1 to p16)
+    '''
+    lat_step, lon_step = geometry
+    if lat_step <= 0 or lon_step <= 0:
+        raise ValueError('The steps of the stencil geometry must be positive')
+    return(tuple((o[0] * lat_step / 5, o[1] * lon_step / 10) for o in STENCIL_OFFSETS))
+
+def geometry_factors(geometry = GEOMETRY_DEFAULT):
+    '''
+    This function computes the factors converting the pressure differences of a stencil
+    geometry to the units of the original geometry (hPa per 10º of latitude)
+
+    :param geometry: (latitude step, longitude step) of the stencil in degrees, default (5, 10)
+    :return: factors of the north-south (fw) and east-west (fs) differences
+    '''
+    lat_step, lon_step = geometry
+    return(10 / (2 * lat_step), 10 / lon_step)
+
+def nearest_index(coord, target, periodic = False):
+    '''
+    This function finds the index of the nearest coordinate value for each target
+    value by binary search. The coordinate only needs to be monotonic, so
+    non-uniform grids (e.g. Gaussian latitudes) are supported.
+    Ties are resolved towards the larger coordinate value, as xarray's "nearest" does.
+
+    :param coord: 1-D array of monotonic coordinate values
+    :param target: array of values to be searched
+    :param periodic: True for longitudes covering the whole globe (values wrap every 360º)
+    '''
+    coord = np.asarray(coord, dtype = float)
+    target = np.asarray(target, dtype = float)
+    descending = coord[0] > coord[-1]
+    if descending:
+        coord = coord[::-1]
+    if periodic:
+        target = coord[0] + np.mod(target - coord[0], 360)
+        coord = np.append(coord, coord[0] + 360)
+    pos = np.clip(np.searchsorted(coord, target), 1, len(coord) - 1)
+    index = np.where(target - coord[pos - 1] < coord[pos] - target, pos - 1, pos)
+    if periodic:
+        coord = coord[:-1]
+        index = index % len(coord)
+    if descending:
+        index = len(coord) - 1 - index
+    return(index)
+
+def bracketing_index(coord, target, periodic = False):
+    '''
+    This function finds the two coordinate values around each target value by
+    binary search, with the weights of a linear interpolation between them.
+    Targets beyond the coordinate values take the value of the closest edge.
+
+    :param coord: 1-D array of monotonic coordinate values
+    :param target: array of values to be searched
+    :param periodic: True for longitudes covering the whole globe (values wrap every 360º)
+    :return: indices and weights, both of shape (2, len(target))
+    '''
+    coord = np.asarray(coord, dtype = float)
+    target = np.asarray(target, dtype = float)
+    descending = coord[0] > coord[-1]
+    if descending:
+        coord = coord[::-1]
+    if periodic:
+        target = coord[0] + np.mod(target - coord[0], 360)
+        coord = np.append(coord, coord[0] + 360)
+    pos = np.clip(np.searchsorted(coord, target), 1, len(coord) - 1)
+    weight = np.clip((target - coord[pos - 1]) / (coord[pos] - coord[pos - 1]), 0, 1)
+    index = np.stack([pos - 1, pos])
+    weights = np.stack([1 - weight, weight])
+    if periodic:
+        coord = coord[:-1]
+        index = index % len(coord)
+    if descending:
+        index = len(coord) - 1 - index
+    return(index, weights)
+
+def central_index(coord, margin):
+    '''
+    This function returns the indices of the central points whose gridpoints
+    (up to "margin" degrees away) fall within the domain of the coordinate.
+    Targets less than one edge grid spacing beyond the domain are accepted,
+    as the original crop factors int(margin/spacing) did on regular grids.
+
+    :param coord: 1-D array of monotonic coordinate values
+    :param margin: largest offset (º) of the gridpoints from the central point
+    '''
+    coord = np.asarray(coord, dtype = float)
+    ordered = np.sort(coord)
+    step_low = ordered[1] - ordered[0]
+    step_high = ordered[-1] - ordered[-2]
+    keep = (((coord + margin) - ordered[-1] < step_high * (1 - 1e-6)) &
+            (ordered[0] - (coord - margin) < step_low * (1 - 1e-6)))
+    return(np.flatnonzero(keep))
+
+def stencil_plan(lat, lon, globe, interpolation = 'nearest', geometry = GEOMETRY_DEFAULT):
+    '''
+    This function plans the extraction of the 16 gridpoints from the actual
+    latitude and longitude values of the grid, so regular, Gaussian and other
+    non-uniform 1-D grids are handled alike.
+    The plan is computed once per grid and reused afterwards.
+
+    :param lat: 1-D array of latitude values of the whole grid
+    :param lon: 1-D array of longitude values (-180 to 180) of the whole grid
+    :param globe: True if the data covers the whole globe (longitudes wrap around)
+    :param interpolation: "nearest" snaps the 16 gridpoints to the nearest grid values (default),
+                          "bilinear" interpolates them from the 4 surrounding grid values, which avoids
+                          the jitter of the stencil on grids whose spacing does not divide 5º
+    :param geometry: (latitude step, longitude step) of the stencil in degrees, default (5, 10)
+    :return: dictionary with the central points ("lat_index", "lon_index") and, for every central
+             latitude and longitude, the indices ("ilat", "ilon") and weights ("wlat", "wlon")
+             of the grid values of the 16 gridpoints
+    '''
+    if interpolation not in ('nearest', 'bilinear'):
+        raise TypeError("Incorrect interpolation, only 'nearest' or 'bilinear' allowed")
+    lat = np.asarray(lat, dtype = float)
+    lon = np.asarray(lon, dtype = float)
+    geometry = tuple(float(step) for step in geometry)
+    key = (lat.tobytes(), lon.tobytes(), bool(globe), interpolation, geometry)
+    plan = cached_plan(key)
+    if plan is not None:
+        return(plan)
+    offsets = stencil_offsets(geometry)
+    lat_index = central_index(lat, max(abs(o[0]) for o in offsets))
+    if globe:
+        lon_index = np.arange(len(lon))
+    else:
+        lon_index = central_index(lon, max(abs(o[1]) for o in offsets))
+    lat_c = lat[lat_index]
+    lon_c = lon[lon_index]
+    if interpolation == 'nearest':
+        ilat = np.array([nearest_index(lat, lat_c + o[0])[None] for o in offsets])
+        ilon = np.array([nearest_index(lon, lon_c + o[1], periodic = globe)[None] for o in offsets])
+        wlat = np.ones(ilat.shape)
+        wlon = np.ones(ilon.shape)
+    else:
+        ilat, wlat = map(np.array, zip(*[bracketing_index(lat, lat_c + o[0]) for o in offsets]))
+        ilon, wlon = map(np.array, zip(*[bracketing_index(lon, lon_c + o[1], periodic = globe) for o in offsets]))
+    plan = {'kind': 'rectilinear', 'grid_shape': (len(lat), len(lon)), 'shape': (len(lat_index), len(lon_index)),
+            'lat_index': lat_index, 'lon_index': lon_index,
+            'ilat': ilat, 'wlat': wlat, 'ilon': ilon, 'wlon': wlon}
+    return(storing_plan(key, plan))
+
+def restricting_plan(plan, lat_index, lon_index):
+    '''
+    This function restricts a stencil plan of a regular grid to some of its central
+    points, e.g. the central points shared by several stencil geometries.
+
+    :param plan: stencil plan of the grid (see stencil_plan)
+    :param lat_index: indices of the central latitudes to be kept (all in the plan)
+    :param lon_index: indices of the central longitudes to be kept (all in the plan)
+    :return: new stencil plan
+    '''
+    lat_pos = np.searchsorted(plan['lat_index'], lat_index)
+    lon_pos = np.searchsorted(plan['lon_index'], lon_index)
+    return({'kind': 'rectilinear', 'grid_shape': plan['grid_shape'], 'shape': (len(lat_pos), len(lon_pos)),
+            'lat_index': plan['lat_index'][lat_pos], 'lon_index': plan['lon_index'][lon_pos],
+            'ilat': plan['ilat'][..., lat_pos], 'wlat': plan['wlat'][..., lat_pos],
+            'ilon': plan['ilon'][..., lon_pos], 'wlon': plan['wlon'][..., lon_pos]})
+
+def halo_index(index, size, periodic = False):
+    '''
+    This function finds the shortest run of consecutive grid indices containing
+    all the given indices, wrapping around the end of periodic (global) longitudes.
+
+    :param index: array of grid indices
+    :param size: number of grid values
+    :param periodic: True for global longitudes
+    :return: array of consecutive grid indices (modulo size when periodic)
+    '''
+    values = np.unique(index)
+    if not periodic:
+        return(np.arange(values[0], values[-1] + 1))
+    #The run starts after the largest gap between the indices (going around the globe)
+    gaps = np.diff(np.append(values, values[0] + size))
+    largest = np.argmax(gaps)
+    first = values[(largest + 1) % len(values)]
+    length = (values[largest] - first) % size + 1
+    return((first + np.arange(length)) % size)
+
+def tiling(plans, tile_shape, periodic = False):
+    '''
+    This function splits the central points of a regular grid into tiles. Every tile
+    reads its own rows and columns of MSLP, including the halo of gridpoints of the
+    stencil (wrapping across the dateline on global grids), so a tile is classified
+    without the rest of the grid.
+
+    :param plans: list of stencil plans sharing the same central points (e.g. several geometries)
+    :param tile_shape: (latitudes, longitudes) number of central points per tile
+    :param periodic: True for global grids
+    :return: list of tiles, dictionaries with the positions of the central points ("lat_pos", "lon_pos"),
+             the grid indices to be read ("rows", "cols") and the stencil plans on the tile ("plans")
+    '''
+    n_lat, n_lon = plans[0]['shape']
+    grid_shape = plans[0]['grid_shape']
+    tiles = []
+    for lat_start in range(0, n_lat, tile_shape[0]):
+        for lon_start in range(0, n_lon, tile_shape[1]):
+            lat_pos = slice(lat_start, min(lat_start + tile_shape[0], n_lat))
+            lon_pos = slice(lon_start, min(lon_start + tile_shape[1], n_lon))
+            rows = halo_index(np.concatenate([plan['ilat'][..., lat_pos].ravel() for plan in plans]), grid_shape[0])
+            cols = halo_index(np.concatenate([plan['ilon'][..., lon_pos].ravel() for plan in plans]), grid_shape[1],
+                              periodic)
+            #Grid indices of the stencil converted to positions in the rows and columns read
+            local_rows = np.full(grid_shape[0], -1)
+            local_rows[rows] = np.arange(len(rows))
+            local_cols = np.full(grid_shape[1], -1)
+            local_cols[cols] = np.arange(len(cols))
+            tile_plans = []
+            for plan in plans:
+                tile_plan = restricting_plan(plan, plan['lat_index'][lat_pos], plan['lon_index'][lon_pos])
+                tile_plan['grid_shape'] = (len(rows), len(cols))
+                tile_plan['ilat'] = local_rows[tile_plan['ilat']]
+                tile_plan['ilon'] = local_cols[tile_plan['ilon']]
+                tile_plans.append(tile_plan)
+            tiles.append({'lat_pos': lat_pos, 'lon_pos': lon_pos, 'rows': rows, 'cols': cols, 'plans': tile_plans})
+    return(tiles)
+
+def unit_vectors(lat, lon):
+    '''
+    Cartesian coordinates on the unit sphere of the given latitudes and longitudes (º)
+    '''
+    lat = np.deg2rad(np.asarray(lat, dtype = float))
+    lon = np.deg2rad(np.asarray(lon, dtype = float))
+    return(np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis = -1))
+
+def stencil_plan_curvilinear(lat, lon, geometry = GEOMETRY_DEFAULT):
+    '''
+    This function plans the extraction of the 16 gridpoints on curvilinear grids
+    (e.g. rotated-pole EURO-CORDEX grids) with 2-D latitude and longitude values.
+    The nearest gridpoint to each of the 16 positions of every central point is
+    found with a KD-tree on the unit sphere, so the data is classified on its
+    native grid. Central points whose gridpoints fall outside the domain (further than
+    half a grid cell diagonal from the nearest gridpoint) are flagged as not valid.
+    The plan is computed once per grid and reused afterwards.
+
+    :param lat: 2-D array of latitude values
+    :param lon: 2-D array of longitude values
+    :param geometry: (latitude step, longitude step) of the stencil in degrees, default (5, 10)
+    :return: dictionary with the flat indices of the 16 gridpoints ("index") for every
+             gridpoint and the mask of valid central points ("valid")
+    '''
+    from scipy.spatial import cKDTree
+    lat = np.asarray(lat, dtype = float)
+    lon = np.asarray(lon, dtype = float)
+    geometry = tuple(float(step) for step in geometry)
+    key = (lat.tobytes(), lon.tobytes(), 'curvilinear', geometry)
+    plan = cached_plan(key)
+    if plan is not None:
+        return(plan)
+    xyz = unit_vectors(lat, lon)
+    tree = cKDTree(xyz.reshape(-1, 3))
+    #Local grid spacing (chord length) along both grid axes and half diagonal of the grid cells
+    dy = np.linalg.norm(np.diff(xyz, axis = 0), axis = -1)
+    dx = np.linalg.norm(np.diff(xyz, axis = 1), axis = -1)
+    dy = np.maximum(np.pad(dy, ((1, 0), (0, 0)), 'edge'), np.pad(dy, ((0, 1), (0, 0)), 'edge'))
+    dx = np.maximum(np.pad(dx, ((0, 0), (1, 0)), 'edge'), np.pad(dx, ((0, 0), (0, 1)), 'edge'))
+    half_diagonal = 0.5 * np.hypot(dy, dx).ravel() * (1 + 1e-6)
+    index = np.empty((len(STENCIL_OFFSETS), lat.size), dtype = int)
+    valid = np.ones(lat.size, dtype = bool)
+    for k, offset in enumerate(stencil_offsets(geometry)):
+        target_lat = (lat + offset[0]).ravel()
+        target_lon = (lon + offset[1]).ravel()
+        distance, index[k] = tree.query(unit_vectors(target_lat, target_lon), workers = -1)
+        valid &= (distance <= half_diagonal[index[k]]) & (np.abs(target_lat) <= 90)
+    plan = {'kind': 'curvilinear', 'grid_shape': lat.shape, 'shape': lat.shape,
+            'index': index, 'valid': valid.reshape(lat.shape)}
+    return(storing_plan(key, plan))
+
+def extracting_gridpoints(mslp, plan):
+    """
+    This function extracts the 16 moving gridded points with a stencil plan
+    (see stencil_plan). Works for any grid spacing and for data with extra
+    dimensions (e.g. "number") before latitude and longitude.
+
+    :param mslp: array of MSLP values with latitude and longitude as last dimensions
+    :param plan: stencil plan of the grid
+    :return: tuple of the 16 gridpoints (p1 to p16)
+    """
+    mslp = np.asarray(mslp)
+    gridpoints = []
+    if plan['kind'] == 'curvilinear':
+        shape = mslp.shape
+        mslp = mslp.reshape(shape[:-2] + (-1,))
+        for k in range(len(STENCIL_OFFSETS)):
+            p = mslp[..., plan['index'][k]].reshape(shape)
+            gridpoints.append(np.where(plan['valid'], p, np.nan))
+        return tuple(gridpoints)
+    ilat, wlat, ilon, wlon = plan['ilat'], plan['wlat'], plan['ilon'], plan['wlon']
+    for k in range(len(STENCIL_OFFSETS)):
+        if ilat.shape[1] == 1 and ilon.shape[1] == 1:
+            #Nearest gridpoint
+            gridpoints.append(mslp[..., ilat[k, 0][:, None], ilon[k, 0][None, :]])
+            continue
+        #Bilinear interpolation from the surrounding gridpoints
+        p = 0
+        for a in range(ilat.shape[1]):
+            for b in range(ilon.shape[1]):
+                weight = wlat[k, a][:, None] * wlon[k, b][None, :]
+                p = p + weight * mslp[..., ilat[k, a][:, None], ilon[k, b][None, :]]
+        gridpoints.append(p)
+    return tuple(gridpoints)
+
+def stencil_weights(plan, k):
+    """
+    This function returns, for gridpoint k (0 for p1 to 15 for p16) of every central
+    point, the flat indices of the grid values it is made of and their weights.
+
+    :param plan: stencil plan of the grid
+    :param k: index of the gridpoint
+    :return: rows (central points), columns (flat grid indices) and weights
+    """
+    if plan['kind'] == 'curvilinear':
+        columns = plan['index'][k]
+        return(np.arange(len(columns)), columns, np.ones(len(columns)))
+    n_lon = plan['grid_shape'][1]
+    ilat, wlat, ilon, wlon = plan['ilat'], plan['wlat'], plan['ilon'], plan['wlon']
+    rows, columns, weights = [], [], []
+    cells = np.arange(plan['shape'][0] * plan['shape'][1])
+    for a in range(ilat.shape[1]):
+        for b in range(ilon.shape[1]):
+            rows.append(cells)
+            columns.append((ilat[k, a][:, None] * n_lon + ilon[k, b][None, :]).ravel())
+            weights.append((wlat[k, a][:, None] * wlon[k, b][None, :]).ravel())
+    return(np.concatenate(rows), np.concatenate(columns), np.concatenate(weights))
+
+#Weights of the gridpoints (1 for p1 to 16 for p16) in the flow terms before applying
+#the latitude dependant constants. ZW is split in the terms multiplied by zwa and zwb
+FLOW_WEIGHTS = (('W',   {12: 0.5, 13: 0.5, 4: -0.5, 5: -0.5}),
+                ('S',   {5: 0.25, 9: 0.5, 13: 0.25, 4: -0.25, 8: -0.5, 12: -0.25}),
+                ('ZWa', {15: 0.5, 16: 0.5, 8: -0.5, 9: -0.5}),
+                ('ZWb', {1: 0.5, 2: 0.5, 8: -0.5, 9: -0.5}),
+                ('ZS',  {6: 0.25, 10: 0.5, 14: 0.25, 5: -0.25, 9: -0.5, 13: -0.25,
+                         4: -0.25, 8: -0.5, 12: -0.25, 3: 0.25, 7: 0.5, 11: 0.25}))
+
+def flow_operator(plan):
+    """
+    This function precompiles the flow terms W, S, ZW and ZS as one sparse matrix,
+    since all of them are linear combinations of the 16 gridpoints of MSLP.
+    One sparse-dense product of the matrix with a block of MSLP fields
+    (flat grid, time) yields the terms of FLOW_WEIGHTS for every central point.
+    The matrix is computed once per plan and reused afterwards.
+
+    :param plan: stencil plan of the grid
+    :return: scipy.sparse matrix of shape (5 * central points, gridpoints)
+    """
+    if 'operator' in plan:
+        return(plan['operator'])
+    from scipy import sparse
+    n_cells = plan['shape'][0] * plan['shape'][1]
+    rows, columns, values = [], [], []
+    for term, (name, weights) in enumerate(FLOW_WEIGHTS):
+        for point, weight in weights.items():
+            r, c, w = stencil_weights(plan, point - 1)
+            rows.append(term * n_cells + r)
+            columns.append(c)
+            values.append(weight * w)
+    operator = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                 shape = (len(FLOW_WEIGHTS) * n_cells, plan['grid_shape'][0] * plan['grid_shape'][1]))
+    plan['operator'] = operator
+    return(operator)
+
+def flows_operator(mslp, plan, operator, sc, zwa, zsc, zwb, wc = 1):
+    """
+    This function computes the flow terms with the sparse operator of flow_operator
+    from a block of MSLP fields with latitude and longitude as last dimensions.
+
+    :param mslp: array of MSLP values
+    :param plan: stencil plan of the grid
+    :param operator: sparse matrix of the flow terms
+    :param sc, zwa, zsc, zwb: latitude dependant constants
+    :param wc: factor of the westerly flow of other stencil geometries (see geometry_factors)
+    :return: W, S, F, ZW, ZS and Z as numpy arrays
+    """
+    mslp = np.asarray(mslp)
+    lead = mslp.shape[:-2]
+    fields = mslp.reshape((-1, mslp.shape[-2] * mslp.shape[-1])).T
+    terms = np.asarray(operator @ fields)
+    terms = terms.reshape((len(FLOW_WEIGHTS), -1, fields.shape[1])).transpose(0, 2, 1)
+    terms = terms.reshape((len(FLOW_WEIGHTS),) + lead + tuple(plan['shape']))
+    if plan['kind'] == 'curvilinear':
+        terms[..., ~plan['valid']] = np.nan
+    W, S, ZWa, ZWb, ZS = terms
+    W = wc * W
+    S = np.array(sc) * S
+    ZW = np.array(zwa) * ZWa + np.array(zwb) * ZWb
+    ZS = np.array(zsc) * ZS
+    F = np.sqrt(S**2 + W**2)
+    Z = ZW + ZS
+    return(W, S, F, ZW, ZS, Z)
+
+#Thresholds of the classification (Jones et al., 1993): Low Flow when F < low_flow and |Z| < low_vorticity,
+#pure directional types when |Z| < pure * F, pure cyclonic/anticyclonic when |Z| > hybrid * F.
+#hemisphere: "auto" uses the Southern Hemisphere directions for negative latitudes, "NH" or "SH" use one of them everywhere
+VARIANT_DEFAULT = {'low_flow': 6, 'low_vorticity': 6, 'pure': 1, 'hybrid': 2, 'hemisphere': 'auto'}
+#Upper limits (º) of the direction sectors N, NE, E, SE, S, SW, W, NW (N again above 337º)
+DIRECTION_BOUNDS = np.array([22, 67, 112, 157, 202, 247, 292, 337])
+#Direction codes of the sectors: 1 NE, 2 E, 3 SE, 4 S, 5 SW, 6 W, 7 NW, 8 N
+DIRECTION_CODES = np.array([8, 1, 2, 3, 4, 5, 6, 7, 8])
+#Codes of the 27 circulation types: LF, A, the directional types (1 NE to 8 N), the anticyclonic
+#hybrid types (11 to 18), C and the cyclonic hybrid types (21 to 28)
+CT_CODES = [-1, 0] + list(range(1, 9)) + list(range(11, 19)) + [20] + list(range(21, 29))
+#Grouping of the 27 circulation types into 11 types (as CTs_functions.eleven_CTs)
+CT_GROUPS = OrderedDict([('LF', [-1]), ('A', [0]), ('NE', [1, 11, 21]), ('E', [2, 12, 22]), ('SE', [3, 13, 23]),
+                         ('S', [4, 14, 24]), ('SW', [5, 15, 25]), ('W', [6, 16, 26]), ('NW', [7, 17, 27]),
+                         ('N', [8, 18, 28]), ('C', [20])])
+
+def type_classes(types = 27):
+    """
+    This function numbers the circulation types (27 types or the 11 grouped types).
+    The 11 grouped types also accept the codes of CTs_functions.eleven_CTs (9 for C).
+
+    :param types: 27 or 11
+    :return: labels of the types, and lookup table of the class of every code + 2 (-1 for no type,
+             -2 for the code 9 with 27 types, see type_indices)
+    """
+    if types not in (11, 27):
+        raise ValueError('Incorrect types, only 11 or 27 allowed')
+    lookup = np.full(32, -1)
+    if types == 27:
+        labels = list(CT_CODES)
+        for n, code in enumerate(CT_CODES):
+            lookup[code + 2] = n
+        lookup[9 + 2] = -2
+    else:
+        labels = list(CT_GROUPS)
+        for n, codes in enumerate(CT_GROUPS.values()):
+            lookup[np.array(codes) + 2] = n
+        lookup[9 + 2] = labels.index('C')
+    return(labels, lookup)
+
+def type_indices(values, lookup):
+    """
+    This function finds the class of every circulation type.
+
+    :param values: array of circulation types (NaN for missing values)
+    :param lookup: lookup table of type_classes
+    :return: array of classes, -1 for no type
+    """
+    classes = lookup[np.where(np.isfinite(values), values + 2, 0).astype(int)]
+    if np.any(classes == -2):
+        raise ValueError('Code 9 found, the circulation types are the 11 grouped types (see CTs_functions.eleven_CTs), use types = 11')
+    return(classes)
+
+def ensemble_statistics(lwt, axis, types = 27):
+    """
+    This function reduces the circulation types of the ensemble members at every gridpoint
+    and time step, from the number of members of every type counted in one pass (bincount).
+
+    :param lwt: array of circulation types
+    :param axis: axis of the ensemble members
+    :param types: 27 or 11 (grouped types, coded as CTs_functions.eleven_CTs)
+    :return: dictionary with the fraction of members of every type ("probability", types as last
+             axis), the most frequent type ("mode", the first type of CT_CODES or CT_GROUPS on ties),
+             the fraction of members of the most frequent type ("agreement") and the entropy of the
+             types in bits ("entropy"). NaN where no member has a type
+    """
+    labels, lookup = type_classes(types)
+    n_types = len(labels)
+    codes = np.array(CT_CODES if types == 27 else range(-1, len(CT_GROUPS) - 1), dtype = float)
+    lwt = np.moveaxis(np.asarray(lwt), axis, -1)
+    classes = type_indices(lwt, lookup)
+    shape = classes.shape[:-1]
+    cells = int(np.prod(shape))
+    #Number of members of every type (types last)
+    flat = classes + n_types * np.arange(cells).reshape(shape + (1,))
+    counts = np.bincount(flat[classes >= 0], minlength = cells * n_types).reshape(shape + (n_types,))
+    members = counts.sum(axis = -1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        probability = counts / members[..., None]
+        logs = np.where(counts > 0, np.log2(np.where(counts > 0, probability, 1)), 0)
+    entropy = np.where(members > 0, -(probability * logs).sum(axis = -1), np.nan)
+    mode = np.where(members > 0, codes[counts.argmax(axis = -1)], np.nan)
+    agreement = counts.max(axis = -1) / np.where(members > 0, members, np.nan)
+    return({'probability': probability, 'mode': mode, 'agreement': agreement, 'entropy': entropy})
+
+def checking_variant(variant):
+    """
+    This function checks a threshold configuration and fills the missing
+    thresholds with the default values (VARIANT_DEFAULT)
+
+    :param variant: dictionary of thresholds, or None for the default ones
+    :return: dictionary with all the thresholds
+    """
+    checked = dict(VARIANT_DEFAULT)
+    for name, value in (variant or {}).items():
+        if name not in VARIANT_DEFAULT:
+            raise TypeError("Incorrect threshold '" + str(name) + "', only " + ', '.join(VARIANT_DEFAULT) + " allowed")
+        checked[name] = value
+    if checked['hemisphere'] not in ('auto', 'NH', 'SH'):
+        raise TypeError("Incorrect hemisphere, only 'auto', 'NH' or 'SH' allowed")
+    return(checked)
+
+def variant_label(variant):
+    """
+    This function describes a threshold configuration, e.g. "low_flow=6 low_vorticity=6 pure=1 hybrid=2 hemisphere=auto"
+
+    :param variant: dictionary of thresholds
+    """
+    variant = checking_variant(variant)
+    return(' '.join(name + '=' + str(variant[name]) for name in VARIANT_DEFAULT))
+
+def flow_directions(W, S, lat, hemisphere = 'auto'):
+    """
+    This function assigns the direction codes (1 NE, 2 E, 3 SE, 4 S, 5 SW, 6 W, 7 NW, 8 N)
+    of the flow, same sectors as direction_def_NH and direction_def_SH
+
+    :param W, S: arrays of westerly and southerly flow
+    :param lat: latitude of the central points, broadcastable to the flow terms
+    :param hemisphere: "auto", "NH" or "SH" (see VARIANT_DEFAULT)
+    :return: array of direction codes, 0 where the direction is not defined
+    """
+    #Computing the wind direction values
+    deg = np.mod(180+np.rad2deg(np.arctan2(W, S)),360)
+    #https://confluence.ecmwf.int/pages/viewpage.action?pageId=133262398
+    direction = DIRECTION_CODES[np.searchsorted(DIRECTION_BOUNDS, np.nan_to_num(deg))]
+    if hemisphere == 'auto':
+        south = np.broadcast_to(np.asarray(lat) < 0, deg.shape)
+    else:
+        south = hemisphere == 'SH'
+    #The Southern Hemisphere directions are rotated 180º
+    direction = np.where(south, (direction + 3) % 8 + 1, direction)
+    return(np.where(np.isfinite(deg), direction, 0))
+
+def circulation_types(W, S, F, Z, lat, variant = None, direction = None):
+    """
+    This function assigns the circulation types from the flow terms,
+    same coding as assign_lwt with configurable thresholds
+
+    :param W, S, F, Z: arrays of westerly, southerly and resultant flow and total shear vorticity
+    :param lat: latitude of the central points, broadcastable to the flow terms
+    :param variant: dictionary of thresholds (see VARIANT_DEFAULT), None for the original ones
+    :param direction: direction codes already computed with flow_directions (optional)
+    :return: numpy array of the circulation types
+    """
+    variant = checking_variant(variant)
+    if direction is None:
+        direction = flow_directions(W, S, lat, variant['hemisphere'])
+    F = np.asarray(F)
+    Z = np.asarray(Z)
+    directional = direction > 0
+    abs_Z = np.fabs(Z)
+    #Determination of Circulation Type (27 Original types)
+    lwt = np.where( (Z<0) & directional, direction, np.nan)
+    lwt = np.where( (abs_Z < variant['pure']*F) & directional, 10 + direction, lwt)
+    lwt = np.where( (abs_Z > variant['hybrid']*F) & (Z>0), 20, lwt)
+    lwt = np.where( (abs_Z > variant['hybrid']*F) & (Z<0), 0, lwt)
+    lwt = np.where( (abs_Z > variant['pure']*F) & (abs_Z < variant['hybrid']*F) & (Z>0) & directional, 20 + direction, lwt)
+    lwt = np.where( (F < variant['low_flow']) & (abs_Z < variant['low_vorticity']), -1, lwt)
+    return(lwt)
+
+def circulation_types_variants(W, S, F, Z, lat, variants):
+    """
+    This function assigns the circulation types for several threshold
+    configurations from the same flow terms
+
+    :param W, S, F, Z: arrays of westerly, southerly and resultant flow and total shear vorticity
+    :param lat: latitude of the central points, broadcastable to the flow terms
+    :param variants: list of dictionaries of thresholds (see VARIANT_DEFAULT)
+    :return: numpy array of the circulation types with the variants as second dimension
+    """
+    directions = {}
+    lwt = []
+    for variant in variants:
+        variant = checking_variant(variant)
+        if variant['hemisphere'] not in directions:
+            directions[variant['hemisphere']] = flow_directions(W, S, lat, variant['hemisphere'])
+        lwt.append(circulation_types(W, S, F, Z, lat, variant, directions[variant['hemisphere']]))
+    return(np.stack(lwt, axis = 1))
+
+def constants(phi, lon, geometry = GEOMETRY_DEFAULT):
     """
     Computing values of constants dependant on latitude and longitude
     They represent the constants referred to the relative differences
     between the grid-point spacing in the E-W and N-S direction
+    Other stencil geometries also rescale the differences to the units of
+    the original geometry (the values are unchanged for the default geometry)
     
-    :param phi: values of central latitude gridpoints
+    :param phi: values of central latitude gridpoints (2-D on curvilinear grids)
     :param lon: longitude values
+    :param geometry: (latitude step, longitude step) of the stencil in degrees, default (5, 10)
     """
+    lat_step = geometry[0]
+    fw, fs = geometry_factors(geometry)
+    if np.ndim(phi) == 2:
+        #Curvilinear grids: a latitude value for every central point
+        phi = np.deg2rad(np.asarray(phi, dtype = float))
+        sc = 1/np.cos(phi)
+        zwa = np.sin(phi) / np.sin(phi - np.deg2rad(lat_step))
+        zwb = np.sin(phi) / np.sin(phi + np.deg2rad(lat_step))
+        zsc = 1/(2*(np.cos(phi)**2))
+        if tuple(geometry) != GEOMETRY_DEFAULT:
+            sc, zwa, zwb, zsc = sc * fs, zwa * fw**2, zwb * fw**2, zsc * fs**2
+        return (sc, zwa, zwb, zsc)
     SC = 1/np.cos(np.deg2rad(phi))
     SC.name="longitue"
     sc=xr.concat([SC]*len(lon),'logitude').T
 
-    ZWA = np.sin(np.deg2rad(phi)) / np.sin (np.deg2rad(phi - 5))
+    ZWA = np.sin(np.deg2rad(phi)) / np.sin (np.deg2rad(phi - lat_step))
     ZWA.name="longitue"
     zwa=xr.concat([ZWA]*len(lon),'logitude').T
 
-    ZWB = np.sin(np.deg2rad(phi)) / np.sin (np.deg2rad(phi + 5))
+    ZWB = np.sin(np.deg2rad(phi)) / np.sin (np.deg2rad(phi + lat_step))
     ZWB.name="longitue"
     zwb=xr.concat([ZWB]*len(lon),'logitude').T
 
     ZSC = (1/(2*(np.cos(np.deg2rad(phi))**2)))
     ZSC.name="longitue"
     zsc=xr.concat([ZSC]*len(lon),'logitude').T
+    if tuple(geometry) != GEOMETRY_DEFAULT:
+        sc, zwa, zwb, zsc = sc * fs, zwa * fw**2, zwb * fw**2, zsc * fs**2
     return (sc, zwa, zwb, zsc)
 
 def direction_def_NH(deg_used):
@@ -144,472 +833,36 @@ def assign_lwt(F_i, Z_i, direction_i):
 
     return lwt,Z_i
 
-def extracting_gridpoints_rean_area(mslp, lat, lon):
-    """
-    This function extracts the 16 moving gridded points over a defined area (not globe)
-    given a Reanalysis (ERA5 or ERA20). This gridpoints are
-    neccesary for the computation of the terms
-    """
-    #Gridpoint 1
-    lat1 = lat+10
-    lon1 = lon-5
-    lat1 = lat.sel(latitude = lat1, method = 'nearest')        
-    lon1 = lon.sel(longitude = lon1, method = 'nearest')     
-    p1 = np.array(mslp.sel(latitude = lat1, longitude = lon1))
-    #Gridpoint 2
-    lat2 = lat + 10
-    lon2 = lon + 5
-    lat2 = lat.sel(latitude = lat2, method = 'nearest')        
-    lon2 = lon.sel(longitude = lon2, method = 'nearest')     
-    p2 = np.array(mslp.sel(latitude = lat2, longitude = lon2))
-    #Gridpoint 3
-    lat3 = lat + 5
-    lon3 = lon - 15
-    lat3 = lat.sel(latitude = lat3, method = 'nearest')        
-    lon3 = lon.sel(longitude = lon3, method = 'nearest')     
-    p3 = np.array(mslp.sel(latitude = lat3, longitude = lon3))
-    #Gridpoint 4
-    lat4 = lat + 5
-    lon4 = lon  -5
-    lat4 = lat.sel(latitude = lat4, method = 'nearest')        
-    lon4 = lon.sel(longitude = lon4, method = 'nearest')     
-    p4 = np.array(mslp.sel(latitude = lat4, longitude = lon4))
-    #Gridpoint 5
-    lat5 = lat + 5
-    lon5 = lon + 5
-    lat5 = lat.sel(latitude = lat5, method = 'nearest')        
-    lon5 = lon.sel(longitude = lon5, method = 'nearest')     
-    p5 = np.array(mslp.sel(latitude = lat5, longitude = lon5))
-    #Gridpoint 6
-    lat6 = lat + 5
-    lon6 = lon + 15
-    lat6 = lat.sel(latitude = lat6, method = 'nearest')        
-    lon6 = lon.sel(longitude = lon6, method = 'nearest')     
-    p6 = np.array(mslp.sel(latitude = lat6, longitude = lon6))
-    #Gridpoint 7
-    lat7 = lat
-    lon7 = lon - 15
-    lat7 = lat.sel(latitude = lat7, method = 'nearest')        
-    lon7 = lon.sel(longitude = lon7, method = 'nearest')     
-    p7 = np.array(mslp.sel(latitude = lat7, longitude = lon7))
-    #Gridpoint 8
-    lat8 = lat
-    lon8 = lon -5
-    lat8 = lat.sel(latitude = lat8, method = 'nearest')        
-    lon8 = lon.sel(longitude = lon8, method = 'nearest')     
-    p8 = np.array(mslp.sel(latitude = lat8, longitude = lon8))
-    #Gridpoint 9
-    lat9 = lat
-    lon9 = lon + 5
-    lat9 = lat.sel(latitude = lat9, method = 'nearest')        
-    lon9 = lon.sel(longitude = lon9, method = 'nearest')     
-    p9 = np.array(mslp.sel(latitude = lat9, longitude = lon9))
-    #Gridpoint 10
-    lat10 = lat
-    lon10 = lon + 15
-    lat10 = lat.sel(latitude = lat10, method = 'nearest')        
-    lon10 = lon.sel(longitude = lon10, method = 'nearest')     
-    p10 = np.array(mslp.sel(latitude = lat10, longitude = lon10))
-    #Gridpoint 11
-    lat11 = lat - 5
-    lon11 = lon - 15
-    lat11 = lat.sel(latitude = lat11, method = 'nearest')        
-    lon11 = lon.sel(longitude = lon11, method = 'nearest')     
-    p11 = np.array(mslp.sel(latitude = lat11, longitude = lon11))
-    #Gridpoint 12
-    lat12 = lat - 5
-    lon12 = lon - 5
-    lat12 = lat.sel(latitude = lat12, method = 'nearest')        
-    lon12 = lon.sel(longitude = lon12, method = 'nearest')     
-    p12 = np.array(mslp.sel(latitude = lat12, longitude = lon12))
-    #Gridpoint 13
-    lat13 = lat - 5
-    lon13 = lon + 5
-    lat13 = lat.sel(latitude = lat13, method = 'nearest')        
-    lon13 = lon.sel(longitude = lon13, method = 'nearest')     
-    p13 = np.array(mslp.sel(latitude = lat13, longitude = lon13))
-    #Gridpoint 14
-    lat14 = lat - 5
-    lon14 = lon + 15
-    lat14 = lat.sel(latitude = lat14, method = 'nearest')        
-    lon14 = lon.sel(longitude = lon14, method = 'nearest')    
-    p14 = np.array(mslp.sel(latitude = lat14, longitude = lon14))
-    #Gridpoint 15
-    lat15 = lat - 10
-    lon15 = lon - 5
-    lat15 = lat.sel(latitude = lat15, method = 'nearest')        
-    lon15 = lon.sel(longitude = lon15, method = 'nearest')       
-    p15 = np.array(mslp.sel(latitude = lat15, longitude = lon15))
-    #Gridpoint 16
-    lat16 = lat - 10
-    lon16 = lon + 5
-    lat16 = lat.sel(latitude = lat16, method = 'nearest')        
-    lon16 = lon.sel(longitude = lon16, method = 'nearest')       
-    p16 = np.array(mslp.sel(latitude = lat16, longitude = lon16))
-    return (p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16)
-
-    
-def extracting_gridpoints_gcm_area(mslp, lat, lon):
-    """
-    This function extracts the 16 moving gridded points over a defined area (not globe)
-    given a Global Climate Model Dataset. This gridpoints are
-    neccesary for the computation of the terms
-    """
-    #Gridpoint 1
-    lat1 = lat+10
-    lon1 = lon-5
-    lat1 = lat.sel(lat = lat1, method = 'nearest')        
-    lon1 = lon.sel(lon = lon1, method = 'nearest')     
-    p1 = np.array(mslp.sel(lat = lat1, lon = lon1))
-    #Gridpoint 2
-    lat2 = lat + 10
-    lon2 = lon + 5
-    lat2 = lat.sel(lat = lat2, method = 'nearest')        
-    lon2 = lon.sel(lon = lon2, method = 'nearest')    
-    p2 = np.array(mslp.sel(lat = lat2, lon = lon2))
-    #Gridpoint 3
-    lat3 = lat + 5
-    lon3 = lon - 15
-    lat3 = lat.sel(lat = lat3, method = 'nearest')        
-    lon3 = lon.sel(lon = lon3, method = 'nearest')    
-    p3 = np.array(mslp.sel(lat = lat3, lon = lon3))
-    #Gridpoint 4
-    lat4 = lat + 5
-    lon4 = lon  -5
-    lat4 = lat.sel(lat = lat4, method = 'nearest')        
-    lon4 = lon.sel(lon = lon4, method = 'nearest')    
-    p4 = np.array(mslp.sel(lat = lat4, lon = lon4))
-    #Gridpoint 5
-    lat5 = lat + 5
-    lon5 = lon + 5
-    lat5 = lat.sel(lat = lat5, method = 'nearest')        
-    lon5 = lon.sel(lon = lon5, method = 'nearest')    
-    p5 = np.array(mslp.sel(lat = lat5, lon = lon5))
-    #Gridpoint 6
-    lat6 = lat + 5
-    lon6 = lon + 15
-    lat6 = lat.sel(lat = lat6, method = 'nearest')        
-    lon6 = lon.sel(lon = lon6, method = 'nearest')    
-    p6 = np.array(mslp.sel(lat = lat6, lon = lon6))
-    #Gridpoint 7
-    lat7 = lat
-    lon7 = lon - 15
-    lat7 = lat.sel(lat = lat7, method = 'nearest')        
-    lon7 = lon.sel(lon = lon7, method = 'nearest')    
-    p7 = np.array(mslp.sel(lat = lat7, lon = lon7))
-    #Gridpoint 8
-    lat8 = lat
-    lon8 = lon -5
-    lat8 = lat.sel(lat = lat8, method = 'nearest')        
-    lon8 = lon.sel(lon = lon8, method = 'nearest')    
-    p8 = np.array(mslp.sel(lat = lat8, lon = lon8))
-    #Gridpoint 9
-    lat9 = lat
-    lon9 = lon + 5
-    lat9 = lat.sel(lat = lat9, method = 'nearest')        
-    lon9 = lon.sel(lon = lon9, method = 'nearest')    
-    p9 = np.array(mslp.sel(lat = lat9, lon = lon9))
-    #Gridpoint 10
-    lat10 = lat
-    lon10 = lon + 15
-    lat10 = lat.sel(lat = lat10, method = 'nearest')        
-    lon10 = lon.sel(lon = lon10, method = 'nearest')    
-    p10 = np.array(mslp.sel(lat = lat10, lon = lon10))
-    #Gridpoint 11
-    lat11 = lat - 5
-    lon11 = lon - 15
-    lat11 = lat.sel(lat = lat11, method = 'nearest')        
-    lon11 = lon.sel(lon = lon11, method = 'nearest')    
-    p11 = np.array(mslp.sel(lat = lat11, lon = lon11))
-    #Gridpoint 12
-    lat12 = lat - 5
-    lon12 = lon - 5
-    lat12 = lat.sel(lat = lat12, method = 'nearest')        
-    lon12 = lon.sel(lon = lon12, method = 'nearest')    
-    p12 = np.array(mslp.sel(lat = lat12, lon = lon12))
-    #Gridpoint 13
-    lat13 = lat - 5
-    lon13 = lon + 5
-    lat13 = lat.sel(lat = lat13, method = 'nearest')        
-    lon13 = lon.sel(lon = lon13, method = 'nearest')    
-    p13 = np.array(mslp.sel(lat = lat13, lon = lon13))
-    #Gridpoint 14
-    lat14 = lat - 5
-    lon14 = lon + 15
-    lat14 = lat.sel(lat = lat14, method = 'nearest')        
-    lon14 = lon.sel(lon = lon14, method = 'nearest')    
-    p14 = np.array(mslp.sel(lat = lat14, lon = lon14))
-    #Gridpoint 15
-    lat15 = lat - 10
-    lon15 = lon - 5
-    lat15 = lat.sel(lat = lat15, method = 'nearest')        
-    lon15 = lon.sel(lon = lon15, method = 'nearest')    
-    p15 = np.array(mslp.sel(lat = lat15, lon = lon15))
-    #Gridpoint 16
-    lat16 = lat - 10
-    lon16 = lon + 5
-    lat16 = lat.sel(lat = lat16, method = 'nearest')        
-    lon16 = lon.sel(lon = lon16, method = 'nearest')    
-    p16 = np.array(mslp.sel(lat = lat16, lon = lon16))
-    return (p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16)
+def flows(gridpoints, sc, zwa, zsc, zwb, wc = 1):
+    """
+    This function computes the indices associated with the direction and vorticity
+    of geostrophic flow from the 16 gridpoints of MSLP (p1 to p16)
+    More info: Jones, P. D., Hulme, M., & Briffa, K. R. (1993). 
+    A comparison of Lamb circulation types with an objective classification scheme.  
+    International Journal of Climatology(6), 655–663. https://doi.org/10.1002/joc.3370130606
     
+    Works with arrays of any shape, the latitude dependant constants are
+    broadcast against the last dimensions (latitude and longitude).
 
-
-def extracting_gridpoints_rean_globe(mslp, lat, lon):
-    """
-    This function extracts the 16 moving gridded points over the whole globe
-    given a Reanalysis dataset (ERA5 or ERA20). This gridpoints are
-    neccesary for the computationo of the terms
-    """
-    #Gridpoint 1
-    lat1 = lat + 10
-    lon1 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat1 = lat.sel(latitude = lat1, method = 'nearest')        
-    lon1 = lon.sel(longitude = lon1, method = 'nearest')     
-    p1 = np.array(mslp.sel(latitude = lat1, longitude = lon1))
-
-    #Gridpoint 2
-    lat2 = lat + 10
-    lon2 = xr.where(lon>175, lon+5-360, lon+5)
-    lon2 = xr.where(lon2 == 180, -180, lon2)
-    lat2 = lat.sel(latitude = lat2, method = 'nearest')        
-    lon2 = lon.sel(longitude = lon2, method = 'nearest')     
-    p2 = np.array(mslp.sel(latitude = lat2, longitude = lon2))
-
-    #Gridpoint 3
-    lat3 = lat + 5
-    lon3 = xr.where(lon<-165, 360+lon-15, lon-15)
-    lat3 = lat.sel(latitude = lat3, method = 'nearest')        
-    lon3 = lon.sel(longitude = lon3, method = 'nearest')     
-    p3 = np.array(mslp.sel(latitude = lat3, longitude = lon3))
-
-    #Gridpoint 4
-    lat4 = lat + 5
-    lon4 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat4 = lat.sel(latitude = lat4, method = 'nearest')        
-    lon4 = lon.sel(longitude = lon4, method = 'nearest')     
-    p4 = np.array(mslp.sel(latitude = lat4, longitude = lon4))
-
-    #Gridpoint 5
-    lat5 = lat + 5
-    lon5 = xr.where(lon>175, lon+5-360, lon+5)
-    lon5 = xr.where(lon5 == 180, -180, lon5)
-    lat5 = lat.sel(latitude = lat5, method = 'nearest')        
-    lon5 = lon.sel(longitude = lon5, method = 'nearest')     
-    p5 = np.array(mslp.sel(latitude = lat5, longitude = lon5))
-
-    #Gridpoint 6
-    lat6 = lat + 5
-    lon6 = xr.where(lon>165, lon+15-360,lon+15)
-    lon6 = xr.where(lon6 == 180, -180, lon6)
-    lat6 = lat.sel(latitude = lat6, method = 'nearest')        
-    lon6 = lon.sel(longitude = lon6, method = 'nearest')     
-    p6 = np.array(mslp.sel(latitude = lat6, longitude = lon6))
-
-    #Gridpoint 7
-    lat7 = lat
-    lon7 = xr.where(lon<-165, 360+lon-15, lon-15)
-    lat7 = lat.sel(latitude = lat7, method = 'nearest')        
-    lon7 = lon.sel(longitude = lon7, method = 'nearest')     
-    p7 = np.array(mslp.sel(latitude = lat7, longitude = lon7))
-
-    #Gridpoint 8
-    lat8 = lat
-    lon8 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat8 = lat.sel(latitude = lat8, method = 'nearest')        
-    lon8 = lon.sel(longitude = lon8, method = 'nearest')     
-    p8 = np.array(mslp.sel(latitude = lat8, longitude = lon8))
-
-    #Gridpoint 9
-    lat9 = lat
-    lon9 = xr.where(lon>175, lon+5-360, lon+5)
-    lon9 = xr.where(lon9 == 180, -180, lon9)
-    lat9 = lat.sel(latitude = lat9, method = 'nearest')        
-    lon9 = lon.sel(longitude = lon9, method = 'nearest')     
-    p9 = np.array(mslp.sel(latitude = lat9, longitude = lon9))
-
-    #Gridpoint 10
-    lat10 = lat
-    lon10 = xr.where(lon>165, lon+15-360, lon+15)
-    lon10 = xr.where(lon10 == 180, -180, lon10)
-    lat10 = lat.sel(latitude = lat10, method = 'nearest')        
-    lon10 = lon.sel(longitude = lon10, method = 'nearest')     
-    p10 = np.array(mslp.sel(latitude = lat10, longitude = lon10))
-
-    #Gridpoint 11
-    lat11 = lat - 5
-    lon11 = xr.where(lon<-165, 360+lon-15, lon-15)
-    lat11 = lat.sel(latitude = lat11, method = 'nearest')        
-    lon11 = lon.sel(longitude = lon11, method = 'nearest')     
-    p11 = np.array(mslp.sel(latitude = lat11, longitude = lon11))
-
-    #Gridpoint 12
-    lat12 = lat - 5
-    lon12 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat12 = lat.sel(latitude = lat12, method = 'nearest')        
-    lon12 = lon.sel(longitude = lon12, method = 'nearest')     
-    p12 = np.array(mslp.sel(latitude = lat12, longitude = lon12))
-
-    #Gridpoint 13
-    lat13 = lat - 5 
-    lon13 = xr.where(lon>175, lon+5-360, lon+5)
-    lon13 = xr.where(lon13 == 180, -180, lon13)
-    lat13 = lat.sel(latitude = lat13, method = 'nearest')        
-    lon13 = lon.sel(longitude = lon13, method = 'nearest')     
-    p13 = np.array(mslp.sel(latitude = lat13, longitude = lon13))
-
-    #Gridpoint 14
-    lat14 = lat - 5
-    lon14 = xr.where(lon>165, lon+15-360, lon+15)
-    lon14 = xr.where(lon14 == 180, -180, lon14) 
-    lat14 = lat.sel(latitude = lat14, method = 'nearest')        
-    lon14 = lon.sel(longitude = lon14, method = 'nearest')     
-    p14 = np.array(mslp.sel(latitude = lat14, longitude = lon14))
-
-    #Gridpoint 15
-    lat15 = lat - 10
-    lon15 = xr.where(lon<-175, 360+lon-5, lon-5) 
-    lat15 = lat.sel(latitude = lat15, method = 'nearest')        
-    lon15 = lon.sel(longitude = lon15, method = 'nearest')     
-    p15 = np.array(mslp.sel(latitude = lat15, longitude = lon15))
-
-    #Gridpoint 16
-    lat16 = lat - 10
-    lon16 = xr.where(lon>175, lon+5-360, lon+5)
-    lon16 = xr.where(lon16 == 180, -180, lon16)
-    lat16 = lat.sel(latitude = lat16, method = 'nearest')        
-    lon16 = lon.sel(longitude = lon16, method = 'nearest')     
-    p16 = np.array(mslp.sel(latitude = lat16, longitude = lon16))
-    
-    return (p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16)
-
-def extracting_gridpoints_gcm_globe(mslp, lat, lon):
-    """
-    This function extracts the 16 moving gridded points over the whole globe
-    given a Global Climate Model dataset. These gridpoints are
-    neccesary for the computation fo the terms
-    """
-    #Gridpoint 1
-    lat1 = lat + 10
-    lon1 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat1 = lat.sel(lat = lat1, method = 'nearest')        
-    lon1 = lon.sel(lon = lon1, method = 'nearest')    
-    p1 = np.array(mslp.sel(lat = lat1, lon = lon1))
-
-    #Gridpoint 2
-    lat2 = lat + 10
-    lon2 = xr.where(lon>175, lon+5-360, lon+5)
-    lon2 = xr.where(lon2 == 180, -180, lon2)
-    lat2 = lat.sel(lat = lat2, method = 'nearest')        
-    lon2 = lon.sel(lon = lon2, method = 'nearest')    
-    p2 = np.array(mslp.sel(lat = lat2, lon = lon2))
-
-    #Gridpoint 3
-    lat3 = lat + 5
-    lon3 = xr.where(lon<-165, 360+lon-15, lon-15)
-    lat3 = lat.sel(lat = lat3, method = 'nearest')        
-    lon3 = lon.sel(lon = lon3, method = 'nearest')    
-    p3 = np.array(mslp.sel(lat = lat3, lon = lon3))
-
-    #Gridpoint 4
-    lat4 = lat + 5
-    lon4 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat4 = lat.sel(lat = lat4, method = 'nearest')        
-    lon4 = lon.sel(lon = lon4, method = 'nearest')    
-    p4 = np.array(mslp.sel(lat = lat4, lon = lon4))
-
-    #Gridpoint 5
-    lat5 = lat + 5
-    lon5 = xr.where(lon>175, lon+5-360, lon+5)
-    lon5 = xr.where(lon5 == 180, -180, lon5)
-    lat5 = lat.sel(lat = lat5, method = 'nearest')        
-    lon5 = lon.sel(lon = lon5, method = 'nearest')    
-    p5 = np.array(mslp.sel(lat = lat5, lon = lon5))
-
-    #Gridpoint 6
-    lat6 = lat + 5
-    lon6 = xr.where(lon>165, lon+15-360,lon+15)
-    lon6 = xr.where(lon6 == 180, -180, lon6)
-    lat6 = lat.sel(lat = lat6, method = 'nearest')        
-    lon6 = lon.sel(lon = lon6, method = 'nearest')    
-    p6 = np.array(mslp.sel(lat = lat6, lon = lon6))
-
-    #Gridpoint 7
-    lat7 = lat
-    lon7 = xr.where(lon<-165, 360+lon-15, lon-15)
-    lat7 = lat.sel(lat = lat7, method = 'nearest')        
-    lon7 = lon.sel(lon = lon7, method = 'nearest')    
-    p7 = np.array(mslp.sel(lat = lat7, lon = lon7))
-
-    #Gridpoint 8
-    lat8 = lat
-    lon8 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat8 = lat.sel(lat = lat8, method = 'nearest')        
-    lon8 = lon.sel(lon = lon8, method = 'nearest')    
-    p8 = np.array(mslp.sel(lat = lat8, lon = lon8))
-
-    #Gridpoint 9
-    lat9 = lat
-    lon9 = xr.where(lon>175, lon+5-360, lon+5)
-    lon9 = xr.where(lon9 == 180, -180, lon9)
-    lat9 = lat.sel(lat = lat9, method = 'nearest')        
-    lon9 = lon.sel(lon = lon9, method = 'nearest')    
-    p9 = np.array(mslp.sel(lat = lat9, lon = lon9))
-
-    #Gridpoint 10
-    lat10 = lat
-    lon10 = xr.where(lon>165, lon+15-360, lon+15)
-    lon10 = xr.where(lon10 == 180, -180, lon10)
-    lat10 = lat.sel(lat = lat10, method = 'nearest')        
-    lon10 = lon.sel(lon = lon10, method = 'nearest')    
-    p10 = np.array(mslp.sel(lat = lat10, lon = lon10))
-
-    #Gridpoint 11
-    lat11 = lat - 5
-    lon11 = xr.where(lon<-165, 360+lon-15, lon-15)
-    lat11 = lat.sel(lat = lat11, method = 'nearest')        
-    lon11 = lon.sel(lon = lon11, method = 'nearest')    
-    p11 = np.array(mslp.sel(lat = lat11, lon = lon11))
-
-    #Gridpoint 12
-    lat12 = lat - 5
-    lon12 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat12 = lat.sel(lat = lat12, method = 'nearest')        
-    lon12 = lon.sel(lon = lon12, method = 'nearest')    
-    p12 = np.array(mslp.sel(lat = lat12, lon = lon12))
-
-    #Gridpoint 13
-    lat13 = lat - 5 
-    lon13 = xr.where(lon>175, lon+5-360, lon+5)
-    lon13 = xr.where(lon13 == 180, -180, lon13)
-    lat13 = lat.sel(lat = lat13, method = 'nearest')        
-    lon13 = lon.sel(lon = lon13, method = 'nearest')    
-    p13 = np.array(mslp.sel(lat = lat13, lon = lon13))
-
-    #Gridpoint 14
-    lat14 = lat - 5
-    lon14 = xr.where(lon>165, lon+15-360, lon+15)
-    lon14 = xr.where(lon14 == 180, -180, lon14)
-    lat14 = lat.sel(lat = lat14, method = 'nearest')        
-    lon14 = lon.sel(lon = lon14, method = 'nearest')    
-    p14 = np.array(mslp.sel(lat = lat14, lon = lon14))
-
-    #Gridpoint 15
-    lat15 = lat - 10
-    lon15 = xr.where(lon<-175, 360+lon-5, lon-5)
-    lat15 = lat.sel(lat = lat15, method = 'nearest')        
-    lon15 = lon.sel(lon = lon15, method = 'nearest')    
-    p15 = np.array(mslp.sel(lat = lat15, lon = lon15))
-
-    #Gridpoint 16
-    lat16 = lat - 10
-    lon16 = xr.where(lon>175, lon+5-360, lon+5)
-    lon16 = xr.where(lon16 == 180, -180, lon16)
-    lat16 = lat.sel(lat = lat16, method = 'nearest')        
-    lon16 = lon.sel(lon = lon16, method = 'nearest')    
-    p16 = np.array(mslp.sel(lat = lat16, lon = lon16))
-    
-    return (p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16)
+    :param gridpoints: tuple of the 16 gridpoints of MSLP (p1 to p16)
+    :param sc, zwa, zsc, zwb: latitude dependant constants
+    :param wc: factor of the westerly flow of other stencil geometries (see geometry_factors)
+    :return: W, S, F, ZW, ZS and Z as numpy arrays
+    """
+    p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16 = gridpoints
+    #Westerly Flow
+    W = wc * (((0.5)*( p12 + p13 )) - ((0.5)*( p4 + p5 )))
+    #Southerly Flow
+    S = np.array(sc)*(((0.25)*(p5 + (2 * p9) + p13)) - ((0.25)*(p4 + (2 * p8) + p12)))
+    #Resultant Flow 
+    F = np.sqrt(S**2 + W**2)
+    #Westerly Shear Vorticity
+    ZW = (np.array(zwa)*( (0.5)*(p15 + p16) - (0.5)*(p8 + p9))) - (np.array(zwb)*((0.5)*(p8 + p9) - (0.5)*(p1 + p2)))
+    #Southerly Shear Vorticity
+    ZS = np.array(zsc) * ( ((0.25)*(p6 + (2 * p10) + p14)) - ((0.25)*(p5 + (2 * p9) + p13)) -((0.25)*(p4 + (2 * p8) + p12)) +((0.25)*(p3 + (2 * p7) + p11)) )
+    #Total Shear Vorticity
+    Z = ZW + ZS
+    return(W, S, F, ZW, ZS, Z)
 
 def flows_rean(p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, sc, zwa, zsc, zwb, lat, lon, time, mslp):
     """
@@ -629,52 +882,14 @@ def flows_rean(p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15,
     This can be used for subseasonal forecasts coming from 
     the Climate Data Store: https://cds.climate.copernicus.eu/cdsapp#!/home
     """
-    #Westerly Flow
-    W = ((0.5)*( p12 + p13 )) - ((0.5)*( p4 + p5 ))
-    if mslp.dims[1] == 'latitude':
-        W = xr.DataArray(W, 
-                          coords = {'time': time, 'latitude':lat, 'longitude':lon}, 
-                          dims = ['time', 'latitude', 'longitude'])
-    elif mslp.dims[1] == 'number':
-        W = xr.DataArray(W, 
-                          coords = {'time': time, 'number':mslp.number ,'latitude':lat, 'longitude':lon}, 
-                          dims = ['time','number' ,'latitude', 'longitude'])
-        
-    #Southerly Flow
-    S = np.array(sc)*(((0.25)*(p5 + (2 * p9) + p13)) - ((0.25)*(p4 + (2 * p8) + p12)))
-    if mslp.dims[1] == 'latitude':
-        S = xr.DataArray(S, 
-                          coords = {'time': time, 'latitude':lat, 'longitude':lon}, 
-                          dims = ['time', 'latitude', 'longitude'])
-    elif mslp.dims[1] == 'number':
-        S = xr.DataArray(S, 
-                          coords = {'time': time, 'number':mslp.number ,'latitude':lat, 'longitude':lon}, 
-                          dims = ['time','number', 'latitude', 'longitude'])        
-    #Resultant Flow 
-    F = np.sqrt(S**2 + W**2)
-    #Westerly Shear Vorticity
-    ZW = (np.array(zwa)*( (0.5)*(p15 + p16) - (0.5)*(p8 + p9))) - (np.array(zwb)*((0.5)*(p8 + p9) - (0.5)*(p1 + p2)))
     if mslp.dims[1] == 'latitude':
-        ZW = xr.DataArray(ZW, 
-                          coords = {'time': time, 'latitude':lat, 'longitude':lon}, 
-                          dims = ['time', 'latitude', 'longitude'])
+        coords = {'time': time, 'latitude':lat, 'longitude':lon}
+        dims = ['time', 'latitude', 'longitude']
     elif mslp.dims[1] == 'number':
-        ZW = xr.DataArray(ZW, 
-                              coords = {'time': time, 'number':mslp.number ,'latitude':lat, 'longitude':lon}, 
-                              dims = ['time', 'number', 'latitude', 'longitude'])        
-    #Southerly Shear Vorticity
-    ZS = np.array(zsc) * ( ((0.25)*(p6 + (2 * p10) + p14)) - ((0.25)*(p5 + (2 * p9) + p13)) -((0.25)*(p4 + (2 * p8) + p12)) +((0.25)*(p3 + (2 * p7) + p11)) )
-    #Total Shear Vorticity
-    if mslp.dims[1] == 'latitude':    
-        ZS = xr.DataArray(ZS, 
-                          coords = {'time': time, 'latitude':lat, 'longitude':lon}, 
-                          dims = ['time', 'latitude', 'longitude'])
-    elif mslp.dims[1] == 'number':
-        ZS = xr.DataArray(ZS, 
-                          coords = {'time': time,'number':mslp.number ,'latitude':lat, 'longitude':lon}, 
-                          dims = ['time', 'number', 'latitude', 'longitude'])
-        
-    Z = ZW + ZS
+        coords = {'time': time, 'number':mslp.number ,'latitude':lat, 'longitude':lon}
+        dims = ['time','number' ,'latitude', 'longitude']
+    terms = flows((p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16), sc, zwa, zsc, zwb)
+    W, S, F, ZW, ZS, Z = [xr.DataArray(term, coords = coords, dims = dims) for term in terms]
     return(W, S, F, ZW, ZS, Z)
     
 def flows_gcm(p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, sc, zwa, zsc, zwb, lat, lon, time):
@@ -690,28 +905,8 @@ def flows_gcm(p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15,
     - The latitude dependant constants (sc, zwa, zsc  and zwb)
     - latitude, longitude, time and MSLP data
     """    
-    W = ((0.5)*( p12 + p13 )) - ((0.5)*( p4 + p5 ))
-    W = xr.DataArray(W, 
-                      coords = {'time': time, 'lat':lat, 'lon':lon}, 
-                      dims = ['time', 'lat', 'lon'])
-    #Southerly Flow
-    S = np.array(sc)*(((0.25)*(p5 + (2 * p9) + p13)) - ((0.25)*(p4 + (2 * p8) + p12)))
-    S = xr.DataArray(S, 
-                      coords = {'time': time, 'lat':lat, 'lon':lon}, 
-                      dims = ['time', 'lat', 'lon'])
-    #Resultant Flow 
-    F = np.sqrt(S**2 + W**2)
-    #Westerly Shear Vorticity
-    ZW = (np.array(zwa)*( (0.5)*(p15 + p16) - (0.5)*(p8 + p9))) - (np.array(zwb)*((0.5)*(p8 + p9) - (0.5)*(p1 + p2)))
-    ZW = xr.DataArray(ZW, 
-                      coords = {'time': time, 'lat':lat, 'lon':lon}, 
-                      dims = ['time', 'lat', 'lon'])
-    #Southerly Shear Vorticity
-    ZS = np.array(zsc) * ( ((0.25)*(p6 + (2 * p10) + p14)) - ((0.25)*(p5 + (2 * p9) + p13)) -((0.25)*(p4 + (2 * p8) + p12)) +((0.25)*(p3 + (2 * p7) + p11)) )
-    #Total Shear Vorticity 
-    ZS = xr.DataArray(ZS, 
-                      coords = {'time': time, 'lat':lat, 'lon':lon}, 
-                      dims = ['time', 'lat', 'lon'])
-    Z = ZW + ZS
+    terms = flows((p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16), sc, zwa, zsc, zwb)
+    W, S, F, ZW, ZS, Z = [xr.DataArray(term, coords = {'time': time, 'lat':lat, 'lon':lon}, dims = ['time', 'lat', 'lon'])
+                          for term in terms]
     return(W, S, F, ZW, ZS, Z)
 
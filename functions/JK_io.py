@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import os
+import glob
+import json
+import threading
+import queue
+import time as timer
+import functools
+import numpy as np
+import xarray as xr
+import JK_functions
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks
+
+#Lock of xarray for the netCDF and HDF5 libraries, also taken when writing with netCDF4
+NETCDF_LOCK = combine_locks([NETCDFC_LOCK, HDF5_LOCK])
+
+def input_files(filename):
+    """
+    This function lists the MSLP files to be classified as one record.
+
+    :param filename: str. name and directory of the MSLP file, a glob pattern
+                     (e.g. "psl_day_EC-Earth3_ssp585_*.nc") or a list of filenames
+    :return: list of filenames
+    """
+    if type(filename) == str:
+        if glob.has_magic(filename):
+            files = sorted(glob.glob(filename))
+        else:
+            files = [filename]
+    elif type(filename) in (list, tuple) and all(type(f) == str for f in filename):
+        files = list(filename)
+    else:
+        raise TypeError("Incorrect filename directory. Only strings or lists of strings allowed")
+    if len(files) == 0:
+        raise FileNotFoundError('No files found matching ' + str(filename))
+    return(files)
+
+#Standard gravity (m s-2), converting geopotential to geopotential height
+GRAVITY = 9.80665
+#Fields that can be classified and the default scale of their values: MSLP in Pa is divided by 100 (hPa),
+#geopotential (m2 s-2, e.g. ERA5 "z") and geopotential height (m, e.g. CMIP6 "zg") are classified
+#in geopotential decametres (1 dam is close to 1.2 hPa near the surface)
+FIELDS = {'mslp': ('mean sea level pressure', 100), 'geopotential': ('geopotential height', 10 * GRAVITY),
+          'height': ('geopotential height', 10)}
+#Names of the dimension of the vertical levels
+LEVEL_DIMS = ('level', 'plev', 'pressure_level', 'isobaricInhPa', 'lev')
+
+#Formats of the input files: netCDF files, Zarr stores and raw arrays (.npy files or
+#binary memory maps) with the coordinates in a JSON sidecar (see opening_array)
+BACKENDS = ('netcdf', 'zarr', 'array')
+ARRAY_EXTENSIONS = ('.npy', '.dat', '.raw')
+
+def input_backend(file, backend = None):
+    """
+    This function returns the format of an input file.
+
+    :param file: str. filename
+    :param backend: "netcdf", "zarr" or "array", default None guesses it from the name
+                    (directories and ".zarr" are Zarr stores, ".npy", ".dat" and ".raw" raw arrays)
+    :return: str. backend
+    """
+    if backend is None:
+        if file.rstrip('/').endswith('.zarr') or os.path.isdir(file):
+            backend = 'zarr'
+        elif file.endswith(ARRAY_EXTENSIONS):
+            backend = 'array'
+        else:
+            backend = 'netcdf'
+    if backend not in BACKENDS:
+        raise TypeError("Incorrect backend, only 'netcdf', 'zarr' or 'array' allowed")
+    return(backend)
+
+def sidecar_coordinate(values):
+    """
+    This function reads a coordinate of a JSON sidecar.
+
+    :param values: list of values (ISO dates for the time), {"start", "step", "size"} for regular
+                   coordinates, or {"values", "dims", "units", "calendar"} (e.g. encoded times or 2-D latitudes)
+    :return: (dims, values, attributes), dims None for 1-D coordinates
+    """
+    if type(values) != dict:
+        return(None, values, {})
+    if 'start' in values:
+        return(None, values['start'] + values['step'] * np.arange(values['size']), {})
+    attrs = {name: values[name] for name in ('units', 'calendar') if name in values}
+    return(values.get('dims'), values['values'], attrs)
+
+def opening_array(file):
+    """
+    This function opens a raw array memory-mapped (nothing is loaded into memory), described
+    by a JSON sidecar with the same name (e.g. "msl_2020.npy" and "msl_2020.json"):
+    {"variable": "msl", "dims": ["time", "latitude", "longitude"],
+     "coords": {"time": ["2020-01-01", ...], "latitude": {"start": 70, "step": -0.25, "size": 161}, ...},
+     "attrs": {...}}
+    Binary memory maps without the .npy header also need "dtype" and "shape" (and optionally "offset").
+
+    :param file: str. filename of the array
+    :return: dataset in xarray format
+    """
+    sidecar = os.path.splitext(file)[0] + '.json'
+    if not os.path.exists(sidecar):
+        raise FileNotFoundError('No sidecar of coordinates found for ' + file + ' (' + sidecar + ')')
+    with open(sidecar) as f:
+        info = json.load(f)
+    if file.endswith('.npy'):
+        values = np.load(file, mmap_mode = 'r')
+    else:
+        values = np.memmap(file, dtype = info['dtype'], mode = 'r', offset = info.get('offset', 0),
+                           shape = tuple(info['shape']))
+    if values.ndim != len(info['dims']):
+        raise ValueError('The sidecar of ' + file + ' does not match the dimensions of the array')
+    coords = {}
+    for name, coordinate in info['coords'].items():
+        dims, points, attrs = sidecar_coordinate(coordinate)
+        if name == 'time' and 'units' not in attrs:
+            points = np.array(points, dtype = 'datetime64[ns]')
+        coords[name] = (dims or (name,), np.asarray(points), attrs)
+    DS = xr.Dataset({info.get('variable', 'msl'): (info['dims'], values, info.get('variable_attrs', {}))},
+                    coords = coords, attrs = info.get('attrs', {}))
+    return(xr.decode_cf(DS))
+
+def opening_file(file, backend = None):
+    """
+    This function opens an input file lazily (nothing is loaded into memory).
+
+    :param file: str. filename (or directory of a Zarr store)
+    :param backend: "netcdf", "zarr" or "array" (see input_backend), default None guesses it from the name
+    :return: dataset in xarray format
+    """
+    backend = input_backend(file, backend)
+    if backend == 'zarr':
+        #Without dask, the blocks are read straight from the store like the netCDF files
+        return(xr.open_dataset(file, engine = 'zarr', chunks = None))
+    if backend == 'array':
+        return(opening_array(file))
+    return(xr.open_dataset(file))
+
+def selecting_variable(DS, variable = None):
+    """
+    This function returns the variable of a dataset to be read.
+
+    :param DS: dataset in xarray format
+    :param variable: str. name of the variable, default None takes the only gridded data variable
+                     (bounds and grid mappings, e.g. "time_bnds" or "rotated_pole", are not counted).
+                     Raw arrays store the variable named in their sidecar only
+    :return: variable in xarray format
+    """
+    if variable is not None:
+        if variable not in DS.data_vars:
+            raise ValueError("Variable '" + variable + "' not found, the files store " + ', '.join(DS.data_vars))
+        return(DS[variable])
+    #Variables referenced as bounds or grid mappings of other variables
+    auxiliary = set()
+    for var in DS.variables.values():
+        for attribute in ('bounds', 'grid_mapping'):
+            auxiliary.update(str(var.attrs.get(attribute, var.encoding.get(attribute, ''))).split())
+    names = [name for name, var in DS.data_vars.items() if var.ndim >= 3 and name not in auxiliary and
+             not str(name).endswith(('_bnds', '_bounds'))]
+    if len(names) != 1:
+        raise ValueError('The files store ' + (', '.join(str(name) for name in DS.data_vars) or 'no variables') +
+                         ', use variable to name the variable to be read')
+    return(DS[names[0]])
+
+def opening_segments(files, variable, backend = None):
+    """
+    This function opens every file lazily (nothing is loaded into memory) and
+    returns the MSLP variable of each file as a time-ordered segment of the record.
+    The files are not concatenated, they are read one after the other.
+
+    :param files: list of filenames
+    :param variable: function returning the MSLP variable of a dataset
+    :param backend: format of the files (see input_backend), default None guesses it from every name
+    :return: list of segments in xarray format sorted by time, and the attributes of the first file
+    """
+    segments = []
+    for file in files:
+        DS = opening_file(file, backend)
+        if len(segments) == 0:
+            attrs = DS.attrs
+        segment = variable(DS)
+        DS.close()
+        if len(segment.time) > 0: #Files without time steps are skipped
+            segments.append(segment)
+    if len(segments) == 0:
+        raise ValueError('No time steps found in the files')
+    segments = sorted(segments, key = lambda segment: segment.time.values[0])
+    #Checking the calendars and the time order of the segments
+    calendars = set(getattr(segment.time.values[0], 'calendar', 'standard') for segment in segments)
+    if len(calendars) > 1:
+        raise ValueError('The files use different calendars: ' + ', '.join(sorted(calendars)))
+    for previous, segment in zip(segments[:-1], segments[1:]):
+        if segment.time.values[0] <= previous.time.values[-1]:
+            raise ValueError('Overlapping time steps between files at ' + str(segment.time.values[0]))
+    return(segments, attrs)
+
+def reading_block(mslp, start, end, scale = 100):
+    """
+    This function reads (and decompresses) a block of time steps of MSLP
+    and converts it to hPa.
+
+    :param mslp: mean sea level pressure data in xarray format (not loaded)
+    :param start, end: first and last (excluded) time index of the block
+    :param scale: the values are divided by scale (100 converts Pa to hPa)
+    :return: numpy array of the block
+    """
+    return(np.asarray(mslp[start:end].values) / scale)
+
+def reading_tile(mslp, start, end, rows, cols, scale = 100):
+    """
+    This function reads a block of time steps of MSLP on a tile of the grid
+    (its central points and halo) and converts it to hPa.
+
+    :param mslp: mean sea level pressure data in xarray format (not loaded), latitude and longitude last
+    :param start, end: first and last (excluded) time index of the block
+    :param rows, cols: consecutive grid indices of the tile (see JK_functions.tiling), the
+                       columns may wrap around the end of global grids
+    :param scale: the values are divided by scale (100 converts Pa to hPa)
+    :return: numpy array of the block
+    """
+    lat_dim, lon_dim = mslp.dims[-2:]
+    #Columns wrapping across the dateline are read as two runs
+    runs = np.split(cols, np.flatnonzero(np.diff(cols) != 1) + 1)
+    block = [np.asarray(mslp[start:end].isel({lat_dim: slice(rows[0], rows[-1] + 1),
+                                              lon_dim: slice(run[0], run[-1] + 1)}).values) for run in runs]
+    return(np.concatenate(block, axis = -1) / scale)
+
+def reading_days(segments, days, first, last, scale = 100, reading = None):
+    """
+    This function reads a block of days of sub-daily data and reduces the time steps of
+    every day (see JK_functions.daily_steps), so only the time steps of the block are read.
+    The days split across two files are read from both files.
+
+    :param segments: list of time-ordered segments (one per file) read as one record
+    :param days: reduction of the record to days (see JK_functions.daily_steps)
+    :param first, last: first and last (excluded) day of the block
+    :param scale: the values are divided by scale (100 converts Pa to hPa)
+    :param reading: function reading the time steps start to end of a segment, default reading_block
+                    (e.g. reading_tile of one tile)
+    :return: numpy array of the block of days
+    """
+    reading = reading or reading_block
+    bounds = np.append(days['starts'], len(days['steps']))
+    last = min(last, len(days['starts']))
+    steps = days['steps'][bounds[first]:bounds[last]]
+    offsets = np.cumsum([0] + [segment.shape[0] for segment in segments])
+    files = np.searchsorted(offsets, steps, side = 'right') - 1
+    #Consecutive time steps of the same file are read at once
+    runs = np.split(np.arange(len(steps)), np.flatnonzero((np.diff(steps) != 1) | (np.diff(files) != 0)) + 1)
+    block = np.concatenate([reading(segments[files[run[0]]], steps[run[0]] - offsets[files[run[0]]],
+                                    steps[run[-1]] + 1 - offsets[files[run[0]]], scale = scale) for run in runs])
+    valid = np.isfinite(block)
+    positions = bounds[first:last] - bounds[first]
+    sums = np.add.reduceat(np.where(valid, block, 0), positions, axis = 0, dtype = float)
+    counts = np.add.reduceat(valid, positions, axis = 0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return(sums / counts)
+
+def prefetch_blocks(mslp, block_size, depth = 2, scale = 100, days = None):
+    """
+    This function reads blocks of time steps of MSLP on a background thread,
+    so the next blocks are read and decompressed while the current one is
+    being classified. At most "depth" blocks are held in the queue.
+    The time spent waiting for the input is printed at the end.
+
+    :param mslp: mean sea level pressure data in xarray format (not loaded), or a list
+                 of time-ordered segments (one per file) read as one record
+    :param block_size: number of time steps per block
+    :param depth: number of blocks read in advance, 0 reads every block when needed
+    :param scale: the values are divided by scale (100 converts Pa to hPa)
+    :param days: reduction of sub-daily data to days (see JK_functions.daily_steps), the blocks are
+                 then blocks of days reduced while reading (see reading_days). Default None
+    :return: generator of (start, block) tuples in time order, start being the time index in the record
+    """
+    segments = mslp if type(mslp) == list else [mslp]
+    tasks = []
+    if days is not None:
+        #Blocks of days, a day split across two segments is read from both
+        for start in range(0, len(days['starts']), block_size):
+            tasks.append((start, functools.partial(reading_days, segments, days, start, start + block_size, scale)))
+    else:
+        #Blocks do not cross the boundaries between segments
+        offset = 0
+        for segment in segments:
+            for start in range(0, segment.shape[0], block_size):
+                tasks.append((offset + start, functools.partial(reading_block, segment, start, start + block_size, scale)))
+            offset += segment.shape[0]
+    waiting = 0.
+    if depth < 1:
+        for start, reading in tasks:
+            t0 = timer.perf_counter()
+            block = reading()
+            waiting += timer.perf_counter() - t0
+            yield start, block
+        print('Time waiting for input: ' + str(round(waiting, 2)) + ' s ⧗')
+        return
+    blocks = queue.Queue(maxsize = depth)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for start, reading in tasks:
+                if stop.is_set():
+                    return
+                blocks.put((start, reading()))
+        except Exception as error: #Raised again on the main thread
+            blocks.put((None, error))
+            return
+        blocks.put((None, None))
+
+    thread = threading.Thread(target = reader, daemon = True)
+    thread.start()
+    try:
+        while True:
+            t0 = timer.perf_counter()
+            start, block = blocks.get()
+            waiting += timer.perf_counter() - t0
+            if start is None:
+                if block is not None:
+                    raise block
+                break
+            yield start, block
+    finally:
+        #Releasing the reader if the classification stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get_nowait()
+            except queue.Empty:
+                thread.join(0.05)
+    print('Time waiting for input: ' + str(round(waiting, 2)) + ' s ⧗')
+
+#Flow terms that can be stored along with the circulation types
+DIAGNOSTICS = {'W': 'Westerly flow', 'S': 'Southerly flow', 'F': 'Resultant flow',
+               'ZW': 'Westerly shear vorticity', 'ZS': 'Southerly shear vorticity', 'Z': 'Total shear vorticity'}
+#The flow terms are packed as int16 with a scale factor of 0.02 (values from -655 to 655,
+#larger values are clipped, non finite values are missing) and compressed
+DIAGNOSTICS_ENCODING = {'dtype': 'int16', 'scale_factor': 0.02, 'add_offset': 0., '_FillValue': -32767,
+                        'zlib': True, 'complevel': 4}
+#The circulation types are stored as bytes, missing values as -128
+CT_ENCODING = {'dtype': 'int8', '_FillValue': -128, 'zlib': True, 'complevel': 4}
+#Statistics of the circulation types of the ensemble members (see JK_functions.ensemble_statistics)
+ENSEMBLE = {'CT_probability': 'Fraction of the ensemble members of every circulation type',
+            'CT_mode': 'Most frequent circulation type of the ensemble members',
+            'CT_agreement': 'Fraction of the ensemble members of the most frequent circulation type',
+            'CT_entropy': 'Entropy of the circulation types of the ensemble members (bits)'}
+#The fractions and entropies are packed as int16 with a scale factor of 0.0002 (values up to 6.5)
+ENSEMBLE_ENCODING = {'dtype': 'int16', 'scale_factor': 0.0002, 'add_offset': 0., '_FillValue': -32767,
+                     'zlib': True, 'complevel': 4}
+
+def variable_encoding(name):
+    """
+    This function returns the encoding of a variable of the results.
+
+    :param name: "CT", a flow term of DIAGNOSTICS or a statistic of ENSEMBLE
+    :return: dictionary with the encoding
+    """
+    if name in ('CT', 'CT_mode'):
+        return(CT_ENCODING)
+    if name in ENSEMBLE:
+        return(ENSEMBLE_ENCODING)
+    return(DIAGNOSTICS_ENCODING)
+
+def packing(values, encoding):
+    """
+    This function packs the values with a scale/offset encoding.
+
+    :param values: array of values
+    :param encoding: dictionary with "dtype", "_FillValue" and optionally "scale_factor" and "add_offset"
+    :return: array of packed values
+    """
+    values = np.asarray(values, dtype = float)
+    info = np.iinfo(encoding['dtype'])
+    packed = (values - encoding.get('add_offset', 0.)) / encoding.get('scale_factor', 1.)
+    packed = np.clip(np.round(np.nan_to_num(packed)), info.min + 1, info.max)
+    packed = np.where(np.isfinite(values), packed, encoding['_FillValue'])
+    return(packed.astype(encoding['dtype']))
+
+def opening_writer(output_file, sizes, coords, variables, attrs, flip_lat = False):
+    """
+    This function creates a netCDF file where the circulation types (and the
+    requested flow terms) are written block by block along the time dimension,
+    so the whole record is never held in memory.
+
+    :param output_file: str. name and directory of the netCDF file
+    :param sizes: dictionary with the size of every dimension except time
+    :param coords: dictionary of coordinate values, or (dims, values) for 2-D coordinates
+    :param variables: dictionary with the dimensions (time first) of every variable to be written
+                      ("CT", the flow terms of DIAGNOSTICS and the statistics of ENSEMBLE)
+    :param attrs: global attributes
+    :param flip_lat: True to write the latitudes in descending order
+    :return: writer, to be used with writing_block and closing_writer
+    """
+    import netCDF4
+    import cftime
+    #The netCDF and HDF5 libraries are not thread-safe, the blocks read meanwhile (prefetch_blocks)
+    #use the same lock through xarray
+    with NETCDF_LOCK:
+        nc = netCDF4.Dataset(output_file, 'w')
+        nc.setncatts(attrs)
+        nc.createDimension('time', None)
+        for dim, size in sizes.items():
+            nc.createDimension(dim, size)
+        #Time coordinate
+        time = np.asarray(coords['time'])
+        units = 'hours since 1850-01-01'
+        var = nc.createVariable('time', 'f8', ('time',))
+        if np.issubdtype(time.dtype, np.datetime64):
+            var[:] = (time - np.datetime64('1850-01-01')) / np.timedelta64(1, 'h')
+            var.calendar = 'proleptic_gregorian'
+        else:
+            var[:] = cftime.date2num(time, units, calendar = time[0].calendar)
+            var.calendar = time[0].calendar
+        var.units = units
+        #Other coordinates
+        for name, values in coords.items():
+            if name == 'time':
+                continue
+            var_dims = tuple(values[0]) if type(values) == tuple else (name,)
+            values = np.asarray(values[1] if type(values) == tuple else values)
+            if flip_lat and name == 'lat':
+                values = values[::-1]
+            if values.dtype.kind == 'U': #Labels (e.g. "variant")
+                var = nc.createVariable(name, str, var_dims)
+                var[:] = values.astype(object)
+            else:
+                var = nc.createVariable(name, values.dtype, var_dims)
+                var[:] = values
+            if name in ('lat', 'lon'):
+                var.units = 'degrees_north' if name == 'lat' else 'degrees_east'
+        #Variables
+        for name, dims in variables.items():
+            encoding = variable_encoding(name)
+            var = nc.createVariable(name, encoding['dtype'], tuple(dims), zlib = encoding['zlib'],
+                                    complevel = encoding['complevel'], fill_value = encoding['_FillValue'])
+            var.set_auto_maskandscale(False)
+            auxiliary = [coord for coord, values in coords.items() if type(values) == tuple]
+            if len(auxiliary) > 0: #2-D latitude and longitude of curvilinear grids
+                var.coordinates = ' '.join(auxiliary)
+            if name == 'CT':
+                var.long_name = 'Jenkinson-Collison circulation types'
+            else:
+                var.long_name = DIAGNOSTICS.get(name) or ENSEMBLE[name]
+            if 'scale_factor' in encoding:
+                var.scale_factor = encoding['scale_factor']
+                var.add_offset = encoding['add_offset']
+    return({'nc': nc, 'flip_lat': flip_lat})
+
+def writing_block(writer, start, values):
+    """
+    This function writes a block of time steps into the file of opening_writer.
+
+    :param writer: writer of opening_writer
+    :param start: time index of the first time step of the block
+    :param values: dictionary of arrays with the block of every variable
+    """
+    for name, block in values.items():
+        encoding = variable_encoding(name)
+        block = packing(block, encoding)
+        if writer['flip_lat']:
+            block = block[..., ::-1, :]
+        with NETCDF_LOCK:
+            writer['nc'][name][start:start + len(block)] = block
+
+def closing_writer(writer):
+    """
+    This function closes the file of opening_writer.
+
+    :param writer: writer of opening_writer
+    """
+    with NETCDF_LOCK:
+        writer['nc'].close()
+
+def rechunking_file(filename, output_file, time_chunk = None, space_chunk = (8, 8), memory = '1GB'):
+    """
+    This function copies a netCDF file (MSLP input or circulation types written with
+    output_file) with time-contiguous chunks, by default the whole record of 8 x 8
+    gridpoints per chunk, so the series of a gridpoint is read from one chunk.
+    The values are copied in slabs of whole chunks fitting the memory budget, and
+    are copied packed (no scale factor is applied).
+
+    :param filename: str. name and directory of the netCDF file
+    :param output_file: str. name and directory of the new netCDF file
+    :param time_chunk: number of time steps per chunk (default None, the whole record)
+    :param space_chunk: (rows, columns) of the grid per chunk (default (8, 8))
+    :param memory: memory budget, in bytes or as a string (e.g. "1GB")
+    """
+    import netCDF4
+    import JK_planner
+    budget = JK_planner.memory_size(memory)
+    source = netCDF4.Dataset(filename)
+    target = netCDF4.Dataset(output_file, 'w')
+    target.setncatts({name: source.getncattr(name) for name in source.ncattrs()})
+    for dim in source.dimensions.values():
+        target.createDimension(dim.name, None if dim.isunlimited() else len(dim))
+    for var in source.variables.values():
+        var.set_auto_maskandscale(False)
+        attrs = {name: var.getncattr(name) for name in var.ncattrs() if name != '_FillValue'}
+        fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        #Gridded variables with time as first dimension are rechunked
+        gridded = len(var.dimensions) >= 3 and var.dimensions[0] == 'time'
+        if not gridded:
+            new = target.createVariable(var.name, var.datatype, var.dimensions, fill_value = fill)
+            new.setncatts(attrs)
+            new.set_auto_maskandscale(False)
+            new[...] = var[...]
+            continue
+        shape = var.shape
+        chunks = ((shape[0] if time_chunk is None else min(time_chunk, shape[0]),) + tuple(shape[1:-2]) +
+                  (min(space_chunk[0], shape[-2]), min(space_chunk[1], shape[-1])))
+        new = target.createVariable(var.name, var.datatype, var.dimensions, zlib = True, complevel = 4,
+                                    chunksizes = chunks, fill_value = fill)
+        new.setncatts(attrs)
+        new.set_auto_maskandscale(False)
+        #Slabs of whole chunks filling the memory budget (values read and written): every chunk of
+        #the new file is written once, and the slabs take as many rows of chunks as possible with all
+        #the columns, since inputs chunked by map are decompressed again for every slab of rows
+        chunk_bytes = np.prod(chunks) * np.dtype(var.dtype).itemsize
+        band_bytes = chunk_bytes * -(-shape[-1] // chunks[-1])
+        if budget >= 2 * band_bytes:
+            rows = int(budget // (2 * band_bytes)) * chunks[-2]
+            columns = shape[-1]
+        else:
+            rows = chunks[-2]
+            columns = int(max(budget // (2 * chunk_bytes), 1)) * chunks[-1]
+        for t in range(0, shape[0], chunks[0]):
+            for y in range(0, shape[-2], rows):
+                for x in range(0, shape[-1], columns):
+                    slab = (slice(t, t + chunks[0]), Ellipsis, slice(y, y + rows), slice(x, x + columns))
+                    new[slab] = var[slab]
+        print(var.name + ' rechunked to ' + ' x '.join(str(c) for c in chunks) + ' ✓')
+    source.close()
+    target.close()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import re
+import time as timer
+import tracemalloc
+import numpy as np
+import JK_functions
+
+#Rough speed of reading and decompressing the input files (bytes per second), it depends on the disks
+READ_SPEED = 100 * 1024**2
+#Calibrations already measured, one per engine and threshold configurations
+_calibrations = {}
+
+def memory_size(memory):
+    """
+    This function converts a memory budget to bytes.
+
+    :param memory: int. number of bytes, or str. with units, e.g. "8GB", "500 MB"
+    :return: int. number of bytes
+    """
+    if type(memory) == str:
+        match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', memory.upper())
+        if match is None:
+            raise TypeError("Incorrect memory budget, only bytes or strings such as '8GB' allowed")
+        return(int(float(match.group(1)) * 1024**'_KMGT'.index(match.group(2) or '_')))
+    return(int(memory))
+
+def readable(size):
+    """
+    This function writes a number of bytes in readable units.
+
+    :param size: number of bytes
+    :return: str.
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return(str(round(size, 1)) + ' ' + unit)
+        size = size / 1024
+    return(str(round(size, 1)) + ' TB')
+
+def available_memory():
+    """
+    This function returns the physical memory of the computer (Linux and macOS).
+
+    :return: int. number of bytes
+    """
+    import os
+    return(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+
+def input_layout(mslp):
+    """
+    This function reads the layout of the MSLP variable from the file,
+    without reading any values.
+
+    :param mslp: mean sea level pressure data in xarray format (not loaded)
+    :return: dictionary with the size of the values in bytes ("itemsize") and the
+             on-disk chunks of every dimension ("chunks", None for contiguous files)
+    """
+    dtype = np.dtype(mslp.encoding.get('dtype', mslp.dtype))
+    chunks = mslp.encoding.get('chunksizes') or mslp.encoding.get('chunks') #netCDF or Zarr
+    if chunks is not None and mslp.encoding.get('contiguous', False):
+        chunks = None
+    return({'itemsize': dtype.itemsize, 'chunks': None if chunks is None else tuple(chunks)})
+
+def calibrating(engine, interpolation, variants = None):
+    """
+    This function measures the memory and time needed to classify one central
+    point at one time step, from a small synthetic MSLP field (the input is not read).
+
+    :param engine: "points" or "sparse"
+    :param interpolation: "nearest" or "bilinear"
+    :param variants: list of threshold configurations (see JK_functions.VARIANT_DEFAULT)
+    :return: bytes and seconds per central point and time step
+    """
+    key = (engine, interpolation, repr(variants))
+    if key in _calibrations:
+        return(_calibrations[key])
+    lat = np.arange(70, 19.9, -0.5)
+    lon = np.arange(-30, 30.1, 0.5)
+    plan = JK_functions.stencil_plan(lat, lon, False, interpolation = interpolation)
+    phi = np.broadcast_to(lat[plan['lat_index']][:, None], plan['shape'])
+    sc, zwa, zwb, zsc = JK_functions.constants(phi, None)
+    operator = JK_functions.flow_operator(plan) if engine == 'sparse' else None
+    steps = 8
+    mslp = 1013 + 10 * np.random.default_rng(0).standard_normal((steps, len(lat), len(lon)))
+    seconds = []
+    for repeat in range(3):
+        tracemalloc.start()
+        t0 = timer.perf_counter()
+        if engine == 'sparse':
+            W, S, F, ZW, ZS, Z = JK_functions.flows_operator(mslp, plan, operator, sc, zwa, zsc, zwb)
+        else:
+            gridpoints = JK_functions.extracting_gridpoints(mslp, plan)
+            W, S, F, ZW, ZS, Z = JK_functions.flows(gridpoints, sc, zwa, zsc, zwb)
+            del(gridpoints)
+        if variants is None:
+            JK_functions.circulation_types(W, S, F, Z, phi)
+        else:
+            JK_functions.circulation_types_variants(W, S, F, Z, phi, variants)
+        seconds.append(timer.perf_counter() - t0)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del(W, S, F, ZW, ZS, Z)
+    points = steps * np.prod(plan['shape'])
+    _calibrations[key] = (peak / points, min(seconds) / points)
+    return(_calibrations[key])
+
+def chunk_span(start, end, chunk):
+    """
+    This function computes the number of values read along a dimension when
+    whole on-disk chunks are read.
+
+    :param start, end: first and last (excluded) index read
+    :param chunk: chunk size of the dimension (None for contiguous files)
+    :return: number of values read
+    """
+    if chunk is None:
+        return(end - start)
+    return((-(-end // chunk) - start // chunk) * chunk)
+
+def planning(memory, workers, grid, layout, engine = 'points', interpolation = 'nearest', variants = None,
+             n_geometries = 1, diagnostics = 0, in_memory = True, prefetch = 2, plans = None, globe = False,
+             ensemble = 0):
+    """
+    This function chooses the number of time steps per block, and the tiles when a
+    single time step of the whole grid does not fit, so the classification stays
+    within a memory budget. The memory and time per central point are calibrated
+    on a synthetic field, the input values are not read.
+
+    :param memory: memory budget, in bytes or as a string (e.g. "8GB")
+    :param workers: number of cores classifying tiles in parallel
+    :param grid: dictionary with the number of time steps read ("read_steps") and classified ("steps"),
+                 the size of the extra dimensions ("extra"), the grid shape ("grid_shape") and the
+                 number of central points ("central")
+    :param layout: layout of the input variable (see input_layout)
+    :param engine, interpolation, variants: options of the classification
+    :param n_geometries: number of stencil geometries of a sweep
+    :param diagnostics: number of flow terms stored
+    :param in_memory: True when the results are kept in memory, False when written to a file
+    :param prefetch: number of blocks read in advance
+    :param plans: stencil plans of the geometries (regular grids, needed for the tiles)
+    :param globe: True for global grids
+    :param ensemble: number of ensemble statistics stored per central point and time step
+    :return: dictionary with the chosen "block_size" and "tiles" (None without tiles) and the
+             estimated "memory" (bytes), "read" (bytes) and "runtime" (seconds)
+    """
+    budget = memory_size(memory)
+    per_point, seconds_per_point = calibrating(engine, interpolation, variants)
+    n_grid = int(np.prod(grid['grid_shape']))
+    central = grid['central']
+    extra = grid['extra']
+    outputs = n_geometries * (1 if variants is None else len(variants))
+    #Circulation types and flow terms of one time step of the whole grid
+    results = central * (extra * (8 * outputs + 8 * diagnostics * n_geometries) + 8 * ensemble)
+    #Whole record kept in memory (circulation types as float64, flow terms packed as int16,
+    #ensemble statistics as float32)
+    record = grid['steps'] * central * (extra * (8 * outputs + 2 * diagnostics * n_geometries) + 4 * ensemble) if in_memory else 0
+    if record >= budget:
+        raise MemoryError('The results (' + readable(record) + ') do not fit in the memory budget, '
+                          'use output_file to write them block by block')
+    time_chunk = 1 if layout['chunks'] is None else layout['chunks'][0]
+    chunks = layout['chunks'] or (None,) * 4
+    read_factor = max(grid['read_steps'] / grid['steps'], 1)
+    #Every time step: the values read and converted to hPa (and the blocks read in advance),
+    #the temporaries of the flow terms for every central point and the results
+    per_step = (n_grid * extra * (layout['itemsize'] + 8 * (prefetch + 1)) * read_factor +
+                per_point * central * extra + results)
+    block_size = int((budget - record) // per_step)
+    tiles = None
+    read = grid['read_steps'] * extra * n_grid * layout['itemsize']
+    if block_size < 1:
+        if plans is None:
+            raise MemoryError('One time step does not fit in the memory budget, tiles are only available for regular grids')
+        #Tiles: the time steps of a block are stitched together, every worker classifies one tile
+        block_size = int(min(grid['steps'], max(time_chunk, 1)))
+        stitched = block_size * results
+        per_worker = (budget - record - stitched) / max(workers, 1)
+        n_lat, n_lon = plans[0]['shape']
+        points = max(per_worker / (block_size * extra * (per_point + 8 * read_factor * 4)), 1)
+        tile_lat = int(max(min(n_lat, np.sqrt(points * n_lat / n_lon)), 1))
+        tile_lon = int(max(min(n_lon, points / tile_lat), 1))
+        while True:
+            tiling = JK_functions.tiling(plans, (tile_lat, tile_lon), globe)
+            largest = max(len(tile['rows']) * len(tile['cols']) * (layout['itemsize'] + 8) * read_factor +
+                          (tile['lat_pos'].stop - tile['lat_pos'].start) * (tile['lon_pos'].stop - tile['lon_pos'].start) *
+                          per_point for tile in tiling)
+            if block_size * extra * largest <= per_worker:
+                break
+            if tile_lat == 1 and tile_lon == 1:
+                raise MemoryError('The memory budget is too small, even for tiles of one central point')
+            tile_lat, tile_lon = max(tile_lat // 2, 1), max(tile_lon // 2, 1)
+        tiles = (tile_lat, tile_lon)
+        peak = record + stitched + min(workers, len(tiling)) * block_size * extra * largest
+        #Whole chunks are read for every tile
+        read = 0
+        for tile in tiling:
+            rows = chunk_span(tile['rows'][0], tile['rows'][-1] + 1, chunks[-2])
+            runs = np.split(tile['cols'], np.flatnonzero(np.diff(tile['cols']) != 1) + 1)
+            cols = sum(chunk_span(run[0], run[-1] + 1, chunks[-1]) for run in runs)
+            read += grid['read_steps'] * extra * rows * cols * layout['itemsize']
+        runtime = (read / READ_SPEED + seconds_per_point * central * extra * grid['steps'] * n_geometries /
+                   min(workers, len(tiling)))
+    else:
+        block_size = int(min(block_size, grid['steps']))
+        if block_size >= time_chunk > 1:
+            block_size = block_size // time_chunk * time_chunk #Whole on-disk chunks per block
+        peak = record + block_size * per_step
+        runtime = read / READ_SPEED + seconds_per_point * central * extra * grid['steps'] * n_geometries
+    return({'block_size': block_size, 'tiles': tiles, 'memory': int(peak), 'read': int(read), 'runtime': float(runtime)})
+
+def printing_plan(grid, run):
+    """
+    This function prints the estimates of planning.
+
+    :param grid: dictionary with the sizes of the input (see planning)
+    :param run: dictionary returned by planning
+    """
+    print('Grid: ' + ' x '.join(str(n) for n in grid['grid_shape']) + ' gridpoints, ' + str(grid['central']) +
+          ' central points, ' + str(grid['steps']) + ' time steps' +
+          ('' if grid['extra'] == 1 else ' x ' + str(grid['extra']) + ' members'))
+    print('Block size: ' + str(run['block_size']) + ' time steps' +
+          ('' if run['tiles'] is None else ', tiles of ' + str(run['tiles'][0]) + ' x ' + str(run['tiles'][1]) + ' central points'))
+    print('Estimated peak memory: ' + readable(run['memory']))
+    print('Bytes to read: ' + readable(run['read']))
+    print('Expected runtime: ' + str(round(run['runtime'], 1)) + ' s')
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+"""
+#Importing neccesary modules
+import os
+import sys
+import json
+import time as timer
+import fnmatch
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import xarray as xr
+#Imported once by every worker process, the stencil plans (and sparse operators) of the
+#grids are kept in memory by JK_functions and reused for every file of the same grid
+import JK_classification
+
+#Name of the status log written in the output directory
+STATUS_LOG = 'status.jsonl'
+#Temporary files (still being copied or written) are not classified
+TEMPORARY = ('.*', '*.part', '*.tmp')
+_log_lock = threading.Lock()
+
+def complete_file(path, settle = 10):
+    """
+    This function checks whether a file has been completely written: it has not been
+    modified for settle seconds and it opens with a time coordinate.
+
+    :param path: str. filename
+    :param settle: seconds without modifications (default 10)
+    :return: (first, last) time steps as str., or None when the file is not complete
+    """
+    try:
+        if timer.time() - os.path.getmtime(path) < settle:
+            return None
+        with xr.open_dataset(path) as DS:
+            if 'time' not in DS.coords or len(DS.time) == 0:
+                return None
+            return(str(DS.time.values[0]), str(DS.time.values[-1]))
+    except (OSError, ValueError):
+        return None
+
+def reading_status(output_dir):
+    """
+    This function reads the status log of the output directory.
+
+    :param output_dir: str. output directory
+    :return: dictionary with the last record of every input file
+    """
+    status = {}
+    path = os.path.join(output_dir, STATUS_LOG)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    status[record['file']] = record
+    return(status)
+
+def logging_status(output_dir, record):
+    """
+    This function appends a record to the status log of the output directory.
+
+    :param output_dir: str. output directory
+    :param record: dictionary with the status of an input file
+    """
+    with _log_lock:
+        with open(os.path.join(output_dir, STATUS_LOG), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def classifying_file(path, output_dir, source, period, globe = False, options = None):
+    """
+    This function classifies one file and writes the results atomically: the circulation
+    types are written block by block to a temporary file, which is renamed when complete.
+
+    :param path: str. filename of the MSLP data
+    :param output_dir: str. output directory, the results are written to CT_<filename>
+    :param source: 'REAN', 'GCM' or 'RCM'
+    :param period: (first, last) time steps of the file
+    :param globe: True for global grids
+    :param options: dictionary of other arguments of JK_classification (e.g. ensemble = True)
+    :return: dictionary with the status of the file (logged by watching)
+    """
+    output = os.path.join(output_dir, 'CT_' + os.path.basename(path))
+    partial = os.path.join(output_dir, '.CT_' + os.path.basename(path) + '.part')
+    record = {'file': path, 'output': output, 'size': os.path.getsize(path), 'mtime': os.path.getmtime(path)}
+    t0 = timer.perf_counter()
+    try:
+        result = JK_classification.JK_classification(path, source, output_file = partial, time_init = period[0],
+                                                     time_end = period[1], globe = globe, **(options or {}))
+        result.close()
+        os.replace(partial, output)
+        record['status'] = 'done'
+    except Exception as error:
+        if os.path.exists(partial):
+            os.remove(partial)
+        record.update(status = 'failed', error = repr(error))
+    record['seconds'] = round(timer.perf_counter() - t0, 3)
+    record['finished'] = timer.strftime('%Y-%m-%dT%H:%M:%S')
+    return(record)
+
+def file_record(path, version, future):
+    """
+    This function returns the status of a file classified by a worker process, failed
+    when the worker process died (e.g. out of memory) before returning it.
+
+    :param path: str. filename of the MSLP data
+    :param version: (size, modification time) of the file when it was submitted
+    :param future: finished future of classifying_file
+    :return: dictionary with the status of the file
+    """
+    try:
+        return(future.result())
+    except Exception as error:
+        return({'file': path, 'size': version[0], 'mtime': version[1], 'status': 'failed', 'error': repr(error),
+                'seconds': None, 'finished': timer.strftime('%Y-%m-%dT%H:%M:%S')})
+
+def finishing_file(output_dir, path, version, future):
+    """
+    This function logs the status of a file once its worker process has finished (or died).
+
+    :param output_dir: str. output directory
+    :param path: str. filename of the MSLP data
+    :param version: (size, modification time) of the file when it was submitted
+    :param future: future of classifying_file
+    """
+    record = file_record(path, version, future)
+    logging_status(output_dir, record)
+    print(('✓ ' if record['status'] == 'done' else '✗ ') + os.path.basename(record['file']) + ' (' + str(record['seconds']) + ' s)')
+
+def watching(directory, output_dir, source = 'REAN', globe = False, pattern = '*.nc', workers = 2, interval = 5,
+             settle = 10, once = False, **options):
+    """
+    This function watches a directory and classifies the new files as soon as they are complete,
+    until it is stopped (Ctrl+C). Up to workers files are classified at the same time, every file in one
+    of the worker processes (the netCDF and HDF5 libraries are not thread-safe), and the worker processes
+    keep the imports and stencil plans in memory between files. The status of every file is
+    appended to status.jsonl in the output directory; files already classified (same size and
+    modification time) are skipped when the worker restarts, and files that failed are retried
+    only when they change. When a worker process dies (e.g. out of memory), its files are logged
+    as failed and the worker processes are started again.
+
+    :param directory: str. directory where the MSLP files land
+    :param output_dir: str. directory of the results
+    :param source: 'REAN' (default), 'GCM' or 'RCM'
+    :param globe: True for global grids (default False)
+    :param pattern: pattern of the names of the files (default "*.nc")
+    :param workers: number of worker processes, files classified at the same time (default 2)
+    :param interval: seconds between two scans of the directory (default 5)
+    :param settle: seconds without modifications before a file is considered complete (default 10)
+    :param once: True classifies the files complete at the first scan and returns
+    :param options: other arguments of JK_classification (e.g. engine = 'sparse', ensemble = True)
+    :return: list of the status of the files classified when once is True (otherwise an empty list,
+             the status of every file is in status.jsonl)
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    status = reading_status(output_dir)
+    submitted = {}
+    records = []
+    print('Watching ' + directory + ' for new files ☉')
+    pool = ProcessPoolExecutor(max_workers = workers)
+    try:
+        while True:
+            for entry in sorted(os.scandir(directory), key = lambda entry: entry.name):
+                if (not entry.is_file() or not fnmatch.fnmatch(entry.name, pattern) or
+                        any(fnmatch.fnmatch(entry.name, name) for name in TEMPORARY)):
+                    continue
+                stat = entry.stat()
+                version = (stat.st_size, stat.st_mtime)
+                previous = status.get(entry.path)
+                if submitted.get(entry.path) == version or (previous is not None and
+                                                            (previous['size'], previous['mtime']) == version):
+                    continue
+                period = complete_file(entry.path, settle)
+                if period is None:
+                    continue
+                submitted[entry.path] = version
+                try:
+                    future = pool.submit(classifying_file, entry.path, output_dir, source, period, globe, options)
+                except BrokenProcessPool:
+                    print('A worker process died, starting the worker processes again ⟲')
+                    pool.shutdown(wait = False)
+                    pool = ProcessPoolExecutor(max_workers = workers)
+                    future = pool.submit(classifying_file, entry.path, output_dir, source, period, globe, options)
+                future.add_done_callback(functools.partial(finishing_file, output_dir, entry.path, version))
+                #Only the runs of once are returned, a long-running worker does not keep its futures
+                if once:
+                    records.append((entry.path, version, future))
+            if once:
+                break
+            timer.sleep(interval)
+    except KeyboardInterrupt:
+        print('Stopping, waiting for the files being classified ⧗')
+    pool.shutdown(wait = True)
+    return([file_record(*record) for record in records])
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    options = {}
+    for name, kind in (('--source', str), ('--workers', int), ('--interval', float), ('--settle', float),
+                       ('--pattern', str), ('--engine', str)):
+        if name in arguments:
+            position = arguments.index(name)
+            options[name[2:]] = kind(arguments[position + 1])
+            del(arguments[position:position + 2])
+    for name in ('--globe', '--ensemble'):
+        if name in arguments:
+            options[name[2:]] = True
+            arguments.remove(name)
+    watching(arguments[0], arguments[1], **options)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+"""
+@Author: Pedro Herrera-Lormendez
+
+Import-time benchmark of the modules. Every module is imported in a new
+Python process, the import time is printed and the script fails (exit code 1)
+if a module of the numerical core pulls in the plotting modules or takes
+longer than the time budget.
+
+Usage: python functions/import_benchmark.py [budget in seconds, default 5]
+"""
+import os
+import sys
+import subprocess
+
+#Modules that must be importable without the plotting modules
+CORE_MODULES = ['JK_functions', 'JK_io', 'JK_cache', 'JK_planner', 'JK_classification', 'CTs_functions', 'CTs_plots', 'CTs_archive', 'CTs_service', 'CTs_composites', 'CTs_comparison', 'JK_watch']
+PLOTTING_MODULES = ['matplotlib', 'mpl_toolkits.basemap', 'seaborn']
+
+def import_time(module, repeat = 3):
+    '''
+    This function measures the time needed to import a module in a new Python process
+
+    :param module: name of the module
+    :param repeat: number of measurements (the fastest is kept)
+    :return: import time in seconds and list of plotting modules loaded by the import
+    '''
+    code = ('import sys, time; t0 = time.perf_counter(); import ' + module + '; t1 = time.perf_counter(); '
+            'print(t1 - t0); print(" ".join(m for m in ' + repr(PLOTTING_MODULES) + ' if m in sys.modules))')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for i in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], cwd = directory, capture_output = True, text = True)
+        if result.returncode != 0:
+            return float('nan'), ['import error: ' + result.stderr.strip().splitlines()[-1]]
+        lines = result.stdout.splitlines()
+        times.append(float(lines[0]))
+        loaded = lines[1].split() if len(lines) > 1 else []
+    return min(times), loaded
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 5.
+    failed = False
+    for module in CORE_MODULES:
+        seconds, loaded = import_time(module)
+        status = '✓'
+        if len(loaded) > 0 or seconds > budget:
+            status = '✗'
+            failed = True
+        print(module.ljust(20), str(round(seconds, 3)).rjust(7), 's', status, ' '.join(loaded))
+    sys.exit(1 if failed else 0)
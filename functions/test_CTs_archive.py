@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the compact archives of circulation types (CTs_archive)
+"""
+import io
+import contextlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+import JK_functions
+import CTs_archive
+
+def random_CT(members = None, days = 800, seed = 0):
+    #Random circulation types with missing values on a small regional grid
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('2000-01-01', periods = days, freq = 'D')
+    shape = (days,) + (() if members is None else (members,)) + (21, 30)
+    values = rng.choice(np.array(JK_functions.CT_CODES, dtype = float), shape)
+    values[rng.random(shape) < 0.05] = np.nan
+    dims = ['time'] + ([] if members is None else ['number']) + ['lat', 'lon']
+    coords = {'time': time, 'lat': np.linspace(70, 30, 21), 'lon': np.linspace(-30, 57, 30)}
+    if members is not None:
+        coords['number'] = np.arange(members)
+    return(xr.DataArray(values, coords = coords, dims = dims, name = 'CT'))
+
+def writing(CT, directory, **options):
+    with contextlib.redirect_stdout(io.StringIO()):
+        CTs_archive.writing_archive(CT, str(directory), **options)
+
+def test_packing_bits_round_trip():
+    values = np.random.default_rng(1).integers(0, 2**CTs_archive.CT_BITS, 1001)
+    data = CTs_archive.packing_bits(values)
+    assert len(data) == -(-1001 * CTs_archive.CT_BITS // 8)
+    assert np.array_equal(CTs_archive.unpacking_bits(data, 1001), values)
+
+@pytest.mark.parametrize('codec', ['bits', 'zlib'])
+@pytest.mark.parametrize('members', [None, 3])
+def test_archive_round_trip(tmp_path, codec, members):
+    CT = random_CT(members)
+    writing(CT, tmp_path, time_chunk = 100, space_chunk = (8, 8), codec = codec)
+    output = CTs_archive.reading_archive(str(tmp_path))
+    assert output.dims == CT.dims
+    assert np.array_equal(output.values, CT.values, equal_nan = True)
+    assert np.array_equal(output.time.values, CT.time.values)
+
+def test_archive_selection(tmp_path):
+    CT = random_CT(2)
+    writing(CT, tmp_path, time_chunk = 90, space_chunk = (8, 8))
+    selection = {'time': slice('2000-12-01', '2001-02-28'), 'lat': slice(60, 40), 'lon': slice(-10, 20)}
+    output = CTs_archive.reading_archive(str(tmp_path), **selection)
+    assert output.equals(CT.sel(selection))
+    point = CTs_archive.reading_archive(str(tmp_path), method = 'nearest', time = '2001-03-05', lat = 51.3, lon = 3.2)
+    assert point.dims == ('number',)
+    assert np.array_equal(point.values, CT.sel(time = '2001-03-05', lat = 51.3, lon = 3.2, method = 'nearest').values,
+                          equal_nan = True)
+
+def test_reading_points(tmp_path):
+    CT = random_CT()
+    writing(CT, tmp_path, time_chunk = 100, space_chunk = (8, 8))
+    meta = CTs_archive.opening_archive(str(tmp_path))
+    rng = np.random.default_rng(2)
+    t_pos, y_pos, x_pos = rng.integers(0, 800, 500), rng.integers(0, 21, 500), rng.integers(0, 30, 500)
+    values = CTs_archive.reading_points(meta, t_pos, y_pos, x_pos)
+    assert np.array_equal(values, CT.values[t_pos, y_pos, x_pos], equal_nan = True)
+
+def test_layouts(tmp_path):
+    CT = random_CT()
+    writing(CT, tmp_path, time_chunk = 100, space_chunk = (8, 8))
+    with contextlib.redirect_stdout(io.StringIO()):
+        CTs_archive.rechunking_archive(str(tmp_path), space_chunk = (4, 4))
+    meta = CTs_archive.opening_archive(str(tmp_path))
+    #The series of a gridpoint is read from the time-contiguous layout, a map from the original one
+    series = {'time': np.arange(800), 'lat': np.array([5]), 'lon': np.array([7])}
+    one_map = {'time': np.array([10]), 'lat': np.arange(21), 'lon': np.arange(30)}
+    assert CTs_archive.choosing_layout(meta, series)['chunks'] == (800, 4, 4)
+    assert CTs_archive.choosing_layout(meta, one_map)['chunks'] == (100, 8, 8)
+    assert np.array_equal(CTs_archive.reading_chunks(CTs_archive.choosing_layout(meta, series), series),
+                          CT.values[:, 5:6, 7:8], equal_nan = True)
+
+@pytest.mark.parametrize('types', [11, 27])
+def test_summed_types(tmp_path, types):
+    CT = random_CT()
+    writing(CT, tmp_path, time_chunk = 100, space_chunk = (8, 8))
+    meta = CTs_archive.opening_archive(str(tmp_path))
+    #The summary of an archive written without it is the same
+    summary = CTs_archive.summarising_archive(meta)
+    assert np.array_equal(summary['counts'], meta['summary']['counts'])
+    labels, lookup = JK_functions.type_classes(types)
+    months = CT.time.dt.month.values
+    boxes = [(np.arange(21), np.arange(30), np.arange(800)),
+             (np.arange(3, 19), np.arange(0, 16), np.flatnonzero(np.isin(months, (12, 1, 2)))),
+             (np.arange(8, 16), np.concatenate([np.arange(25, 30), np.arange(0, 4)]), np.arange(45, 400))]
+    for y_pos, x_pos, t_pos in boxes:
+        positions = {'time': t_pos, 'lat': y_pos, 'lon': x_pos}
+        counts = CTs_archive.summed_types(meta, positions, lookup, len(labels))
+        classes = JK_functions.type_indices(CT.values[np.ix_(t_pos, y_pos, x_pos)], lookup)
+        assert np.array_equal(counts, np.bincount(classes[classes >= 0], minlength = len(labels)))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the comparison of two datasets of circulation types (CTs_comparison) against naive masks
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+import JK_functions
+import CTs_comparison
+
+LAT = np.arange(60., 40., -2.)
+LON = np.arange(-10., 14., 2.)
+
+def random_CT(time, lat = LAT, lon = LON, members = None, seed = 0):
+    #Random circulation types with missing values, as the output of JK_classification
+    rng = np.random.default_rng(seed)
+    shape = (len(time),) + (() if members is None else (members,)) + (len(lat), len(lon))
+    values = rng.choice(np.array(JK_functions.CT_CODES, dtype = float), shape)
+    values[rng.random(shape) < 0.05] = np.nan
+    dims = ['time'] + ([] if members is None else ['number']) + ['lat', 'lon']
+    return(xr.DataArray(values, coords = {'time': time, 'lat': lat, 'lon': lon}, dims = dims, name = 'CT'))
+
+def type_codes(types):
+    #Codes of every type (CTs_functions.eleven_CTs also codes C as 9)
+    if types == 27:
+        return([[code] for code in JK_functions.CT_CODES])
+    return([codes + [9] if label == 'C' else codes for label, codes in JK_functions.CT_GROUPS.items()])
+
+def checking(output, reference, model, types):
+    #Naive confusion counts, one pair of masks of the whole record per pair of types
+    model = model.sel(lat = reference.lat, lon = reference.lon).reindex(time = reference.time)
+    model = model.broadcast_like(reference).transpose(*reference.dims).values
+    codes = type_codes(types)
+    for i, first in enumerate(codes):
+        for j, second in enumerate(codes):
+            naive = (np.isin(reference.values, first) & np.isin(model, second)).sum(axis = 0)
+            assert np.array_equal(output['confusion'][i, j].values, naive)
+    days = output['confusion'].sum(['type_reference', 'type_model']).values
+    assert np.array_equal(output['days'].values, days)
+    total = np.where(days > 0, days, np.nan)
+    hits = sum(output['confusion'][n, n].values for n in range(len(codes)))
+    frequency_reference = output['confusion'].sum('type_model').values / total
+    frequency_model = output['confusion'].sum('type_reference').values / total
+    np.testing.assert_allclose(output['accuracy'].values, hits / total)
+    np.testing.assert_allclose(output['frequency_bias'].values, frequency_model - frequency_reference)
+    np.testing.assert_allclose(output['perkins'].values, np.minimum(frequency_reference, frequency_model).sum(axis = 0))
+
+@pytest.mark.parametrize('types', [27, 11])
+def test_comparison(types):
+    #The model covers part of the days of the reference on a larger grid
+    reference = random_CT(pd.date_range('2000-01-01', periods = 300, freq = 'D'))
+    model = random_CT(pd.date_range('2000-03-01', periods = 400, freq = 'D'), lat = np.arange(64., 36., -2.),
+                      lon = np.arange(-20., 20., 2.), seed = 1)
+    output = CTs_comparison.CT_comparison(reference, model, types = types, block_size = 45, prefetch = 0)
+    checking(output, reference, model, types)
+
+def test_comparison_members(tmp_path):
+    #Members of an ensemble against a reference stored in two files, the eleven types coded with 9 for C
+    time = pd.date_range('2000-01-01', periods = 200, freq = 'D')
+    reference = random_CT(time)
+    model = random_CT(time, members = 4, seed = 2)
+    model = model.where(model != 20, 9)
+    files = [str(tmp_path / 'CT_a.nc'), str(tmp_path / 'CT_b.nc')]
+    reference[:90].to_netcdf(files[0])
+    reference[90:].to_netcdf(files[1])
+    output = CTs_comparison.CT_comparison(model, files, types = 11, block_size = 64)
+    checking(output, model, reference, 11)
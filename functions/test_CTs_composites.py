@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the composites by circulation type (CTs_composites) against naive masks
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+import JK_functions
+import CTs_composites
+
+LAT = np.arange(60., 40., -2.)
+LON = np.arange(-10., 14., 2.)
+
+def random_CT(days = 400, members = None, seed = 0):
+    #Random circulation types with missing values, as the output of JK_classification
+    rng = np.random.default_rng(seed)
+    shape = (days,) + (() if members is None else (members,)) + (len(LAT), len(LON))
+    values = rng.choice(np.array(JK_functions.CT_CODES, dtype = float), shape)
+    values[rng.random(shape) < 0.05] = np.nan
+    dims = ['time'] + ([] if members is None else ['number']) + ['lat', 'lon']
+    coords = {'time': pd.date_range('2000-01-01', periods = days, freq = 'D'), 'lat': LAT, 'lon': LON}
+    return(xr.DataArray(values, coords = coords, dims = dims, name = 'CT'))
+
+def random_variable(time, seed = 1):
+    #Random values with missing values on a grid containing the grid of the circulation types
+    rng = np.random.default_rng(seed)
+    lat, lon = np.arange(64., 36., -2.), np.arange(-20., 20., 2.)
+    values = rng.gamma(2., 3., (len(time), len(lat), len(lon)))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    return(xr.DataArray(values, coords = {'time': time, 'lat': lat, 'lon': lon}, dims = ['time', 'lat', 'lon'], name = 'pr'))
+
+def type_codes(types):
+    #Codes of every type (CTs_functions.eleven_CTs also codes C as 9)
+    if types == 27:
+        return([[code] for code in JK_functions.CT_CODES])
+    return([codes + [9] if label == 'C' else codes for label, codes in JK_functions.CT_GROUPS.items()])
+
+def checking(output, CT, pr, types, thresholds):
+    #Naive composites, one mask of the whole record per type
+    pr = pr.sel(lat = CT.lat, lon = CT.lon).reindex(time = CT.time)
+    pr = pr.broadcast_like(CT).transpose(*CT.dims).values
+    for n, codes in enumerate(type_codes(types)):
+        typed = np.isin(CT.values, codes)
+        valid = typed & np.isfinite(pr)
+        values = np.where(valid, pr, np.nan)
+        count = valid.sum(axis = 0)
+        assert np.array_equal(output['CT_count'][n].values, typed.sum(axis = 0))
+        assert np.array_equal(output['pr_count'][n].values, count)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = np.nansum(values, axis = 0) / count
+            variance = np.nansum((values - mean)**2, axis = 0) / (count - 1)
+        np.testing.assert_allclose(output['pr_mean'][n].values, mean, rtol = 1e-10)
+        np.testing.assert_allclose(output['pr_variance'][n].values, np.where(count > 1, variance, np.nan), rtol = 1e-8)
+        for t, threshold in enumerate(thresholds):
+            assert np.array_equal(output['pr_exceedance'][t, n].values, (valid & (pr > threshold)).sum(axis = 0))
+
+@pytest.mark.parametrize('types', [27, 11])
+def test_composites(types):
+    CT = random_CT()
+    pr = random_variable(pd.date_range('2000-02-01', periods = 400, freq = 'D'))
+    output = CTs_composites.CT_composites(CT, {'pr': pr}, thresholds = {'pr': [1, 10]}, types = types,
+                                          block_size = 30, prefetch = 0)
+    checking(output, CT, pr, types, [1, 10])
+
+def test_composites_members_and_files(tmp_path):
+    #Members of an ensemble and a variable without members split in two files, the eleven types coded with 9 for C
+    CT = random_CT(members = 3)
+    CT = CT.where(CT != 20, 9)
+    pr = random_variable(pd.date_range('1999-12-01', periods = 300, freq = 'D'))
+    files = [str(tmp_path / 'pr_a.nc'), str(tmp_path / 'pr_b.nc')]
+    pr[:150].to_netcdf(files[0])
+    pr[150:].to_netcdf(files[1])
+    output = CTs_composites.CT_composites(CT, {'pr': files}, thresholds = {'pr': [5]}, types = 11, block_size = 64)
+    checking(output, CT, pr, 11, [5])
+
+@pytest.mark.parametrize('daily', ['mean', 12])
+def test_composites_daily(daily):
+    CT = random_CT(days = 60)
+    pr = random_variable(pd.date_range('2000-01-01', periods = 240, freq = '6h'))
+    output = CTs_composites.CT_composites(CT, {'pr': pr.to_dataset()}, block_size = 7, daily = daily, prefetch = 0)
+    if daily == 'mean':
+        #Missing values are left out of the daily means
+        days = pr.resample(time = '1D').mean()
+    else:
+        days = pr.sel(time = pr.time.dt.hour == 12)
+        days['time'] = days.time.dt.floor('D')
+    checking(output, CT, days, 27, [])
+    with pytest.raises(ValueError):
+        CTs_composites.CT_composites(CT, {'pr': pr})
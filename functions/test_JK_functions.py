@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the time, grid and stencil helpers of the classification (JK_functions)
+"""
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+import cftime
+import pytest
+import JK_functions
+import JK_classification
+
+def test_normalise_time():
+    time = pd.date_range('2000-02-28 06:00', periods = 12, freq = '6h').values
+    assert np.array_equal(JK_functions.normalise_time(time), time.astype('datetime64[D]').astype('datetime64[ns]'))
+    for calendar in ('360_day', 'noleap', 'all_leap'):
+        time = cftime.num2date(np.arange(0, 5, 0.25), 'days since 2000-02-28 00:00', calendar = calendar)
+        days = JK_functions.normalise_time(time)
+        assert all(day.calendar == calendar and day.hour == 0 for day in days)
+        assert [day.day for day in days[::4]] == [day.day for day in time[::4]]
+        assert np.array_equal(days[1::4], days[::4])
+
+@pytest.mark.parametrize('step', [1, -1])
+def test_nearest_index(step):
+    rng = np.random.default_rng(0)
+    coord = np.sort(rng.uniform(-90, 90, 50))[::step]
+    target = rng.uniform(-100, 100, 1000)
+    index = JK_functions.nearest_index(coord, target)
+    expected = xr.DataArray(np.arange(50), coords = {'lat': coord}).sel(lat = target, method = 'nearest').values
+    assert np.array_equal(index, expected)
+    #Longitudes wrap on global grids
+    lon = np.arange(0., 360., 2.5)
+    assert np.array_equal(JK_functions.nearest_index(lon, [-1., 359., 181.2, 720.4], periodic = True), [0, 0, 72, 0])
+
+def test_stencil_plans():
+    JK_functions._stencil_plans.clear()
+    for n in range(JK_functions.STENCIL_PLANS + 5):
+        JK_functions.storing_plan(n, {'grid': n})
+    assert len(JK_functions._stencil_plans) == JK_functions.STENCIL_PLANS
+    assert JK_functions.cached_plan(0) is None and JK_functions.cached_plan(5) == {'grid': 5}
+    #The plans used are kept
+    JK_functions.storing_plan('new', {})
+    assert JK_functions.cached_plan(5) is not None and JK_functions.cached_plan(6) is None
+    JK_functions._stencil_plans.clear()
+
+def test_global_tiles(tmp_path):
+    #Tiles of a global grid read their halo across the dateline
+    rng = np.random.default_rng(0)
+    values = 100. * rng.integers(990, 1030, (5, 37, 72))
+    np.save(str(tmp_path / 'msl.npy'), values)
+    info = {'dims': ['time', 'lat', 'lon'],
+            'coords': {'time': [str(t) for t in pd.date_range('2000-01-01', periods = 5).values],
+                       'lat': {'start': 90, 'step': -5, 'size': 37}, 'lon': {'start': 0, 'step': 5, 'size': 72}}}
+    with open(str(tmp_path / 'msl.json'), 'w') as f:
+        json.dump(info, f)
+    options = dict(time_init = '2000-01-01', time_end = '2000-01-05', globe = True, prefetch = 0)
+    expected = JK_classification.JK_classification(str(tmp_path / 'msl.npy'), 'REAN', **options)
+    assert np.isfinite(expected.values).any()
+    for tiles, workers in (((7, 10), 1), ((5, 72), 2), ((40, 7), 3)):
+        output = JK_classification.JK_classification(str(tmp_path / 'msl.npy'), 'REAN', tiles = tiles,
+                                                     workers = workers, **options)
+        assert output.equals(expected)
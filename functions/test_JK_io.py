@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Tests of the input files (JK_io): raw arrays with a JSON sidecar and
+sub-daily records reduced to days across the files
+"""
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+import JK_functions
+import JK_io
+import JK_classification
+
+LAT = {'start': 70, 'step': -1, 'size': 41}
+LON = {'start': -30, 'step': 1, 'size': 81}
+
+def random_mslp(steps, freq = '6h', seed = 0):
+    #Random whole hPa values (in Pa), so daily means are exact and classify as the precomputed ones
+    rng = np.random.default_rng(seed)
+    time = pd.date_range('2000-01-01', periods = steps, freq = freq)
+    values = 100. * rng.integers(990, 1030, (steps, LAT['size'], LON['size']))
+    return(time, values)
+
+def writing_npy(path, time, values, **sidecar):
+    #Sidecar with only the dimensions and coordinates, the variable is named "msl" by default
+    np.save(str(path), values)
+    info = {'dims': ['time', 'lat', 'lon'], 'coords': {'time': [str(t) for t in time], 'lat': LAT, 'lon': LON}}
+    info.update(sidecar)
+    with open(str(path.with_suffix('.json')), 'w') as f:
+        json.dump(info, f)
+    return(str(path))
+
+def classifying(filename, **options):
+    return(JK_classification.JK_classification(filename, 'REAN', time_init = '2000-01-01', time_end = '2000-12-31',
+                                               globe = False, prefetch = 0, **options))
+
+def test_daily_steps():
+    time, values = random_mslp(40)
+    days = JK_functions.daily_steps(time.values, 'mean')
+    assert np.array_equal(days['starts'], np.arange(0, 40, 4))
+    assert np.array_equal(days['time'], time.values[::4])
+    hours = JK_functions.daily_steps(time.values, 12)
+    assert np.array_equal(hours['steps'], np.arange(2, 40, 4))
+    assert JK_functions.daily_steps(time.values[::4], 'mean') is None
+    with pytest.raises(ValueError):
+        JK_functions.daily_steps(time.values, 5)
+    with pytest.raises(TypeError):
+        JK_functions.daily_steps(time.values, 'max')
+
+@pytest.mark.parametrize('daily', ['mean', 12])
+@pytest.mark.parametrize('block_size', [1, 3, 31])
+@pytest.mark.parametrize('depth', [0, 2])
+def test_days_across_files(tmp_path, daily, block_size, depth):
+    #Day 4 (time steps 16 to 19) is split between the two files
+    time, values = random_mslp(40)
+    files = [writing_npy(tmp_path / 'msl_a.npy', time[:18], values[:18]),
+             writing_npy(tmp_path / 'msl_b.npy', time[18:], values[18:])]
+    segments, attrs = JK_io.opening_segments(files, JK_io.selecting_variable)
+    record = xr.concat(segments, 'time')
+    days = JK_functions.daily_steps(record.time.values, daily)
+    blocks = [block for start, block in JK_io.prefetch_blocks(segments, block_size, depth = depth, days = days)]
+    if daily == 'mean':
+        expected = record.resample(time = '1D').mean().values / 100
+    else:
+        expected = record.sel(time = record.time.dt.hour == 12).values / 100
+    assert np.array_equal(np.concatenate(blocks), expected)
+
+def test_days_missing_values(tmp_path):
+    #Missing values are left out of the daily means, days without values are missing
+    time, values = random_mslp(8)
+    values[1, 0, 0] = np.nan
+    values[4:, 1, 1] = np.nan
+    files = [writing_npy(tmp_path / 'msl_a.npy', time[:3], values[:3]),
+             writing_npy(tmp_path / 'msl_b.npy', time[3:], values[3:])]
+    segments, attrs = JK_io.opening_segments(files, JK_io.selecting_variable)
+    days = JK_functions.daily_steps(np.concatenate([segment.time.values for segment in segments]), 'mean')
+    block = JK_io.reading_days(segments, days, 0, 2, scale = 1)
+    assert block[0, 0, 0] == np.nanmean(values[:4, 0, 0])
+    assert np.isnan(block[1, 1, 1]) and block[0, 1, 1] == values[:4, 1, 1].mean()
+
+def test_classification_daily_across_files(tmp_path):
+    time, values = random_mslp(40)
+    files = [writing_npy(tmp_path / 'msl_a.npy', time[:18], values[:18]),
+             writing_npy(tmp_path / 'msl_b.npy', time[18:], values[18:])]
+    daily = writing_npy(tmp_path / 'daily.npy', time[::4], values.reshape(10, 4, *values.shape[1:]).mean(axis = 1))
+    expected = classifying(daily)
+    for block_size in (1, 3, 31):
+        output = classifying(files, daily = 'mean', block_size = block_size)
+        assert output.equals(expected)
+    output = classifying(files, daily = 'mean', tiles = (10, 20))
+    assert output.equals(expected)
+
+def test_sidecar_defaults(tmp_path):
+    #The same record as a .npy file, a binary memory map with encoded times and a netCDF file
+    time, values = random_mslp(12, freq = 'D')
+    array = writing_npy(tmp_path / 'msl.npy', time, values)
+    info = {'variable': 'pressure', 'dtype': 'float32', 'shape': list(values.shape), 'dims': ['time', 'lat', 'lon'],
+            'coords': {'time': {'values': list(range(12)), 'units': 'days since 2000-01-01'}, 'lat': LAT, 'lon': LON}}
+    with open(str(tmp_path / 'msl_raw.json'), 'w') as f:
+        json.dump(info, f)
+    raw_file = str(tmp_path / 'msl_raw.dat')
+    values.astype('float32').tofile(raw_file)
+    netcdf = str(tmp_path / 'msl.nc')
+    DS = JK_io.opening_file(array)
+    assert list(DS.data_vars) == ['msl'] and np.array_equal(DS.lat.values, np.arange(70, 29, -1))
+    assert JK_io.opening_file(raw_file).time.equals(DS.time)
+    DS.load().to_netcdf(netcdf)
+    DS.close()
+    expected = classifying(netcdf)
+    assert np.isfinite(expected.values).any()
+    assert classifying(array).equals(expected)
+    assert classifying(raw_file).equals(expected)
+
+def test_selecting_variable():
+    time, values = random_mslp(2, freq = 'D')
+    DS = xr.Dataset({'msl': (('time', 'lat', 'lon'), values),
+                     'lat_bnds': (('lat', 'bnds'), np.zeros((LAT['size'], 2))),
+                     'time_bnds': (('time', 'bnds', 'x'), np.zeros((2, 2, 1)))},
+                    coords = {'time': time})
+    assert JK_io.selecting_variable(DS).name == 'msl'
+    DS['orog'] = DS['msl'] * 0
+    with pytest.raises(ValueError):
+        JK_io.selecting_variable(DS)
+    assert JK_io.selecting_variable(DS, 'orog').name == 'orog'